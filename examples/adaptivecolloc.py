@@ -0,0 +1,75 @@
+# Adaptive mesh refinement for a collocation problem with a fast transient.
+import time
+import numpy as np
+import mpctools as mpc
+import matplotlib.pyplot as plt
+
+# Van der Pol oscillator in the relaxation regime. Starting away from the
+# origin, the state moves quickly before the controller settles it, so a
+# uniform mesh wastes intervals on the slow part of the trajectory.
+Nx = 2
+Nu = 1
+Nc = 3
+mu = 5
+T = 10
+
+def ode(x, u):
+    """Continuous-time model."""
+    return np.array([x[1], -x[0] + mu*(1 - x[0]**2)*x[1] + u[0]])
+f = mpc.getCasadiFunc(ode, [Nx, Nu], ["x", "u"], funcname="f")
+
+def stagecost(x, u):
+    """Quadratic stage cost."""
+    return x[0]**2 + x[1]**2 + 0.01*u[0]**2
+l = mpc.getCasadiFunc(stagecost, [Nx, Nu], ["x", "u"], funcname="l")
+
+x0 = np.array([2, 0])
+def build(Delta, guess):
+    """Builds the collocation problem on the given mesh."""
+    N = {"x" : Nx, "u" : Nu, "t" : len(Delta), "c" : Nc}
+    if guess is None:
+        guess = {}
+    return mpc.nmpc(f, l, N, x0, lb={"u" : -1}, ub={"u" : 1}, guess=guess,
+                    Delta=Delta, verbosity=0)
+
+# Refine a uniform mesh until the collocation error is below tol.
+tol = 1e-4
+print("Uniform mesh:")
+for Nt in [10, 20, 40, 80, 160]:
+    starttime = time.time()
+    uniform = build(T/Nt*np.ones(Nt), None)
+    uniform.solve()
+    print("    %3d intervals, %4d variables: error %.2e (%.2f s)"
+          % (Nt, uniform.var.size, np.max(uniform.collocerror()),
+             time.time() - starttime))
+
+# Now use adaptive refinement from the coarsest mesh.
+print("Adaptive mesh:")
+starttime = time.time()
+adaptive = mpc.adaptivecolloc(build, T/10*np.ones(10), tol=tol, verbosity=1)
+print("    %3d intervals, %4d variables: error %.2e (%.2f s total)"
+      % (adaptive.misc["N"]["t"], adaptive.var.size,
+         np.max(adaptive.collocerror()), time.time() - starttime))
+
+# Plot both solutions and the adaptive mesh.
+sols = {"Uniform" : mpc.callSolver(uniform),
+        "Adaptive" : mpc.callSolver(adaptive)}
+[fig, ax] = plt.subplots(nrows=Nx + 1, sharex=True)
+for (name, style) in [("Uniform", "-k"), ("Adaptive", "or")]:
+    sol = sols[name]
+    tfine = np.linspace(0, T, 500)
+    xfine = mpc.util.interpColloc(tfine, sol["x"], sol["xc"], sol["t"])
+    for i in range(Nx):
+        if name == "Uniform":
+            ax[i].plot(tfine, xfine[:,i], style, label=name)
+        else:
+            ax[i].plot(sol["t"], sol["x"][:,i], style, markerfacecolor="none",
+                       label="%s mesh" % name)
+        ax[i].set_ylabel("$x_{%d}$" % i)
+    ax[Nx].step(sol["t"][:-1], sol["u"][:,0], style[-1], where="post",
+                label=name)
+ax[Nx].set_ylabel("$u$")
+ax[Nx].set_xlabel("Time")
+ax[0].legend(loc="upper right")
+fig.tight_layout()
+mpc.plots.showandsave(fig, "adaptivecolloc.pdf")
@@ -34,13 +34,14 @@ x = sol["x"]
 u = sol["u"]
 z = sol["xc"]
 
-# Plot some stuff.
+# Plot some stuff. Evaluate the collocation polynomials before smushing.
+tfine = np.linspace(0,Nt*Delta,250)
+xinterp = util.interpColloc(tfine, x, z, Delta=Delta)
 colloc = util.smushColloc(None, x, None, z, Delta=Delta, asdict=True)
 tx = colloc["tp"]
 x = colloc["xp"]
 tz = colloc["tc"]
 z = colloc["xc"]
-tfine = np.linspace(0,Nt*Delta,250)
 xfine = np.zeros((2,len(tfine)))
 
 # Analytical solution.
@@ -54,6 +55,7 @@ f = plt.figure()
 for i in range(2):
     ax = f.add_subplot(2,1,1+i)
     ax.plot(tfine, xfine[i,:], "-k", label="Analytical")
+    ax.plot(tfine, xinterp[:,i], "--r", label="Collocation Polynomials")
     ax.plot(tx, x[:,i],'o', label="State Points", markerfacecolor="k",
             markeredgecolor="k")
     ax.plot(tz, z[:,i], "o", label="Collocation Points",
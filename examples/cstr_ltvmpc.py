@@ -0,0 +1,122 @@
+# Startup of a CSTR using nonlinear MPC and successive-linearization MPC.
+import time
+import mpctools as mpc
+import numpy as np
+
+# Define some parameters and then the CSTR model.
+Nx = 3
+Nu = 2
+Nd = 1
+Delta = .25
+
+T0 = 350
+c0 = 1
+r = .219
+k0 = 7.2e10
+E = 8750
+U = 54.94
+rho = 1000
+Cp = .239
+dH = -5e4
+
+def ode(x,u,d):
+    """CSTR model with x = [c, T, h], u = [Tc, F], and d = [F0]."""
+    c = x[0]
+    T = x[1]
+    h = x[2]
+    Tc = u[0]
+    F = u[1]
+    F0 = d[0]
+    rate = k0*c*np.exp(-E/T)
+    dxdt = np.array([
+        F0*(c0 - c)/(np.pi*r**2*h) - rate,
+        F0*(T0 - T)/(np.pi*r**2*h)
+            - dH/(rho*Cp)*rate
+            + 2*U/(r*rho*Cp)*(Tc - T),
+        (F0 - F)/(np.pi*r**2)
+    ])
+    return dxdt
+
+cstr = mpc.DiscreteSimulator(ode, Delta, [Nx,Nu,Nd], ["x","u","d"])
+ode_rk4_casadi = mpc.getCasadiFunc(ode, [Nx,Nu,Nd], ["x","u","d"],
+                                   funcname="F", rk4=True, Delta=Delta, M=2)
+
+# Steady state and LQR terminal penalty.
+xs = np.array([.878, 324.5, .659])
+us = np.array([300, .1])
+ds = np.array([.1])
+for i in range(10):
+    xs = cstr.sim(xs, us, ds)
+ss = mpc.util.getLinearizedModel(ode_rk4_casadi, [xs,us,ds], ["A","B","Bp"])
+Q = .5*np.diag(xs**-2)
+R = 2*np.diag(us**-2)
+[K, Pi] = mpc.util.dlqr(ss["A"], ss["B"], Q, R)
+
+def stagecost(x,u):
+    dx = x - xs
+    du = u - us
+    return mpc.mtimes(dx.T,Q,dx) + mpc.mtimes(du.T,R,du)
+l = mpc.getCasadiFunc(stagecost, [Nx,Nu], ["x","u"], funcname="l")
+
+def costtogo(x):
+    dx = x - xs
+    return mpc.mtimes(dx.T,Pi,dx)
+Pf = mpc.getCasadiFunc(costtogo, [Nx], ["x"], funcname="Pf")
+
+# Build both controllers. For NMPC, the disturbance is a fixed parameter, but
+# for LTV MPC, we pass its value in fpar.
+Nt = 15
+Nsim = 60
+x0 = np.array([.05*xs[0], .75*xs[1], .5*xs[2]])
+umax = np.array([.05*us[0], .15*us[1]])
+commonargs = dict(
+    l=l,
+    Pf=Pf,
+    x0=x0,
+    lb={"u" : us - umax},
+    ub={"u" : us + umax},
+    guess={"x" : np.tile(xs, (Nt + 1, 1)), "u" : np.tile(us, (Nt, 1))},
+    verbosity=0,
+)
+controllers = {}
+controllers["nmpc"] = mpc.nmpc(f=ode_rk4_casadi,
+                               N={"x":Nx, "u":Nu, "p":Nd, "t":Nt},
+                               p=np.tile(ds, (Nt, 1)), **commonargs)
+controllers["ltvmpc"] = mpc.ltvmpc(ode_rk4_casadi, N={"x":Nx, "u":Nu, "t":Nt},
+                                   fpar=[ds], **commonargs)
+
+# Simulate closed loop.
+xcl = {}
+ucl = {}
+for (method, controller) in controllers.items():
+    xcl[method] = np.zeros((Nsim + 1, Nx))
+    ucl[method] = np.zeros((Nsim, Nu))
+    xcl[method][0,:] = x0
+    solvetime = 0
+    for t in range(Nsim):
+        starttime = time.time()
+        controller.fixvar("x", 0, xcl[method][t,:])
+        if method == "ltvmpc":
+            controller.relinearize()
+        controller.solve()
+        solvetime += time.time() - starttime
+        if controller.stats["status"] not in ["Solve_Succeeded",
+                                              "Successful return."]:
+            print("%s %3d: %s" % (method, t, controller.stats["status"]))
+        ucl[method][t,:] = np.squeeze(controller.var["u",0])
+        xcl[method][t + 1,:] = cstr.sim(xcl[method][t,:], ucl[method][t,:],
+                                        ds)
+        controller.saveguess()
+    print("%6s: %.2f ms per sample" % (method, 1000*solvetime/Nsim))
+print("Max difference in u: %g" % np.max(np.abs(ucl["nmpc"] - ucl["ltvmpc"])
+                                       /umax))
+
+# Plot closed-loop trajectories.
+tplot = Delta*np.arange(Nsim + 1)
+fig = mpc.plots.mpcplot(xcl["nmpc"], ucl["nmpc"], tplot,
+                        np.tile(xs, (Nsim + 1, 1)),
+                        xnames=["$c$", "$T$", "$h$"], unames=["$T_c$", "$F$"],
+                        title="NMPC (solid) vs. LTV MPC (dashed)")
+for (i, ax) in enumerate(fig.axes[:Nx]):
+    ax.plot(tplot, xcl["ltvmpc"][:,i], "--k")
+mpc.plots.showandsave(fig, "cstr_ltvmpc.pdf")
@@ -0,0 +1,103 @@
+# Benchmark of automatic scaling for CSTR startup with nonlinear MPC.
+import time
+import mpctools as mpc
+import numpy as np
+
+# Define some parameters and then the CSTR model. The states are a
+# concentration near 1, a temperature near 300, and a level near 0.5, and the
+# inputs are a temperature near 300 and a flow near 0.1.
+Nx = 3
+Nu = 2
+Nd = 1
+Delta = .25
+
+T0 = 350
+c0 = 1
+r = .219
+k0 = 7.2e10
+E = 8750
+U = 54.94
+rho = 1000
+Cp = .239
+dH = -5e4
+
+def ode(x,u,d):
+    """CSTR model with x = [c, T, h], u = [Tc, F], and d = [F0]."""
+    c = x[0]
+    T = x[1]
+    h = x[2]
+    Tc = u[0]
+    F = u[1]
+    F0 = d[0]
+    rate = k0*c*np.exp(-E/T)
+    dxdt = np.array([
+        F0*(c0 - c)/(np.pi*r**2*h) - rate,
+        F0*(T0 - T)/(np.pi*r**2*h)
+            - dH/(rho*Cp)*rate
+            + 2*U/(r*rho*Cp)*(Tc - T),
+        (F0 - F)/(np.pi*r**2)
+    ])
+    return dxdt
+
+cstr = mpc.DiscreteSimulator(ode, Delta, [Nx,Nu,Nd], ["x","u","d"])
+ode_rk4_casadi = mpc.getCasadiFunc(ode, [Nx,Nu,Nd], ["x","u","d"],
+                                   funcname="F", rk4=True, Delta=Delta, M=2)
+
+# Steady state and LQR terminal penalty.
+xs = np.array([.878, 324.5, .659])
+us = np.array([300, .1])
+ds = np.array([.1])
+for i in range(10):
+    xs = cstr.sim(xs, us, ds)
+ss = mpc.util.getLinearizedModel(ode_rk4_casadi, [xs,us,ds], ["A","B","Bp"])
+Q = .5*np.diag(xs**-2)
+R = 2*np.diag(us**-2)
+[K, Pi] = mpc.util.dlqr(ss["A"], ss["B"], Q, R)
+
+def stagecost(x,u):
+    dx = x - xs
+    du = u - us
+    return mpc.mtimes(dx.T,Q,dx) + mpc.mtimes(du.T,R,du)
+l = mpc.getCasadiFunc(stagecost, [Nx,Nu], ["x","u"], funcname="l")
+
+def costtogo(x):
+    dx = x - xs
+    return mpc.mtimes(dx.T,Pi,dx)
+Pf = mpc.getCasadiFunc(costtogo, [Nx], ["x"], funcname="Pf")
+
+# Simulate closed-loop startup with and without scaling. Scale factors are
+# either inferred from bounds and guesses or given as nominal values.
+Nt = 15
+Nsim = 40
+x0 = np.array([.05*xs[0], .75*xs[1], .5*xs[2]])
+umax = np.array([.05*us[0], .15*us[1]])
+scalings = [("none", None), ("inferred", True),
+            ("nominal", {"x" : xs, "u" : us})]
+xcl = {}
+for (name, scaling) in scalings:
+    controller = mpc.nmpc(f=ode_rk4_casadi, N={"x":Nx, "u":Nu, "p":Nd, "t":Nt},
+                          p=np.tile(ds, (Nt, 1)), l=l, Pf=Pf, x0=x0,
+                          lb={"x" : np.zeros(Nx), "u" : us - umax},
+                          ub={"u" : us + umax},
+                          guess={"x" : np.tile(xs, (Nt + 1, 1)),
+                                 "u" : np.tile(us, (Nt, 1))},
+                          verbosity=0, scaling=scaling)
+    xcl[name] = np.zeros((Nsim + 1, Nx))
+    xcl[name][0,:] = x0
+    iterations = 0
+    failures = 0
+    starttime = time.time()
+    for t in range(Nsim):
+        controller.fixvar("x", 0, xcl[name][t,:])
+        controller.solve()
+        iterations += controller.stats["iter_count"]
+        failures += controller.stats["status"] != "Solve_Succeeded"
+        u = np.squeeze(controller.var["u",0])
+        xcl[name][t + 1,:] = cstr.sim(xcl[name][t,:], u, ds)
+        controller.saveguess()
+    solvetime = time.time() - starttime
+    print("%9s: %4d IPOPT iterations, %d failures, %.2f ms per sample"
+          % (name, iterations, failures, 1000*solvetime/Nsim))
+for (name, _) in scalings[1:]:
+    print("Max difference in x (%s): %g" % (name,
+          np.max(np.abs(xcl[name] - xcl["none"])/xs)))
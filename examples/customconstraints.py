@@ -32,7 +32,8 @@ N = {"x" : Nx, "u" : Nu, "t" : Nt}
 solver = mpc.nmpc(f, l, N, x0, lb, ub, verbosity=0)
 
 # Add some input blocking constraints. Note that you can achieve the same
-# effect using time-varying rate-of-change constraints on u, but we want to
+# effect using time-varying rate-of-change constraints on u or (more
+# efficiently) by passing blocks=blocksizes to nmpc, but we want to
 # illustrate custom constraints.
 blocksizes = [10, 5]*5
 if sum(blocksizes) > Nt:
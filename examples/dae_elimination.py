@@ -0,0 +1,69 @@
+# Benchmark of full-space DAE formulation vs. eliminating z with rootfinders.
+import time
+import numpy as np
+import mpctools as mpc
+
+# Van der Pol oscillator written as a DAE (see daeexample.py). With
+# collocation, the full-space formulation has z at every time point and
+# collocation point, while eliminating z leaves only differential states. Note
+# that the eliminated problem is built with MX, so each function evaluation is
+# more expensive, and the rootfinder adds Newton iterations to each call. For
+# this model, g is explicit in z and there is only one algebraic state, so the
+# smaller NLP does not make up for the slower evaluations, and the full-space
+# problem solves faster. Elimination is aimed at models with many algebraic
+# states relative to differential states.
+Delta = 0.5
+Nx = 2
+Nz = 1
+Nu = 1
+
+def zfunc(x):
+    return (1 - x[1]**2)*x[0]
+
+def odefunc(x, u, z):
+    return [z[0] - x[1] + u[0], x[0]]
+
+def gfunc(x, z):
+    return z[0] - zfunc(x)
+
+fdae = mpc.getCasadiFunc(odefunc, [Nx,Nu,Nz], ["x","u","z"], funcname="fdae")
+gdae = mpc.getCasadiFunc(gfunc, [Nx,Nz], ["x","z"], funcname="gdae")
+def stagecost(x, u):
+    return mpc.mtimes(x.T, x) + mpc.mtimes(u.T, u)
+l = mpc.getCasadiFunc(stagecost, [Nx,Nu], ["x","u"], funcname="l")
+def termcost(x):
+    return 10*mpc.mtimes(x.T, x)
+Pf = mpc.getCasadiFunc(termcost, [Nx], ["x"], funcname="Pf")
+
+# Compare formulations for a few horizons and numbers of collocation points.
+Nsim = 10
+x0 = np.array([0, 1])
+vdp = mpc.DiscreteSimulator(lambda x, u: odefunc(x, u, [zfunc(x)]), Delta,
+                            [Nx,Nu], ["x","u"])
+for (Nt, Nc) in [(25, 3), (50, 5)]:
+    print("Nt = %d, Nc = %d" % (Nt, Nc))
+    ucl = {}
+    for (label, eliminatez) in [("full space", False), ("eliminated", True)]:
+        builttime = time.time()
+        controller = mpc.nmpc(f=fdae, g=gdae, l=l, Pf=Pf,
+                              N={"x":Nx, "u":Nu, "z":Nz, "c":Nc, "t":Nt},
+                              x0=x0, lb={"u" : [-0.75]}, ub={"u" : [1]},
+                              Delta=Delta, verbosity=0, eliminatez=eliminatez)
+        builttime = time.time() - builttime
+
+        # Closed-loop simulation.
+        x = x0
+        ucl[label] = np.zeros((Nsim, Nu))
+        solvetime = time.time()
+        for t in range(Nsim):
+            controller.fixvar("x", 0, x)
+            controller.solve()
+            ucl[label][t,:] = np.squeeze(controller.var["u",0])
+            x = vdp.sim(x, ucl[label][t,:])
+            controller.saveguess()
+        solvetime = (time.time() - solvetime)/Nsim
+        print("    %-10s %5d vars: build %7.1f ms, solve %7.1f ms (%s)"
+              % (label, controller.var.size, 1000*builttime,
+                 1000*solvetime, controller.stats["status"]))
+    print("    Max difference in u: %g"
+          % np.max(np.abs(ucl["full space"] - ucl["eliminated"])))
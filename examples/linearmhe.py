@@ -0,0 +1,69 @@
+# Benchmark of linear MHE with LinearMHE vs. nmhe.
+import time
+import numpy as np
+import mpctools as mpc
+
+# Damped oscillator with position measurements and a long window. nmhe solves
+# the window NLP with Ipopt after every measurement, while LinearMHE solves
+# the same unconstrained least-squares problem with Riccati recursions that
+# are updated incrementally as measurements arrive. Both use the Kalman
+# filter arrival cost, so the window trajectories should agree.
+Nx = 2
+Nu = 1
+Ny = 1
+Nt = 500
+A = np.array([[1, 0.01], [-0.01, 0.999]])
+B = np.array([[0], [0.01]])
+C = np.array([[1, 0]])
+Q = 1e-4*np.eye(Nx)
+R = np.array([[0.01]])
+P0 = np.eye(Nx)
+x0 = np.zeros(Nx)
+
+# Simulate data.
+Nsim = 5000
+np.random.seed(0)
+u = np.sin(0.01*np.arange(Nsim))[:,np.newaxis]
+x = np.zeros((Nsim, Nx))
+x[0,:] = [1, 0]
+for t in range(Nsim - 1):
+    x[t + 1,:] = (A.dot(x[t,:]) + B.dot(u[t,:])
+                  + np.random.multivariate_normal(np.zeros(Nx), Q))
+y = x.dot(C.T) + np.sqrt(R[0,0])*np.random.randn(Nsim, Ny)
+
+# LinearMHE for the whole simulation.
+mhe = mpc.estimators.LinearMHE(A, B, C, Q, R, Nt, x0, P0)
+steptime = time.time()
+for t in range(Nsim):
+    mhe.step(y[t,:], u[t,:])
+steptime = (time.time() - steptime)/Nsim
+smoothtime = time.time()
+linear = mhe.smooth()
+smoothtime = time.time() - smoothtime
+print("LinearMHE: %.1f us per step (%.0f kHz), %.1f ms to smooth window"
+      % (1e6*steptime, 1e-3/steptime, 1000*smoothtime))
+print("    Riccati recursion steady: %s" % mhe.steady)
+
+# nmhe for the last window.
+(Qinv, Rinv, P0inv) = [np.linalg.inv(M) for M in [Q, R, mhe.P0]]
+def ffunc(x, u, w):
+    return mpc.mtimes(A, x) + mpc.mtimes(B, u) + w
+f = mpc.getCasadiFunc(ffunc, [Nx, Nu, Nx], ["x", "u", "w"], "f")
+h = mpc.getCasadiFunc(lambda x: mpc.mtimes(C, x), [Nx], ["x"], "h")
+def lfunc(w, v):
+    return mpc.mtimes(w.T, Qinv, w) + mpc.mtimes(v.T, Rinv, v)
+l = mpc.getCasadiFunc(lfunc, [Nx, Ny], ["w", "v"], "l")
+lx = mpc.getCasadiFunc(lambda x: mpc.mtimes(x.T, P0inv, x), [Nx], ["x"],
+                       "lx")
+builttime = time.time()
+nmhe = mpc.nmhe(f, h, u[-Nt - 1:-1,:], y[-Nt - 1:,:], l,
+                {"x" : Nx, "y" : Ny, "u" : Nu, "t" : Nt}, lx=lx,
+                x0bar=mhe.x0bar, verbosity=0)
+builttime = time.time() - builttime
+solvetime = time.time()
+nmhe.solve()
+solvetime = time.time() - solvetime
+print("nmhe: build %.1f ms, solve %.1f ms (%s)"
+      % (1000*builttime, 1000*solvetime, nmhe.stats["status"]))
+print("Max difference in x: %g" % np.max(np.abs(nmhe.vardict["x"]
+                                               - linear["x"])))
@@ -0,0 +1,55 @@
+# Benchmark of building linear MPC with lmpc vs. nmpc.
+import time
+import numpy as np
+import mpctools as mpc
+
+# Chain of masses connected by springs with a force on the first mass. nmpc
+# builds the QP from symbolic expressions at every time point, while lmpc
+# assembles the matrices directly with scipy.sparse, so its build time is
+# nearly independent of the horizon. Both use the sparse qrqp solver, but
+# nmpc also evaluates its symbolic derivatives at each solve.
+Nm = 5
+Nx = 2*Nm
+Nu = 1
+Delta = 0.25
+K = (np.diag(-2*np.ones(Nm)) + np.diag(np.ones(Nm - 1), 1)
+     + np.diag(np.ones(Nm - 1), -1))
+Ac = np.block([[np.zeros((Nm, Nm)), np.eye(Nm)], [K, np.zeros((Nm, Nm))]])
+Bc = np.zeros((Nx, Nu))
+Bc[Nm,0] = 1
+(A, B) = mpc.util.c2d(Ac, Bc, Delta)
+Q = np.eye(Nx)
+R = np.eye(Nu)
+x0 = np.zeros(Nx)
+xsp = np.zeros(Nx)
+xsp[:Nm] = 1
+lb = {"u" : -np.ones(Nu)}
+ub = {"u" : np.ones(Nu)}
+
+f = mpc.getLinearFunc([A, B], ["x", "u"], "f")
+def stagecost(x, u, x_sp):
+    dx = x - x_sp
+    return mpc.mtimes(dx.T, Q, dx) + mpc.mtimes(u.T, R, u)
+l = mpc.getCasadiFunc(stagecost, [Nx, Nu, Nx], ["x", "u", "x_sp"], "l")
+
+for Nt in [100, 1000]:
+    print("Nt = %d (%d variables)" % (Nt, (Nt + 1)*Nx + Nt*Nu))
+    u = {}
+    for method in ["lmpc", "nmpc"]:
+        builttime = time.time()
+        if method == "lmpc":
+            controller = mpc.lmpc(A, B, Q, R, Nt, x0=x0, lb=lb, ub=ub,
+                                  sp={"x" : xsp}, verbosity=0)
+        else:
+            controller = mpc.nmpc(f=f, l=l, N={"x" : Nx, "u" : Nu, "t" : Nt},
+                                  x0=x0, lb=lb, ub=ub, sp={"x" : xsp},
+                                  solver="qrqp", isQP=True, verbosity=0)
+        builttime = time.time() - builttime
+        solvetime = time.time()
+        controller.solve()
+        solvetime = time.time() - solvetime
+        u[method] = np.squeeze(controller.vardict["u"])
+        print("    %s: build %8.1f ms, solve %8.1f ms (%s)"
+              % (method, 1000*builttime, 1000*solvetime,
+                 controller.stats["status"]))
+    print("    Max difference in u: %g" % np.max(np.abs(u["lmpc"] - u["nmpc"])))
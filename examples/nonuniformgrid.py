@@ -0,0 +1,71 @@
+# Closed-loop NMPC with a uniform grid and a non-uniform grid with the same
+# lookahead. The non-uniform grid uses fine steps near the present and coarse
+# steps far in the future, so it needs far fewer stages.
+import time
+import numpy as np
+import mpctools as mpc
+
+# Van der Pol oscillator, discretized with rk4. Passing Delta=None makes the
+# timestep an extra argument "Delta" so that each stage can have its own.
+Nx = 2
+Nu = 1
+Delta = 0.25
+T = 12
+
+def ode(x, u):
+    """Continuous-time model."""
+    return np.array([(1 - x[1]*x[1])*x[0] - x[1] + u[0], x[0]])
+F = mpc.getCasadiFunc(ode, [Nx, Nu], ["x", "u"], funcname="F", rk4=True,
+                      Delta=None, M=2)
+vdp = mpc.DiscreteSimulator(ode, Delta, [Nx, Nu], ["x", "u"])
+
+def stagecost(x, u, Delta):
+    """Quadratic stage cost scaled by the length of each stage."""
+    return Delta*(mpc.mtimes(x.T, x) + mpc.mtimes(u.T, u))
+l = mpc.getCasadiFunc(stagecost, [Nx, Nu, 1], ["x", "u", "Delta"],
+                      funcname="l")
+
+# Uniform grid and a grid whose steps double every few stages. The first step
+# must match the simulation timestep.
+grids = {
+    "uniform" : Delta*np.ones(int(T/Delta)),
+    "nonuniform" : Delta*np.repeat([1, 2, 4, 8], [8, 4, 4, 2]),
+}
+x0 = np.array([0, 1])
+controllers = {}
+for (name, grid) in grids.items():
+    print("%10s grid: %d stages, lookahead %g" % (name, len(grid),
+                                                 np.sum(grid)))
+    N = {"x" : Nx, "u" : Nu, "t" : len(grid)}
+    controllers[name] = mpc.nmpc(F, l, N, x0, lb={"u" : -0.75},
+                                 ub={"u" : 1}, Delta=grid, inferargs=True,
+                                 verbosity=0)
+
+# Simulate closed loop.
+Nsim = 40
+xcl = {}
+ucl = {}
+for (name, controller) in controllers.items():
+    xcl[name] = np.zeros((Nsim + 1, Nx))
+    ucl[name] = np.zeros((Nsim, Nu))
+    xcl[name][0,:] = x0
+    solvetime = 0
+    for t in range(Nsim):
+        controller.fixvar("x", 0, xcl[name][t,:])
+        starttime = time.time()
+        controller.solve()
+        solvetime += time.time() - starttime
+        ucl[name][t,:] = np.squeeze(controller.var["u",0])
+        xcl[name][t + 1,:] = vdp.sim(xcl[name][t,:], ucl[name][t,:])
+        controller.saveguess()
+    cost = Delta*(np.sum(xcl[name]**2) + np.sum(ucl[name]**2))
+    print("%10s grid: %5.2f ms per sample, %4d variables, cost %.4f"
+          % (name, 1000*solvetime/Nsim, controller.var.size, cost))
+
+# Plot closed-loop trajectories.
+tplot = Delta*np.arange(Nsim + 1)
+fig = mpc.plots.mpcplot(xcl["uniform"], ucl["uniform"], tplot,
+                        title="Uniform (solid) vs. non-uniform (dashed)")
+for (i, ax) in enumerate(fig.axes[:Nx]):
+    ax.plot(tplot, xcl["nonuniform"][:,i], "--k")
+mpc.plots.showandsave(fig, "nonuniformgrid.pdf")
@@ -0,0 +1,68 @@
+# Particle filter for a bimodal estimation problem, with timing benchmark.
+import time
+import numpy as np
+import mpctools as mpc
+import matplotlib.pyplot as plt
+
+# Classic benchmark model whose measurement only sees x^2, so the posterior
+# is bimodal whenever x is near zero. The time-varying forcing term is passed
+# in as the input u.
+Nx = 1
+Nu = 1
+Ny = 1
+Q = np.array([[10.]])
+R = np.array([[1.]])
+
+def f(x, u):
+    """Discrete-time model x^+ = f(x,u) + w."""
+    return 0.5*x + 25*x/(1 + x**2) + u
+
+def h(x):
+    """Measurement y = h(x) + v."""
+    return x**2/20
+
+fcasadi = mpc.getCasadiFunc(f, [Nx, Nu], ["x", "u"], "f")
+hcasadi = mpc.getCasadiFunc(h, [Nx], ["x"], "h")
+
+# Simulate the plant.
+Nsim = 50
+np.random.seed(0)
+u = 8*np.cos(1.2*np.arange(Nsim))[:,np.newaxis]
+x = np.zeros((Nsim + 1, Nx))
+y = np.zeros((Nsim, Ny))
+for k in range(Nsim):
+    y[k] = h(x[k]) + np.sqrt(R[0,0])*np.random.randn(Ny)
+    x[k + 1] = f(x[k], u[k]) + np.sqrt(Q[0,0])*np.random.randn(Nx)
+
+# Benchmark the filter for various numbers of particles. Each step includes
+# one mapped model evaluation and (possibly) a resampling step.
+x0 = np.zeros((Nx,))
+P0 = np.array([[5.]])
+xhat = {}
+for parallelization in ["serial", "thread"]:
+    for Nparticles in [10**3, 10**4, 10**5]:
+        pf = mpc.estimators.ParticleFilter(fcasadi, hcasadi, x0, P0, Q, R,
+                                           Nparticles=Nparticles, seed=0,
+                                           parallelization=parallelization)
+        thisxhat = np.zeros((Nsim, Nx))
+        starttime = time.time()
+        for k in range(Nsim):
+            pf.correct(y[k])
+            thisxhat[k] = pf.xhat
+            pf.predict(u[k])
+        steptime = (time.time() - starttime)/Nsim
+        print("%8s, %6d particles: %7.3f ms per step" % (parallelization,
+              Nparticles, 1000*steptime))
+        xhat[Nparticles] = thisxhat
+
+# Plot estimates.
+[fig, ax] = plt.subplots()
+ax.plot(x[:-1,0], color="black", label="Actual")
+for (Nparticles, marker) in [(10**3, "o"), (10**5, "s")]:
+    ax.plot(xhat[Nparticles][:,0], marker=marker, markerfacecolor="none",
+            linestyle="none", label="%d particles" % Nparticles)
+ax.set_xlabel("Time")
+ax.set_ylabel("$x$")
+ax.legend(loc="upper right")
+fig.tight_layout()
+mpc.plots.showandsave(fig, "particlefilter.pdf")
@@ -40,10 +40,12 @@ if casadi.has_conic("qpoases"):
 if casadi.has_nlpsol("bonmin"):
     examplefiles += ["fishing.py", "cargears.py"]
 examplefiles += [
+    "adaptivecolloc.py",
     "airplane.py",
     "ballmaze.py",
     "cstr.py",
     "cstr_startup.py",
+    "cstr_ltvmpc.py",
     "cstr_nmpc_nmhe.py",
     "collocationexample.py",
     "comparison_casadi.py",
@@ -55,6 +57,7 @@ examplefiles += [
     "mpcmodelcomparison.py",
     "nmheexample.py",
     "nmpcexample.py",
+    "nonuniformgrid.py",
     "periodicmpcexample.py",
     "predatorprey.py",
     "softconstraints.py",
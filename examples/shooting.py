@@ -0,0 +1,72 @@
+# Benchmark of multiple shooting, partial condensing, and single shooting.
+import time
+import numpy as np
+import mpctools as mpc
+
+# Three test problems. The Van der Pol oscillator is unstable with a long
+# horizon, so single shooting is badly conditioned and slow, while partial
+# condensing keeps it well-behaved with fewer variables. The nonlinear chain
+# of tanks has many states and a short horizon, so eliminating states mostly
+# makes the model functions more expensive to build. The linear spring-mass
+# system is a QP solved with a dense active-set method, where eliminating
+# states is much faster than multiple shooting.
+def vdp(x, u):
+    """Van der Pol oscillator."""
+    return np.array([(1 - x[1]*x[1])*x[0] - x[1] + u[0], x[0]])
+
+Nchain = 30
+def chain(x, u):
+    """Chain of tanks with second-order reaction. Input is the feed."""
+    xin = [u[0]] + [x[i] for i in range(Nchain - 1)]
+    return np.array([xin[i] - x[i] - 0.5*x[i]**2 for i in range(Nchain)])
+
+def masses(x, u):
+    """Two masses connected by a spring. Force acts on the first mass."""
+    return np.array([x[2], x[3], x[1] - 2*x[0] + u[0], x[0] - x[1]])
+
+problems = {}
+problems["vdp"] = dict(ode=vdp, Nx=2, Nu=1, Nt=100, Delta=0.1,
+                       x0=np.array([0, 1]), xlb=np.array([-0.25, -np.inf]),
+                       ulb=-0.75, uub=1, solver="ipopt")
+problems["chain"] = dict(ode=chain, Nx=Nchain, Nu=1, Nt=20, Delta=0.25,
+                         x0=np.ones(Nchain), xlb=0.1*np.ones(Nchain),
+                         ulb=0, uub=2, solver="ipopt")
+problems["masses"] = dict(ode=masses, Nx=4, Nu=1, Nt=60, Delta=0.25,
+                          x0=np.array([1, -1, 0, 0]), xlb=-np.inf*np.ones(4),
+                          ulb=-0.5, uub=0.5, solver="qpoases")
+
+# Solve each problem with each formulation. qpOASES is a dense active-set QP
+# solver, so it benefits the most from having fewer variables. Note that the
+# first build with each solver includes loading the plugin.
+variants = [("multiple", "multiple"), ("condensed (k=10)", 10),
+            ("single", "single")]
+Nrep = 3
+for (name, prob) in sorted(problems.items()):
+    (Nx, Nu, Nt) = (prob["Nx"], prob["Nu"], prob["Nt"])
+    f = mpc.getCasadiFunc(prob["ode"], [Nx, Nu], ["x", "u"], "f", rk4=True,
+                          Delta=prob["Delta"], M=2)
+    def lfunc(x, u):
+        return mpc.mtimes(x.T, x) + mpc.mtimes(u.T, u)
+    l = mpc.getCasadiFunc(lfunc, [Nx, Nu], ["x", "u"], "l")
+    print("%s (Nx = %d, Nt = %d, %s)" % (name, Nx, Nt, prob["solver"]))
+    objs = []
+    for (label, shooting) in variants:
+        lb = {"x" : prob["xlb"], "u" : prob["ulb"]*np.ones(Nu)}
+        ub = {"u" : prob["uub"]*np.ones(Nu)}
+        builttime = time.time()
+        controller = mpc.nmpc(f=f, l=l, N={"x" : Nx, "u" : Nu, "t" : Nt},
+                              x0=prob["x0"], lb=lb, ub=ub,
+                              verbosity=0, shooting=shooting,
+                              solver=prob["solver"],
+                              isQP=(prob["solver"] == "qpoases"))
+        builttime = time.time() - builttime
+        solvetime = time.time()
+        for i in range(Nrep):
+            controller.saveguess(default=True)
+            controller.solve()
+        solvetime = (time.time() - solvetime)/Nrep
+        objs.append(controller.obj)
+        print("    %-17s %5d vars: build %7.1f ms, solve %7.1f ms (%s)"
+              % (label, controller.var.size, 1000*builttime,
+                 1000*solvetime, controller.stats["status"]))
+    print("    Max objective difference: %g" % (max(objs) - min(objs)))
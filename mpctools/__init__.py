@@ -42,7 +42,9 @@ from . import plots
 from . import util
 from . import colloc
 from . import solvers
+from . import estimators
 from .tools import nmpc, nmhe, sstarg, getCasadiFunc, DiscreteSimulator
+from .tools import ltvmpc, lmpc, adaptivecolloc, getLinearFunc
 from .util import safevertcat as vcat
 from .util import keyboard, mtimes, ekf
 from .util import sum1 as sum
@@ -7,9 +7,21 @@ in runall.py.
 """
 
 import unittest
+import warnings
+import os
+import shutil
+import tempfile
 import numpy as np
+import scipy.linalg
+import scipy.special
+import scipy.sparse
 import casadi
 from .util import safevertcat
+from . import util
+from . import tools
+from . import estimators
+from . import colloc
+from . import solvers
 
 class SymTests(unittest.TestCase):
     """Tests compatibility of various operations with symbolics."""
@@ -38,5 +50,634 @@ class SymTests(unittest.TestCase):
         with self.assertRaises(TypeError):
             safevertcat(1)
 
+class CasadiFuncTests(unittest.TestCase):
+    """Tests building Casadi Functions from Python functions."""
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.cache)
+    
+    def test_cache(self):
+        # Second build should load the cached Function.
+        def build(k):
+            def ode(x, u):
+                return np.array([-k*x[0] + u[0], x[0] - x[1]*x[1]])
+            return tools.getCasadiFunc(ode, [2, 1], ["x", "u"], "f", rk4=True,
+                                       Delta=0.5, cache=self.cache)
+        def entries():
+            return [f for f in os.listdir(self.cache)
+                    if f.endswith(".casadi")]
+        f = build(1.0)
+        self.assertEqual(len(entries()), 1)
+        cached = build(1.0)
+        self.assertEqual(len(entries()), 1)
+        np.testing.assert_allclose(cached([1, 2], [3]), f([1, 2], [3]))
+        
+        # Changing closure variables should give a new entry.
+        f = build(2.0)
+        self.assertEqual(len(entries()), 2)
+        self.assertFalse(np.allclose(f([1, 2], [3]), cached([1, 2], [3])))
+        
+        # Constants should be restored from the cache.
+        k = np.array([[1.0, 2.0]])
+        def g(x):
+            return util.mtimes(k, x)
+        for i in range(2):
+            gcasadi = tools.getCasadiFunc(g, [2], ["x"], "g", cache=self.cache,
+                                          constants=["k"])
+        self.assertEqual(len(entries()), 3)
+        self.assertEqual(list(gcasadi.constants), ["k"])
+        np.testing.assert_array_equal(gcasadi.constants["k"], k)
+    
+    def test_matrixargs(self):
+        # Matrix arguments should be passed with the correct layout.
+        M = np.arange(6.0).reshape(3, 2)
+        f = tools.getCasadiFunc(lambda A : [A[1,0], A[2,1]], [[3, 2]], ["A"])
+        np.testing.assert_allclose(np.squeeze(f(M)), [M[1,0], M[2,1]])
+
+    def test_linearfunc(self):
+        # Sparse model should match the dense one without any zeros.
+        A = scipy.sparse.diags([1.0, -2.0, 1.0], [-1, 0, 1], shape=(20, 20))
+        B = np.zeros(20)
+        B[0] = 1
+        f = tools.getLinearFunc([A, B], ["x", "u"], "f", offset=np.ones(20))
+        self.assertEqual(f.name_in(), ["x", "u"])
+        (x, u) = (np.arange(20.0), 2.0)
+        np.testing.assert_allclose(np.squeeze(f(x, u)),
+                                   A.dot(x) + B*u + 1)
+        jac = casadi.jacobian(f(*f.sx_in()), f.sx_in()[0])
+        self.assertEqual(jac.nnz(), A.nnz)
+
+class EstimatorTests(unittest.TestCase):
+    """Tests estimators against util.ekf."""
+    def setUp(self):
+        def ffunc(x, u, w):
+            return np.array([x[0] + 0.1*x[1],
+                             x[1] - 0.1*np.sin(x[0]) + u[0]]) + w
+        def hfunc(x):
+            return np.array([x[0]**2 + x[1]])
+        self.f = tools.getCasadiFunc(ffunc, [2, 1, 2], ["x", "u", "w"], "f")
+        self.h = tools.getCasadiFunc(hfunc, [2], ["x"], "h")
+        self.Q = 0.01*np.eye(2)
+        self.R = 0.1*np.eye(1)
+        self.x0 = np.array([0.5, -0.2])
+        self.P0 = np.eye(2)
+        
+    def test_ekf(self):
+        ekf = estimators.EKF(self.f, self.h, self.x0, self.P0, self.Q, self.R)
+        (x, P) = (self.x0, self.P0)
+        for (k, y) in enumerate([0.3, 0.1, -0.2, 0.4]):
+            u = np.array([0.1*k])
+            check = util.ekf(self.f, self.h, x, u, np.zeros(2), np.array([y]),
+                             P, self.Q, self.R)
+            result = ekf.step(np.array([y]), u)
+            for (a, b) in zip(check, result):
+                np.testing.assert_allclose(a, b, rtol=1e-10, atol=1e-12)
+            (P, x) = check[:2]
+    
+    def test_ekfbank(self):
+        K = 3
+        x0 = self.x0 + 0.1*np.arange(K)[:,np.newaxis]
+        bank = estimators.EKFBank(self.f, self.h, x0, self.P0, self.Q, self.R)
+        y = np.array([[0.3], [0.1], [-0.2]])
+        u = np.array([[0.1], [0.2], [0.3]])
+        result = bank.step(y, u)
+        for k in range(K):
+            check = util.ekf(self.f, self.h, x0[k], u[k], np.zeros(2), y[k],
+                             self.P0, self.Q, self.R)
+            for (a, b) in zip(check, result):
+                np.testing.assert_allclose(a, b[k], rtol=1e-12, atol=1e-14)
+
+    def test_kalmanfilterbank(self):
+        (K, Nt) = (4, 10)
+        A = np.array([[0.9, 0.1], [-0.1, 0.8]])
+        B = np.array([[0], [0.5]])
+        C = np.array([[1, 0]])
+        [L, _] = util.dlqe(A, C, self.Q, self.R)
+        np.random.seed(0)
+        x0 = np.random.randn(K, 2)
+        y = np.random.randn(Nt, K, 1)
+        u = np.random.randn(Nt, K, 1)
+        bank = estimators.KalmanFilterBank(A, B, C, L, x0)
+        xhatm = x0.copy()
+        for t in range(Nt):
+            result = bank.step(y[t], u[t])
+            for k in range(K):
+                xhat = xhatm[k] + L.dot(y[t,k] - C.dot(xhatm[k]))
+                xhatm[k] = A.dot(xhat) + B.dot(u[t,k])
+                np.testing.assert_allclose(result[0][k], xhatm[k],
+                                           rtol=1e-12, atol=1e-14)
+                np.testing.assert_allclose(result[1][k], xhat, rtol=1e-12,
+                                           atol=1e-14)
+
+    def test_ukf(self):
+        # For a linear model, the UKF and EKF should be identical.
+        A = np.array([[1, 0.1], [-0.2, 0.9]])
+        f = tools.getCasadiFunc(lambda x, u, w: util.mtimes(A, x) + u + w,
+                                [2, 1, 2], ["x", "u", "w"], "f")
+        h = tools.getCasadiFunc(lambda x: np.array([x[0] + 2*x[1]]), [2],
+                                ["x"], "h")
+        # Also check a singular Q, which has no Cholesky factor.
+        for Q in [self.Q, np.diag([0, 0.1])]:
+            ekf = estimators.EKF(f, h, self.x0, self.P0, Q, self.R)
+            ukf = estimators.UKF(f, h, self.x0, self.P0, Q, self.R)
+            for y in [0.3, 0.1, -0.2]:
+                check = ekf.step(np.array([y]), np.array([0.1]))
+                result = ukf.step(np.array([y]), np.array([0.1]))
+                for (a, b) in zip(check, result):
+                    np.testing.assert_allclose(a, b, rtol=1e-10, atol=1e-12)
+    
+    def test_particlefilter(self):
+        # With enough particles, estimates should be close to the EKF's.
+        f = tools.getCasadiFunc(lambda x, u, w: 0.9*x + u + w, [2, 1, 2],
+                                ["x", "u", "w"], "f")
+        h = tools.getCasadiFunc(lambda x: np.array([x[0] + 2*x[1]]), [2],
+                                ["x"], "h")
+        # Also check a singular Q, which has no Cholesky factor.
+        for Q in [self.Q, np.diag([0, 0.01])]:
+            ekf = estimators.EKF(f, h, self.x0, self.P0, Q, self.R)
+            pf = estimators.ParticleFilter(f, h, self.x0, self.P0, Q, self.R,
+                                           Nparticles=50000, seed=0)
+            self.assertAlmostEqual(pf.ess, 50000)
+            for y in [0.3, 0.1, -0.2]:
+                check = ekf.step(np.array([y]), np.array([0.1]))
+                result = pf.step(np.array([y]), np.array([0.1]))
+                np.testing.assert_allclose(check[1], result[0], atol=0.05)
+
+    def test_linearmhe(self):
+        # Should match the EKF and nmhe with the same arrival cost.
+        A = np.array([[1, 0.1], [-0.2, 0.9]])
+        B = np.array([[0], [0.1]])
+        C = np.array([[1, 2]])
+        f = tools.getCasadiFunc(lambda x, u, w: (util.mtimes(A, x)
+                                                 + util.mtimes(B, u) + w),
+                                [2, 1, 2], ["x", "u", "w"], "f")
+        h = tools.getCasadiFunc(lambda x: util.mtimes(C, x), [2], ["x"], "h")
+        ekf = estimators.EKF(f, h, self.x0, self.P0, self.Q, self.R)
+        mhe = estimators.LinearMHE(A, B, C, self.Q, self.R, 5, self.x0,
+                                   self.P0)
+        y = np.sin(np.arange(200))[:,np.newaxis]
+        u = np.cos(np.arange(200))[:,np.newaxis]
+        for t in range(199):
+            check = ekf.step(y[t], u[t])
+            result = mhe.step(y[t], u[t])
+            for (a, b) in zip(check, result):
+                np.testing.assert_allclose(a, b, rtol=1e-8, atol=1e-10)
+        self.assertTrue(mhe.steady)
+        
+        (Qinv, Rinv, P0inv) = [np.linalg.inv(M) for M
+                               in [self.Q, self.R, mhe.P0]]
+        l = tools.getCasadiFunc(lambda w, v: (util.mtimes(w.T, Qinv, w)
+                                              + util.mtimes(v.T, Rinv, v)),
+                                [2, 1], ["w", "v"], "l")
+        lx = tools.getCasadiFunc(lambda x: util.mtimes(x.T, P0inv, x), [2],
+                                 ["x"], "lx")
+        nmhe = tools.nmhe(f, h, u[193:198], y[193:199], l,
+                          {"x" : 2, "y" : 1, "u" : 1, "t" : 5}, lx=lx,
+                          x0bar=mhe.x0bar, verbosity=-1)
+        for t in [199, None]:
+            nmhe.solve()
+            sol = mhe.smooth()
+            for k in ["x", "w", "v"]:
+                np.testing.assert_allclose(nmhe.vardict[k], sol[k],
+                                           atol=1e-8)
+            if t is not None:
+                mhe.step(y[t], u[t])
+                nmhe.newmeasurement(y[t], u[t - 1], mhe.x0bar)
+    
+class LinearizationTests(unittest.TestCase):
+    """Tests linearization and discretization."""
+    def setUp(self):
+        def ode(x, u):
+            return np.array([-x[0]*u[0] + np.exp(-x[1]), x[0] - x[1]**2])
+        self.f = tools.getCasadiFunc(ode, [2, 1], ["x", "u"], "f")
+        
+    def test_stackedlinearization(self):
+        x = np.array([[0.5, 0.3], [0.1, 0.2], [1, -1]])
+        u = np.array([[1], [0.5], [2]])
+        stacked = util.getLinearizedModel(self.f, [x, u], ["A", "B"],
+                                          Delta=0.1, stacked=True)
+        for k in range(x.shape[0]):
+            check = util.getLinearizedModel(self.f, [x[k], u[k]], ["A", "B"],
+                                            Delta=0.1)
+            for v in ["A", "B", "f"]:
+                np.testing.assert_allclose(stacked[v][k], check[v])
+
+    def test_stackedc2d(self):
+        np.random.seed(0)
+        A = np.random.randn(5, 3, 3)
+        B = np.random.randn(3, 2)
+        (Ad, Bd) = util.c2d(A, B, 0.5)
+        objective = util.c2dObjective(A, np.tile(B, (5, 1, 1)), np.eye(3),
+                                      np.eye(2), 0.5)
+        for k in range(A.shape[0]):
+            check = scipy.linalg.expm(0.5*A[k])
+            np.testing.assert_allclose(Ad[k], check)
+            np.testing.assert_allclose(objective[0][k], check)
+            np.testing.assert_allclose(Bd[k], objective[1][k])
+
+    def test_expmcache(self):
+        # Stacks larger than the cache should still work, and hits should
+        # not be evicted by the misses computed in the same call.
+        np.random.seed(0)
+        A = 0.1*np.random.randn(6, 2, 2)
+        maxsize = util.EXPM_CACHE.maxsize
+        util.EXPM_CACHE.maxsize = 4
+        try:
+            util.expm(A[:2])
+            expA = util.expm(A)
+        finally:
+            util.EXPM_CACHE.maxsize = maxsize
+        for k in range(A.shape[0]):
+            np.testing.assert_allclose(expA[k], scipy.linalg.expm(A[k]))
+        
+        # Total size should be bounded by maxbytes.
+        cache = util.LRUCache(maxsize=100, maxbytes=3*A[0].nbytes)
+        for k in range(A.shape[0]):
+            cache.get(k, lambda : A[k])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 3*A[0].nbytes)
+        self.assertEqual([k in cache for k in range(6)], [False]*3 + [True]*3)
+
+class RiccatiTests(unittest.TestCase):
+    """Tests finite-horizon and cached Riccati solutions."""
+    def setUp(self):
+        np.random.seed(0)
+        self.A = 0.5*np.random.randn(4, 4)
+        self.B = np.random.randn(4, 2)
+        self.C = np.random.randn(2, 4)
+        self.Q = np.eye(4)
+        self.R = np.eye(2)
+        
+    def test_timevarying(self):
+        [K, Pi] = util.dlqr(self.A, self.B, self.Q, self.R)
+        [Kt, Pit] = util.dlqrtv(self.A, self.B, self.Q, self.R,
+                                np.zeros((4, 4)), N=200)
+        np.testing.assert_allclose(Kt[0], K, atol=1e-10)
+        np.testing.assert_allclose(Pit[0], Pi, atol=1e-10)
+        [L, P] = util.dlqe(self.A, self.C, self.Q, self.R)
+        [Lt, Pt] = util.dlqetv(self.A, self.C, self.Q, self.R, np.eye(4),
+                               N=200)
+        np.testing.assert_allclose(Lt[-1], L, atol=1e-10)
+        np.testing.assert_allclose(Pt[-1], P, atol=1e-10)
+        
+    def test_terminalcost(self):
+        terminal = util.LQRTerminalCost(self.Q, self.R)
+        terminal(self.A, self.B)
+        A = self.A + 1e-3*np.random.randn(4, 4)
+        [K, Pi] = terminal(A, self.B)
+        [Kcheck, Picheck] = util.dlqr(A, self.B, self.Q, self.R)
+        np.testing.assert_allclose(K, Kcheck, atol=1e-10)
+        np.testing.assert_allclose(Pi, Picheck, atol=1e-10)
+
+class CollocTests(unittest.TestCase):
+    """Tests collocation weights."""
+    def test_radau(self):
+        [r, A, B, q] = colloc.weights(2, False, True, "radau")
+        np.testing.assert_allclose(r, [(4 - np.sqrt(6))/10,
+                                       (4 + np.sqrt(6))/10, 1])
+        np.testing.assert_allclose(q, [(16 - np.sqrt(6))/36,
+                                       (16 + np.sqrt(6))/36, 1/9])
+        
+        # High orders should match the closed form for Radau weights.
+        n = 25
+        [r, A, B, q] = colloc.weights(n, False, True, "radau")
+        x = 2*r[:-1] - 1
+        check = (1 + x)/(2*(n + 1)**2*scipy.special.eval_legendre(n, x)**2)
+        np.testing.assert_allclose(q, np.append(check, 1/(n + 1)**2),
+                                   rtol=1e-10)
+        
+    def test_cached(self):
+        [r, A, B, q] = colloc.weights(4)
+        self.assertRaises(ValueError, r.__setitem__, 0, 1)
+        r.shape = (r.size, 1)
+        self.assertEqual(colloc.weights(4)[0].shape, (6,))
+        np.testing.assert_allclose(A.dot(r**2)[:,0], 2*r[:,0], atol=1e-10)
+
+    def test_interpolation(self):
+        def x(t):
+            return np.array([t**3 - t, 2*t**2]).T
+        Delta = 0.5
+        t = Delta*np.arange(4)
+        r = colloc.weights(2, False, False)[0]
+        tc = t[:-1,np.newaxis] + Delta*r
+        xc = x(tc.flatten()).reshape((3, 2, 2)).transpose((0, 2, 1))
+        tq = np.linspace(0, t[-1], 31)
+        np.testing.assert_allclose(util.interpColloc(tq, x(t), xc, t), x(tq),
+                                   atol=1e-12)
+
+class ControllerTests(unittest.TestCase):
+    """Tests alternative controller formulations against nmpc."""
+    def setUp(self):
+        (Nx, Nu, Nt) = (2, 1, 10)
+        def ode(x, u):
+            return np.array([(1 - x[1]*x[1])*x[0] - x[1] + u[0], x[0]])
+        self.f = tools.getCasadiFunc(ode, [Nx, Nu], ["x", "u"], "F", rk4=True,
+                                     Delta=0.5)
+        self.fcont = tools.getCasadiFunc(ode, [Nx, Nu], ["x", "u"], "f")
+        def lfunc(x, u):
+            return util.mtimes(x.T, x) + util.mtimes(u.T, u)
+        l = tools.getCasadiFunc(lfunc, [Nx, Nu], ["x", "u"], "l")
+        self.args = dict(N={"x" : Nx, "u" : Nu, "t" : Nt}, l=l, verbosity=-1,
+                         x0=np.array([0, 1]), lb={"u" : -0.75*np.ones(Nu)},
+                         ub={"u" : np.ones(Nu)})
+        self.nmpc = tools.nmpc(f=self.f, **self.args)
+        self.nmpc.solve()
+    
+    def test_ltvmpc(self):
+        # Repeated relinearization should converge to the NMPC solution.
+        ltv = tools.ltvmpc(self.f, solver="ipopt", **self.args)
+        for i in range(10):
+            ltv.relinearize()
+            ltv.solve()
+            ltv.saveguess(toffset=0)
+        np.testing.assert_allclose(ltv.vardict["u"], self.nmpc.vardict["u"],
+                                   atol=1e-5)
+
+    def test_adaptivecolloc(self):
+        def build(Delta, guess):
+            args = self.args.copy()
+            args["N"] = dict(args["N"], t=len(Delta), c=2)
+            return tools.nmpc(f=self.fcont, Delta=Delta, guess=guess or {},
+                              **args)
+        solver = tools.adaptivecolloc(build, 0.5*np.ones(10), tol=1e-5)
+        self.assertLessEqual(np.max(solver.collocerror()), 1e-5)
+        t = solvers.callSolver(solver)["t"]
+        self.assertAlmostEqual(t[-1], 5)
+        self.assertGreater(np.ptp(np.diff(t)), 0)
+
+    def test_nonuniformgrid(self):
+        # Stepsize as a parameter should match the fixed-step model.
+        F = tools.getCasadiFunc(lambda x, u: self.fcont(x, u), [2, 1],
+                                ["x", "u"], "F", rk4=True, Delta=None)
+        controller = tools.nmpc(f=F, Delta=0.5*np.ones(10), inferargs=True,
+                                **self.args)
+        controller.solve()
+        np.testing.assert_allclose(controller.vardict["u"],
+                                   self.nmpc.vardict["u"], atol=1e-8)
+        
+        # Shifting the guess on a non-uniform grid should interpolate.
+        Delta = np.repeat([0.25, 0.5, 1], [4, 2, 2])
+        args = dict(self.args, N=dict(self.args["N"], t=8))
+        controller = tools.nmpc(f=F, Delta=Delta, inferargs=True, **args)
+        controller.solve()
+        controller.saveguess()
+        x = np.squeeze(controller.vardict["x"])
+        xguess = np.squeeze(controller.guess["x"])
+        np.testing.assert_allclose(xguess[:4], x[1:5])
+        np.testing.assert_allclose(xguess[4], 0.5*(x[4] + x[5]))
+        
+        # Changing the parameter should change the time grid.
+        controller.par["Delta"] = 0.5
+        t = solvers.callSolver(controller)["t"]
+        np.testing.assert_allclose(t, 0.5*np.arange(9))
+        
+        # Delta is only a parameter if a discrete-time model can use it.
+        extra = dict(self.args, extrapar={"Delta" : 1})
+        scalar = tools.nmpc(f=self.f, Delta=0.5, **extra)
+        self.assertIn("Delta", scalar.par.keys())
+        self.assertEqual(len(scalar.par["Delta"]), 1)
+        with self.assertRaises(KeyError):
+            tools.nmpc(f=F, Delta=0.5*np.ones(10), **extra)
+
+    def test_blocking(self):
+        # Should match adding equality constraints on u.
+        blocks = [2, 3, 5]
+        constrained = tools.nmpc(f=self.f, **self.args)
+        u = constrained.varsym["u"]
+        con = [u[t] - u[t - 1] for t in [1, 3, 4, 6, 7, 8, 9]]
+        constrained.addconstraints(con)
+        constrained.solve()
+        blocked = tools.nmpc(f=self.f, blocks=blocks, **self.args)
+        blocked.solve()
+        self.assertEqual(len(blocked.var["u"]), len(blocks))
+        np.testing.assert_allclose(solvers.callSolver(blocked)["u"],
+                                   constrained.vardict["u"], atol=1e-6)
+        
+        # Collocation error should use the right u on each interval.
+        args = dict(self.args, N=dict(self.args["N"], c=3))
+        collocated = tools.nmpc(f=self.fcont, Delta=0.5, blocks=blocks,
+                                **args)
+        collocated.solve()
+        self.assertLess(np.max(collocated.collocerror()), 1e-4)
+
+    def test_shooting(self):
+        # Eliminating states should give the multiple-shooting solution.
+        lb = dict(self.args["lb"], x=np.array([-0.3, -np.inf]))
+        args = dict(self.args, lb=lb)
+        multiple = solvers.callSolver(tools.nmpc(f=self.f, **args))
+        for shooting in ["single", 3]:
+            controller = tools.nmpc(f=self.f, shooting=shooting, **args)
+            sol = solvers.callSolver(controller)
+            self.assertEqual(sol["status"], "Solve_Succeeded")
+            np.testing.assert_allclose(sol["x"], multiple["x"], atol=1e-5)
+            np.testing.assert_allclose(sol["u"], multiple["u"], atol=1e-5)
+            controller.saveguess()
+            np.testing.assert_allclose(np.squeeze(controller.guess["x",0]),
+                                       sol["x"][1])
+
+    def test_presolve(self):
+        # Should match the full problem, including multipliers.
+        sols = []
+        for presolve in [False, True]:
+            controller = tools.nmpc(f=self.f, **self.args)
+            (x, u) = (controller.varsym["x"], controller.varsym["u"])
+            controller.addconstraints([u[2] - u[3], u[2] - u[3], x[0][0]],
+                                      lb=[-0.1, -0.05, -1], ub=[0.1, 0.2, 1])
+            controller.fixvar("u", 5, 0.3)
+            controller.presolve = presolve
+            controller.solve()
+            sols.append(controller.sol)
+        self.assertEqual(controller.stats["presolve"],
+                         dict(fixed=3, dropped=1, duplicate=1))
+        for k in ["x", "g", "lam_x", "lam_g"]:
+            np.testing.assert_allclose(sols[1][k], sols[0][k], atol=1e-6)
+        
+        # Changing which variables are fixed needs a new problem.
+        controller.lb["u",6] = controller.ub["u",6] = 0.2
+        controller.fixvar("x", 0, [2, 1])
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            controller.solve()
+        self.assertEqual(controller.stats["presolve"]["fixed"], 4)
+        self.assertEqual(len(w), 1)
+        self.assertAlmostEqual(float(controller.var["u",6]), 0.2)
+
+    def test_scaling(self):
+        # Scaled problems should have the same solution in original units.
+        sol = self.nmpc.vardict
+        for (scaling, presolve) in [(True, False), ({"u" : 100}, True)]:
+            controller = tools.nmpc(f=self.f, scaling=scaling, **self.args)
+            controller.presolve = presolve
+            controller.solve()
+            self.assertEqual(controller.stats["status"], "Solve_Succeeded")
+            for k in ["x", "u"]:
+                np.testing.assert_allclose(controller.vardict[k], sol[k],
+                                           atol=1e-6)
+
+    def test_gaussnewton(self):
+        # Least-squares form of l should give the same solution.
+        r = tools.getCasadiFunc(lambda x, u: np.concatenate([x, u]), [2, 1],
+                                ["x", "u"], "r")
+        args = dict(self.args, l=(r, np.eye(3)))
+        controller = tools.nmpc(f=self.f, **args)
+        self.assertEqual(controller.hessian, "gauss-newton")
+        for hessian in ["gauss-newton", "exact"]:
+            controller.hessian = hessian
+            controller.solve()
+            self.assertAlmostEqual(controller.obj, self.nmpc.obj)
+            np.testing.assert_allclose(controller.vardict["u"],
+                                       self.nmpc.vardict["u"], atol=1e-6)
+        with self.assertRaises(ValueError):
+            self.nmpc.hessian = "gauss-newton"
+
+    def test_structure(self):
+        # Linear model should be detected as a QP and match ipopt.
+        A = np.array([[1, 0.5], [0, 1]])
+        B = np.array([[0.125], [0.5]])
+        F = tools.getCasadiFunc(lambda x, u: util.mtimes(A, x)
+                                + util.mtimes(B, u), [2, 1], ["x", "u"], "F")
+        qp = tools.nmpc(f=F, solver="auto", **self.args)
+        self.assertTrue(qp.structure["QP"])
+        if "qpoases" in util.listAvailableSolvers()["QP"]:
+            self.assertEqual(qp.solver, "qpoases")
+        qp.solve()
+        self.assertTrue(qp.stats["success"])
+        nlp = tools.nmpc(f=F, **self.args)
+        self.assertEqual(nlp.solver, "ipopt")
+        nlp.solve()
+        self.assertTrue(nlp.structure["QP"])
+        self.assertEqual(nlp.stats["status"], "Solve_Succeeded")
+        np.testing.assert_allclose(qp.vardict["u"], nlp.vardict["u"],
+                                   atol=1e-6)
+        
+        # Nonlinear model should only get the flags that apply.
+        self.assertEqual(self.nmpc.solver, "ipopt")
+        self.assertFalse(self.nmpc.structure["QP"])
+        self.assertTrue(self.nmpc.structure["quadratic"])
+        self.assertTrue(self.nmpc.structure["linearinequality"])
+        self.assertFalse(self.nmpc.structure["linearequality"])
+        nonlinear = tools.nmpc(f=self.f, solver="auto", **self.args)
+        self.assertEqual(nonlinear.solver, "ipopt")
+        
+        # isQP=False should not check anything.
+        unchecked = tools.nmpc(f=F, isQP=False, **self.args)
+        self.assertIsNone(unchecked.structure)
+
+    def test_constants(self):
+        # Changing a lifted constant should match rebuilding the model.
+        def build(k, constants=None):
+            def ode(x, u):
+                return np.array([(k - x[1]*x[1])*x[0] - x[1] + u[0], x[0]])
+            F = tools.getCasadiFunc(ode, [2, 1], ["x", "u"], "F", rk4=True,
+                                    Delta=0.5, constants=constants)
+            return tools.nmpc(f=F, **self.args)
+        lifted = build(1, ["k"])
+        self.assertEqual(list(lifted.par.keys()), ["k"])
+        lifted.solve()
+        np.testing.assert_allclose(lifted.vardict["u"],
+                                   self.nmpc.vardict["u"], atol=1e-8)
+        lifted.par["k",0] = 0.5
+        lifted.solve()
+        rebuilt = build(0.5)
+        rebuilt.solve()
+        np.testing.assert_allclose(lifted.vardict["u"],
+                                   rebuilt.vardict["u"], atol=1e-6)
+
+    def test_horizon(self):
+        # Shorter active horizons should match rebuilding with N["t"].
+        Pf = tools.getCasadiFunc(lambda x: 10*util.mtimes(x.T, x), [2], ["x"],
+                                 "Pf")
+        args = dict(self.args, Pf=Pf)
+        controller = tools.nmpc(f=self.f, horizon=10, **args)
+        for horizon in [7, 4]:
+            controller.par["horizon",0] = horizon
+            controller.solve()
+            args["N"] = dict(self.args["N"], t=horizon)
+            rebuilt = tools.nmpc(f=self.f, **args)
+            rebuilt.solve()
+            self.assertAlmostEqual(controller.obj, rebuilt.obj)
+            u = np.squeeze(controller.vardict["u"])
+            np.testing.assert_allclose(u[:horizon],
+                                       np.squeeze(rebuilt.vardict["u"]),
+                                       atol=1e-6)
+        
+        # Guess after the active horizon should be padded.
+        controller.saveguess()
+        uguess = np.squeeze(controller.guess["u"])
+        np.testing.assert_allclose(uguess[:3], u[1:4])
+        np.testing.assert_allclose(uguess[3:], u[3])
+        
+        # Unreachable bounds after the active horizon should be ignored.
+        lbx = np.tile([-np.inf, -np.inf], (11, 1))
+        lbx[8:,0] = 10
+        args = dict(self.args, Pf=Pf, lb=dict(self.args["lb"], x=lbx))
+        for shooting in ["multiple", "single"]:
+            controller = tools.nmpc(f=self.f, horizon=4, shooting=shooting,
+                                    **args)
+            controller.solve()
+            self.assertEqual(controller.stats["status"], "Solve_Succeeded")
+            np.testing.assert_allclose(np.squeeze(controller.vardict["u"])[:4],
+                                       np.squeeze(rebuilt.vardict["u"]),
+                                       atol=1e-6)
+        
+        # Horizon must be between 1 and N["t"].
+        for horizon in [0, 11, 2.5]:
+            controller.par["horizon",0] = horizon
+            with self.assertRaises(ValueError):
+                controller.solve()
+
+    def test_eliminatez(self):
+        # Eliminating z should match the full-space DAE formulation.
+        def ode(x, u, z):
+            return np.array([z[0] - x[1] + u[0], x[0]])
+        f = tools.getCasadiFunc(ode, [2, 1, 1], ["x", "u", "z"], "f")
+        g = tools.getCasadiFunc(lambda x, z: z - (1 - x[1]*x[1])*x[0],
+                                [2, 1], ["x", "z"], "g")
+        args = dict(self.args, f=f, g=g, Delta=0.5,
+                    N=dict(self.args["N"], z=1, c=2))
+        full = tools.nmpc(**args)
+        full.solve()
+        eliminated = tools.nmpc(eliminatez=True, **args)
+        eliminated.solve()
+        self.assertNotIn("z", eliminated.var.keys())
+        self.assertAlmostEqual(eliminated.obj, full.obj)
+        np.testing.assert_allclose(eliminated.vardict["u"],
+                                   full.vardict["u"], atol=1e-6)
+
+    def test_lmpc(self):
+        # Matrix formulation should match nmpc with the linearized model.
+        ss = util.getLinearizedModel(self.f, [np.zeros(2), np.zeros(1)],
+                                     ["A", "B"])
+        f = tools.getLinearFunc([ss["A"], ss["B"]], ["x", "u"], "f")
+        xsp = np.array([0.5, 0])
+        def lfunc(x, u):
+            return util.mtimes((x - xsp).T, x - xsp) + util.mtimes(u.T, u)
+        l = tools.getCasadiFunc(lfunc, [2, 1], ["x", "u"], "l")
+        linear = tools.nmpc(f=f, **dict(self.args, l=l))
+        linear.solve()
+        controller = tools.lmpc(ss["A"], ss["B"], np.eye(2), np.eye(1),
+                                self.args["N"], x0=self.args["x0"],
+                                lb=self.args["lb"], ub=self.args["ub"],
+                                sp={"x" : xsp}, verbosity=-1)
+        sol = solvers.callSolver(controller)
+        self.assertTrue(controller.stats["success"])
+        self.assertAlmostEqual(sol["obj"], linear.obj, places=6)
+        np.testing.assert_allclose(sol["u"], linear.vardict["u"], atol=1e-6)
+        self.assertEqual(sol["t"].shape, (11,))
+        
+        # Updating the setpoint and x0 should match a new nmpc.
+        x0 = np.array([1, 0])
+        check = tools.nmpc(f=f, **dict(self.args, x0=x0))
+        check.solve()
+        controller.par["x_sp"] = np.zeros(2)
+        controller.fixvar("x", 0, x0)
+        controller.saveguess()
+        controller.solve()
+        self.assertAlmostEqual(controller.obj, check.obj, places=6)
+        np.testing.assert_allclose(controller.vardict["u"],
+                                   check.vardict["u"], atol=1e-6)
+
 if __name__ == "__main__":
     unittest.main()
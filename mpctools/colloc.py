@@ -18,26 +18,102 @@ numerically unstable for high-order polynomials.
   March 2015
 """
 
-def weights(n,include0=True,include1=True):
+# Jacobi parameters (alpha, beta) for each family of interior nodes.
+FAMILIES = {
+    "legendre" : (0, 0),
+    "radau" : (1, 0),
+}
+
+# Cache of weights computed so far, keyed on (n, include0, include1, family).
+_WEIGHTS = {}
+
+def weights(n,include0=True,include1=True,family="legendre"):
     """
     Returns collocation weights for order n.
     
     Two optional arguments decide whether to include left or right endpoints.
     
+    family chooses the n interior nodes. "legendre" gives the roots of the
+    shifted Legendre polynomial (Gauss points), while "radau" gives the
+    interior nodes of right-sided Radau quadrature, i.e., the Radau IIA nodes
+    when include1=True.
+    
     Returns [r,A,B,q] with r the roots (on the interval [0,1]), A the first
     derivative weights, B the second derivative weights, and q the quadrature
     weights. r and q are numpy rank-1 arrays, while A and B are numpy rank-2
     arrays.
+    
+    Results are cached, so repeated calls are free. The returned arrays are
+    read-only views of the cached values.
     """
+    key = (n, bool(include0), bool(include1), family)
+    if key not in _WEIGHTS:
+        if family not in FAMILIES:
+            raise ValueError("Unknown family '%s'!" % (family,))
+        [alpha, beta] = FAMILIES[family]
+        [d1,d2,d3,r] = jacobi(n,alpha,beta,include0,include1)
+        A = dfopr(n,d1,d2,d3,r,"first")
+        B = dfopr(n,d1,d2,d3,r,"second")
+        if family == "legendre":
+            q = dfopr(n,d1,d2,d3,r,"weights")
+        else:
+            q = quadrature(r)
+        vals = [r,A,B,q]
+        for v in vals:
+            v.flags.writeable = False
+        _WEIGHTS[key] = vals
+    return [v.view() for v in _WEIGHTS[key]]
+
+def tabulate(nmax,families=("legendre","radau")):
+    """
+    Precomputes weights for orders 1 through nmax.
     
-    alpha = 0
-    beta = 0
-    [d1,d2,d3,r] = jacobi(n,alpha,beta,include0,include1)
-    A = dfopr(n,d1,d2,d3,r,"first")
-    B = dfopr(n,d1,d2,d3,r,"second")
-    q = dfopr(n,d1,d2,d3,r,"weights")
+    All combinations of endpoints are computed for each of the given
+    families, so that later calls to weights are simply lookups.
+    """
+    for family in families:
+        for n in range(1, nmax + 1):
+            for include0 in [True, False]:
+                for include1 in [True, False]:
+                    weights(n, include0, include1, family)
+
+def quadrature(r):
+    """
+    Returns interpolatory quadrature weights on [0,1] for nodes r.
     
-    return [r,A,B,q]
+    Weights are found by integrating the Lagrange basis polynomials for r
+    with Gauss-Legendre quadrature, which is exact for their degree. This
+    avoids the ill-conditioned Vandermonde system for monomials.
+    """
+    r = np.asarray(r, dtype=float).flatten()
+    N = r.size
+    for m in [N, N + 1]:
+        [s, _, _, w] = weights(m, include0=False, include1=False)
+        if np.min(np.abs(s[:,np.newaxis] - r[np.newaxis,:])) > 1e-8:
+            break # Gauss points with odd m or m + 1 can't both include r.
+    [L, _] = basis(r, s)
+    return w.dot(L)
+
+def basis(r,s):
+    """
+    Evaluates the Lagrange basis polynomials for nodes r at points s.
+    
+    Returns [L, D] with L[i,j] the value and D[i,j] the derivative of the jth
+    basis polynomial at s[i]. Points s must not coincide with any nodes.
+    """
+    r = np.asarray(r, dtype=float).flatten()
+    s = np.asarray(s, dtype=float).flatten()
+    [ri, rj] = ijify(r)
+    y = ri - rj
+    np.fill_diagonal(y, 1)
+    w = 1/np.prod(y, axis=1)
+    
+    # Use l_j(s) = w_j*prod_m (s - r_m)/(s - r_j) and the fact that the log
+    # derivative of l_j is the sum of 1/(s - r_m) for m != j.
+    diff = s[:,np.newaxis] - r[np.newaxis,:]
+    L = w*np.prod(diff, axis=1)[:,np.newaxis]/diff
+    D = L*(np.sum(1/diff, axis=1)[:,np.newaxis] - 1/diff)
+    return [L, D]
 
 def jacobi(n,alpha,beta,include0=True,include1=True):
     """
@@ -45,7 +121,8 @@ def jacobi(n,alpha,beta,include0=True,include1=True):
     
     [d1, d2, d3, r] = jacobi(n, alpha, beta, include0, include1)
     
-    d1, d2, and d3 are derivatives at the roots which are given in r.
+    d1, d2, and d3 are derivatives at the roots which are given in r. All
+    are numpy rank-1 arrays.
     """
     # Suppress some SciPy warnings that may occur.
     oldNpInvalidSetting = np.seterr(invalid="ignore")["invalid"]    
@@ -64,26 +141,25 @@ def jacobi(n,alpha,beta,include0=True,include1=True):
     if include1:
         r = r + [1]
         
-    # Now calculate derivatives.    
-    N = len(r) # Total number of points.
-    d1 = [1]*N
-    d2 = [0]*N
-    d3 = [0]*N
-    
-    # Use recursive formulas. Could probably be vectorized for speed.
-    for i in range(N):
-        x = r[i]
-        for j in range(N):
-            if j != i:
-                y = x - r[j]
-                d3[i] = y*d3[i] + 3*d2[i]
-                d2[i] = y*d2[i] + 2*d1[i]
-                d1[i] = y*d1[i]
+    r = np.array(r, dtype=float)
+    
+    # Derivatives of the node polynomial prod_j (x - r_j) at each root. With
+    # y_ij = r_i - r_j for j != i, d1 is the product of y_ij, and the others
+    # follow from sums of 1/y_ij.
+    [ri, rj] = ijify(r)
+    y = ri - rj
+    np.fill_diagonal(y, 1)
+    d1 = np.prod(y, axis=1)
+    np.fill_diagonal(y, np.inf)
+    s1 = np.sum(1/y, axis=1)
+    s2 = np.sum(1/y**2, axis=1)
+    d2 = 2*d1*s1
+    d3 = 3*d1*(s1**2 - s2)
     
     # Change back the settings.
     np.seterr(invalid=oldNpInvalidSetting)
     
-    return [d1, d2, d3, np.array(r)]
+    return [d1, d2, d3, r]
         
 def dfopr(n,d1,d2,d3,r,mode="weights"):
     """    
@@ -92,7 +168,8 @@ def dfopr(n,d1,d2,d3,r,mode="weights"):
     n is the order of the polynomail.
     
     d1, d2, d3, and r are the first through third derivatives at the roots r
-    These are the outputs, e.g., of jacobi, and they should be lists.
+    These are the outputs, e.g., of jacobi, and they should be rank-1 arrays
+    or lists.
     
     mode must be one of "weights", "first", or "second".
     """
@@ -0,0 +1,896 @@
+import numpy as np
+import scipy.linalg
+import casadi
+from . import util
+
+"""
+Stateful state estimators for use in closed-loop simulations.
+
+Unlike util.ekf, these objects build all of the Casadi Functions they need
+once at construction and keep their estimates in preallocated arrays, so each
+call only does the numerical work for the current sample.
+"""
+
+class EKF(object):
+    """
+    Extended Kalman filter with cached model derivatives.
+
+    The model is x^+ = f(x,u,w) and y = h(x) + v, where f and h are Casadi
+    Functions (e.g., from getCasadiFunc), and f must be discrete-time. Q and R
+    are the covariances of w and v.
+
+    At construction, f and its Jacobians with respect to x and w are fused into
+    a single Casadi Function, as are h and its Jacobian with respect to x.
+    Thus, each call to step() makes only two calls into Casadi, and the
+    covariance updates are done in place with NumPy and LAPACK.
+
+    The current estimate is stored in four properties that follow the
+    notation of util.ekf:
+
+        xhatm = xhat(k | k-1)       Pm = P(k | k-1)
+        xhat  = xhat(k | k)         P  = P(k | k)
+
+    Note that these are the internal arrays themselves, so they will change
+    after every call to correct(), predict(), or step().
+    """
+    @property
+    def xhatm(self):
+        return self.__xhatm
+
+    @property
+    def Pm(self):
+        return self.__Pm
+
+    @property
+    def xhat(self):
+        return self.__xhat
+
+    @property
+    def P(self):
+        return self.__P
+
+    @property
+    def Nx(self):
+        return self.__Nx
+
+    @property
+    def Ny(self):
+        return self.__Ny
+
+    def __init__(self, f, h, x0, P0, Q, R):
+        """
+        Initialize the filter with models and the prior (x0, P0).
+
+        x0 and P0 should be xhat(0 | -1) and P(0 | -1), i.e., the estimate
+        before the first measurement is received.
+        """
+        # Build fused functions.
+        self.__ffunc = util.fusedjacobianfunc(f, [0, 2], name="ekf_f")
+        self.__hfunc = util.fusedjacobianfunc(h, [0], name="ekf_h")
+
+        # Get sizes and check everything.
+        Nx = f.size1_in(0)
+        Nu = f.size1_in(1)
+        Nw = f.size1_in(2)
+        Ny = h.size1_out(0)
+        self.__Nx = Nx
+        self.__Ny = Ny
+        self.__Q = util.array(Q)
+        self.__R = util.array(R)
+        for (m, s, name) in [(self.__Q, (Nw, Nw), "Q"),
+                             (self.__R, (Ny, Ny), "R")]:
+            if m.shape != s:
+                raise ValueError("%s must have shape %r!" % (name, s))
+
+        # Preallocate storage for estimates and intermediate products.
+        self.__xhatm = np.zeros((Nx,))
+        self.__Pm = np.zeros((Nx, Nx))
+        self.__xhat = np.zeros((Nx,))
+        self.__P = np.zeros((Nx, Nx))
+        self.__w = np.zeros((Nw,))
+        self.__u = np.zeros((Nu,))
+        self.__dx = np.zeros((Nx,))
+        self.__CP = np.zeros((Ny, Nx))
+        self.__S = np.zeros((Ny, Ny))
+        self.__AP = np.zeros((Nx, Nx))
+        self.__GQ = np.zeros((Nx, Nw))
+        self.__NxNx = np.zeros((Nx, Nx))
+        self.reset(x0, P0)
+
+    def reset(self, x0, P0):
+        """Resets the prior to xhat(k | k-1) = x0 and P(k | k-1) = P0."""
+        self.__xhatm[:] = np.asarray(x0, dtype=float).flatten()
+        self.__Pm[...] = P0
+        self.__xhat[:] = self.__xhatm
+        self.__P[...] = self.__Pm
+
+    def correct(self, y):
+        """
+        Updates xhat(k | k) and P(k | k) using measurement y(k).
+        """
+        [yhat, C] = [np.array(a) for a in self.__hfunc(self.__xhatm)]
+        CP = self.__CP
+        S = self.__S
+        np.dot(C, self.__Pm, out=CP)
+        np.dot(CP, C.T, out=S)
+        S += self.__R
+        Sfactor = scipy.linalg.cho_factor(S, overwrite_a=True,
+                                          check_finite=False)
+        LT = scipy.linalg.cho_solve(Sfactor, CP, check_finite=False)
+        innov = np.asarray(y, dtype=float).flatten() - yhat.flatten()
+        np.dot(innov, LT, out=self.__dx)
+        np.add(self.__xhatm, self.__dx, out=self.__xhat)
+        np.dot(LT.T, CP, out=self.__NxNx)
+        np.subtract(self.__Pm, self.__NxNx, out=self.__P)
+
+    def predict(self, u=None):
+        """
+        Advances to xhat(k+1 | k) and P(k+1 | k) using input u(k).
+
+        If u is None, the previous value of u is used.
+        """
+        if u is not None:
+            self.__u[:] = np.asarray(u, dtype=float).flatten()
+        [xnext, A, G] = [np.array(a) for a
+                         in self.__ffunc(self.__xhat, self.__u, self.__w)]
+        np.dot(A, self.__P, out=self.__AP)
+        np.dot(self.__AP, A.T, out=self.__Pm)
+        np.dot(G, self.__Q, out=self.__GQ)
+        np.dot(self.__GQ, G.T, out=self.__NxNx)
+        self.__Pm += self.__NxNx
+        self.__xhatm[:] = xnext.flatten()
+
+    def step(self, y, u=None):
+        """
+        Does one correction and one prediction step.
+
+        The return value matches util.ekf, i.e., copies of
+
+            [P(k+1 | k), xhat(k+1 | k), P(k | k), xhat(k | k)]
+        """
+        self.correct(y)
+        self.predict(u)
+        return [self.__Pm.copy(), self.__xhatm.copy(), self.__P.copy(),
+                self.__xhat.copy()]
+
+
+class EKFBank(object):
+    """
+    Bank of extended Kalman filters for K identical units.
+
+    Each unit has model x^+ = f(x,u,w) and y = h(x) + v as in EKF, and all
+    units share the same noise covariances Q and R. Estimates are stored as
+    stacks, i.e., xhatm and xhat have shape (K, Nx), while Pm and P have shape
+    (K, Nx, Nx). Inputs and measurements should similarly be passed with
+    shapes (K, Nu) and (K, Ny).
+
+    Models and Jacobians for every unit are evaluated with a single call to
+    a mapped Casadi Function, and the Kalman updates use NumPy's batched
+    linear algebra. The arithmetic follows util.ekf, so results agree with
+    calling util.ekf separately for each unit.
+
+    parallelization and maxthreads are passed to util.mapfunc, e.g., set
+    parallelization="thread" to evaluate the models in parallel.
+    """
+    @property
+    def xhatm(self):
+        return self.__xhatm
+
+    @property
+    def Pm(self):
+        return self.__Pm
+
+    @property
+    def xhat(self):
+        return self.__xhat
+
+    @property
+    def P(self):
+        return self.__P
+
+    @property
+    def K(self):
+        return self.__K
+
+    def __init__(self, f, h, x0, P0, Q, R, K=None, parallelization="serial",
+                 maxthreads=None):
+        """
+        Initialize the bank with models and stacked priors (x0, P0).
+
+        x0 can have shape (K, Nx) or (Nx,), and P0 can have shape (K, Nx, Nx)
+        or (Nx, Nx). In the latter cases, all units are given the same prior,
+        and K must be given explicitly.
+        """
+        x0 = util.array(x0)
+        if K is None:
+            if x0.ndim != 2:
+                raise ValueError("Must specify K if x0 is not stacked!")
+            K = x0.shape[0]
+        self.__K = K
+
+        # Build mapped functions.
+        ffunc = util.fusedjacobianfunc(f, [0, 2], name="ekfbank_f")
+        hfunc = util.fusedjacobianfunc(h, [0], name="ekfbank_h")
+        self.__ffunc = util.mapfunc(ffunc, K, parallelization, maxthreads)
+        self.__hfunc = util.mapfunc(hfunc, K, parallelization, maxthreads)
+
+        # Get sizes and check everything.
+        Nx = f.size1_in(0)
+        Nu = f.size1_in(1)
+        Nw = f.size1_in(2)
+        Ny = h.size1_out(0)
+        (self.__Nx, self.__Nu, self.__Nw, self.__Ny) = (Nx, Nu, Nw, Ny)
+        self.__Q = util.array(Q)
+        self.__R = util.array(R)
+        for (m, s, name) in [(self.__Q, (Nw, Nw), "Q"),
+                             (self.__R, (Ny, Ny), "R")]:
+            if m.shape != s:
+                raise ValueError("%s must have shape %r!" % (name, s))
+
+        # Preallocate storage.
+        self.__xhatm = np.zeros((K, Nx))
+        self.__Pm = np.zeros((K, Nx, Nx))
+        self.__xhat = np.zeros((K, Nx))
+        self.__P = np.zeros((K, Nx, Nx))
+        self.__u = np.zeros((K, Nu))
+        self.__w = np.zeros((Nw, K))
+        self.__CP = np.zeros((K, Ny, Nx))
+        self.__S = np.zeros((K, Ny, Ny))
+        self.__ImLC = np.zeros((K, Nx, Nx))
+        self.__AP = np.zeros((K, Nx, Nx))
+        self.__GQ = np.zeros((K, Nx, Nw))
+        self.__NxNx = np.zeros((K, Nx, Nx))
+        self.__eye = np.eye(Nx)
+        self.reset(x0, P0)
+
+    def reset(self, x0, P0):
+        """Resets the priors for all units."""
+        self.__xhatm[...] = x0
+        self.__Pm[...] = P0
+        self.__xhat[...] = self.__xhatm
+        self.__P[...] = self.__Pm
+
+    def __unstack(self, M, ncols):
+        """Converts a horizontal stack of K matrices to shape (K, m, ncols)."""
+        M = np.array(M)
+        return M.reshape((M.shape[0], self.__K, ncols)).transpose((1, 0, 2))
+
+    def correct(self, y):
+        """Updates xhat(k | k) and P(k | k) using stacked measurements y."""
+        [yhat, C] = self.__hfunc(self.__xhatm.T)
+        yhat = np.array(yhat).T
+        C = self.__unstack(C, self.__Nx)
+        CT = C.transpose((0, 2, 1))
+        np.matmul(C, self.__Pm, out=self.__CP)
+        np.matmul(self.__CP, CT, out=self.__S)
+        self.__S += self.__R
+        L = np.linalg.solve(self.__S, self.__CP).transpose((0, 2, 1))
+        innov = np.reshape(y, yhat.shape) - yhat
+        np.add(self.__xhatm, np.matmul(L, innov[..., np.newaxis])[..., 0],
+               out=self.__xhat)
+        np.matmul(L, C, out=self.__ImLC)
+        np.subtract(self.__eye, self.__ImLC, out=self.__ImLC)
+        np.matmul(self.__ImLC, self.__Pm, out=self.__P)
+
+    def predict(self, u=None):
+        """
+        Advances all units to xhat(k+1 | k) and P(k+1 | k).
+
+        If u is None, the previous value of u is used.
+        """
+        if u is not None:
+            self.__u[...] = np.reshape(u, self.__u.shape)
+        [xnext, A, G] = self.__ffunc(self.__xhat.T, self.__u.T, self.__w)
+        A = self.__unstack(A, self.__Nx)
+        G = self.__unstack(G, self.__Nw)
+        np.matmul(A, self.__P, out=self.__AP)
+        np.matmul(self.__AP, A.transpose((0, 2, 1)), out=self.__Pm)
+        np.matmul(G, self.__Q, out=self.__GQ)
+        np.matmul(self.__GQ, G.transpose((0, 2, 1)), out=self.__NxNx)
+        self.__Pm += self.__NxNx
+        self.__xhatm[...] = np.array(xnext).T
+
+    def step(self, y, u=None):
+        """
+        Does one correction and one prediction step for every unit.
+
+        Returns copies of the stacked [P(k+1 | k), xhat(k+1 | k), P(k | k),
+        xhat(k | k)] as in util.ekf.
+        """
+        self.correct(y)
+        self.predict(u)
+        return [self.__Pm.copy(), self.__xhatm.copy(), self.__P.copy(),
+                self.__xhat.copy()]
+
+
+class KalmanFilterBank(object):
+    """
+    Bank of steady-state Kalman filters for K identical linear units.
+
+    The model is x^+ = Ax + Bu and y = Cx, and the filter gain L can be
+    obtained from util.dlqe. Estimates are stored with shape (K, Nx) in
+    xhatm = xhat(k | k-1) and xhat = xhat(k | k).
+    """
+    @property
+    def xhatm(self):
+        return self.__xhatm
+
+    @property
+    def xhat(self):
+        return self.__xhat
+
+    def __init__(self, A, B, C, L, x0, K=None):
+        """Initialize with system matrices, gain, and stacked prior x0."""
+        x0 = util.array(x0)
+        if K is None:
+            if x0.ndim != 2:
+                raise ValueError("Must specify K if x0 is not stacked!")
+            K = x0.shape[0]
+        self.__AT = util.array(A).T.copy()
+        self.__BT = util.array(B).T.copy()
+        self.__CT = util.array(C).T.copy()
+        self.__LT = util.array(L).T.copy()
+        Nx = self.__AT.shape[0]
+        self.__xhatm = np.zeros((K, Nx))
+        self.__xhat = np.zeros((K, Nx))
+        self.__innov = np.zeros((K, self.__CT.shape[1]))
+        self.__Bu = np.zeros((K, Nx))
+        self.__xhatm[...] = x0
+
+    def correct(self, y):
+        """Updates xhat(k | k) using stacked measurements y."""
+        np.dot(self.__xhatm, self.__CT, out=self.__innov)
+        np.subtract(y, self.__innov, out=self.__innov)
+        np.dot(self.__innov, self.__LT, out=self.__xhat)
+        self.__xhat += self.__xhatm
+
+    def predict(self, u):
+        """Advances all units to xhat(k+1 | k) using stacked inputs u."""
+        np.dot(self.__xhat, self.__AT, out=self.__xhatm)
+        np.dot(u, self.__BT, out=self.__Bu)
+        self.__xhatm += self.__Bu
+
+    def step(self, y, u):
+        """Does one correction and prediction and returns copies of both."""
+        self.correct(y)
+        self.predict(u)
+        return [self.__xhatm.copy(), self.__xhat.copy()]
+
+
+class UKF(object):
+    """
+    Unscented Kalman filter with mapped sigma-point propagation.
+
+    The model is x^+ = f(x,u,w) and y = h(x) + v as in EKF. Because w enters
+    f nonlinearly, the prediction step uses sigma points for the augmented
+    state (x, w) with covariance blkdiag(P, Q).
+
+    All 2n + 1 sigma points are passed through the model in a single call
+    to a mapped Casadi Function, and the unscented transform (means,
+    covariances, and cross-covariances) is done with NumPy in preallocated
+    buffers.
+
+    alpha, beta, and kappa are the usual scaling parameters for the sigma
+    points. The defaults (alpha=1, beta=2, kappa=0) give nonnegative weights,
+    which keeps the covariances positive semidefinite.
+
+    Estimates are stored as in EKF, i.e., in the properties xhatm, Pm, xhat,
+    and P.
+    """
+    @property
+    def xhatm(self):
+        return self.__xhatm
+
+    @property
+    def Pm(self):
+        return self.__Pm
+
+    @property
+    def xhat(self):
+        return self.__xhat
+
+    @property
+    def P(self):
+        return self.__P
+
+    def __init__(self, f, h, x0, P0, Q, R, alpha=1, beta=2, kappa=0,
+                 parallelization="serial", maxthreads=None):
+        """Initialize the filter with models and the prior (x0, P0)."""
+        # Get sizes and check everything.
+        Nx = f.size1_in(0)
+        Nu = f.size1_in(1)
+        Nw = f.size1_in(2)
+        Ny = h.size1_out(0)
+        self.__Nx = Nx
+        self.__Q = util.array(Q)
+        self.__R = util.array(R)
+        for (m, s, name) in [(self.__Q, (Nw, Nw), "Q"),
+                             (self.__R, (Ny, Ny), "R")]:
+            if m.shape != s:
+                raise ValueError("%s must have shape %r!" % (name, s))
+
+        # Sigma-point weights and mapped functions for both steps.
+        sigmaargs = dict(alpha=alpha, beta=beta, kappa=kappa,
+                         parallelization=parallelization,
+                         maxthreads=maxthreads)
+        self.__hsigma = self.__sigmasetup(h, Nx, **sigmaargs)
+        self.__fsigma = self.__sigmasetup(f, Nx + Nw, **sigmaargs)
+
+        # Preallocate storage.
+        self.__xhatm = np.zeros((Nx,))
+        self.__Pm = np.zeros((Nx, Nx))
+        self.__xhat = np.zeros((Nx,))
+        self.__P = np.zeros((Nx, Nx))
+        self.__u = np.zeros((Nu,))
+        self.__Paug = np.zeros((Nx + Nw, Nx + Nw))
+        self.__Paug[Nx:,Nx:] = self.__Q
+        self.__xaug = np.zeros((Nx + Nw,))
+        self.__yhat = np.zeros((Ny,))
+        self.__dX = np.zeros((Nx, 2*(Nx + Nw) + 1))
+        self.__dXW = self.__dX.copy()
+        self.__dY = np.zeros((Ny, 2*Nx + 1))
+        self.__dYW = self.__dY.copy()
+        self.__Pyy = np.zeros((Ny, Ny))
+        self.__Pxy = np.zeros((Nx, Ny))
+        self.__NxNy = np.zeros((Nx, Ny))
+        self.__NxNx = np.zeros((Nx, Nx))
+        self.reset(x0, P0)
+
+    def reset(self, x0, P0):
+        """Resets the prior to xhat(k | k-1) = x0 and P(k | k-1) = P0."""
+        self.__xhatm[:] = np.asarray(x0, dtype=float).flatten()
+        self.__Pm[...] = P0
+        self.__xhat[:] = self.__xhatm
+        self.__P[...] = self.__Pm
+
+    @staticmethod
+    def __sigmasetup(func, n, alpha, beta, kappa, parallelization,
+                     maxthreads):
+        """Returns weights, buffers, and mapped func for dimension n."""
+        lam = alpha**2*(n + kappa) - n
+        Wm = np.full((2*n + 1,), 0.5/(n + lam))
+        Wc = Wm.copy()
+        Wm[0] = lam/(n + lam)
+        Wc[0] = Wm[0] + 1 - alpha**2 + beta
+        mapped = util.mapfunc(func, 2*n + 1, parallelization, maxthreads)
+        return dict(func=mapped, Wm=Wm, Wc=Wc, scale=np.sqrt(n + lam),
+                    X=np.zeros((n, 2*n + 1)))
+
+    @staticmethod
+    def __sigmapoints(sigma, x, P):
+        """Fills sigma["X"] with sigma points for mean x and covariance P."""
+        n = x.size
+        X = sigma["X"]
+        S = util.psdsqrt(P)
+        S *= sigma["scale"]
+        X[:,0] = x
+        np.add(x[:,np.newaxis], S, out=X[:,1:n + 1])
+        np.subtract(x[:,np.newaxis], S, out=X[:,n + 1:])
+        return X
+
+    def correct(self, y):
+        """Updates xhat(k | k) and P(k | k) using measurement y(k)."""
+        Nx = self.__Nx
+        sigma = self.__hsigma
+        X = self.__sigmapoints(sigma, self.__xhatm, self.__Pm)
+        Y = np.array(sigma["func"](X))
+        (Wm, Wc) = (sigma["Wm"], sigma["Wc"])
+
+        # Unscented transform.
+        np.dot(Y, Wm, out=self.__yhat)
+        dY = self.__dY
+        np.subtract(Y, self.__yhat[:,np.newaxis], out=dY)
+        dX = self.__dX[:,:2*Nx + 1]
+        dXW = self.__dXW[:,:2*Nx + 1]
+        np.subtract(X, self.__xhatm[:,np.newaxis], out=dX)
+        np.multiply(dX, Wc, out=dXW)
+        np.dot(dXW, dY.T, out=self.__Pxy)
+        np.multiply(dY, Wc, out=self.__dYW)
+        np.dot(self.__dYW, dY.T, out=self.__Pyy)
+        self.__Pyy += self.__R
+
+        # Kalman update.
+        Pyyfactor = scipy.linalg.cho_factor(self.__Pyy, check_finite=False)
+        LT = scipy.linalg.cho_solve(Pyyfactor, self.__Pxy.T,
+                                    check_finite=False)
+        innov = np.asarray(y, dtype=float).flatten() - self.__yhat
+        np.add(self.__xhatm, innov.dot(LT), out=self.__xhat)
+        np.dot(LT.T, self.__Pyy, out=self.__NxNy)
+        np.dot(self.__NxNy, LT, out=self.__NxNx)
+        np.subtract(self.__Pm, self.__NxNx, out=self.__P)
+
+    def predict(self, u=None):
+        """
+        Advances to xhat(k+1 | k) and P(k+1 | k) using input u(k).
+
+        If u is None, the previous value of u is used.
+        """
+        if u is not None:
+            self.__u[:] = np.asarray(u, dtype=float).flatten()
+        Nx = self.__Nx
+        sigma = self.__fsigma
+        self.__xaug[:Nx] = self.__xhat
+        self.__Paug[:Nx,:Nx] = self.__P
+        X = self.__sigmapoints(sigma, self.__xaug, self.__Paug)
+        Xnext = np.array(sigma["func"](X[:Nx,:], self.__u, X[Nx:,:]))
+
+        # Unscented transform.
+        np.dot(Xnext, sigma["Wm"], out=self.__xhatm)
+        np.subtract(Xnext, self.__xhatm[:,np.newaxis], out=self.__dX)
+        np.multiply(self.__dX, sigma["Wc"], out=self.__dXW)
+        np.dot(self.__dXW, self.__dX.T, out=self.__Pm)
+
+    def step(self, y, u=None):
+        """
+        Does one correction and one prediction step.
+
+        Returns copies of [P(k+1 | k), xhat(k+1 | k), P(k | k), xhat(k | k)]
+        as in util.ekf.
+        """
+        self.correct(y)
+        self.predict(u)
+        return [self.__Pm.copy(), self.__xhatm.copy(), self.__P.copy(),
+                self.__xhat.copy()]
+
+
+class ParticleFilter(object):
+    """
+    Bootstrap particle filter with mapped model evaluations.
+
+    f can be a Casadi Function (e.g., from getCasadiFunc) or a simulator
+    object (e.g., DiscreteSimulator). If f takes three arguments, the model is
+    x^+ = f(x,u,w); if it takes two, the noise is additive, i.e.,
+    x^+ = f(x,u) + w. The measurement model is y = h(x) + v. Both w and v are
+    Gaussian with covariances Q and R.
+
+    Each step propagates all particles through one call to f mapped over
+    Nparticles (see util.mapfunc for parallelization and maxthreads).
+    Weighting, effective sample size, and systematic resampling are
+    vectorized NumPy operations. Particles are resampled whenever the
+    effective sample size drops below resample*Nparticles.
+
+    Particles are stored with shape (Nparticles, Nx). The weighted mean after
+    the last correction is xhat = xhat(k | k), and the mean after the last
+    prediction is xhatm = xhat(k+1 | k).
+    """
+    @property
+    def particles(self):
+        return self.__particles
+
+    @property
+    def weights(self):
+        return self.__weights
+
+    @property
+    def ess(self):
+        return 1/np.sum(self.__weights**2)
+
+    @property
+    def xhat(self):
+        return self.__xhat
+
+    @property
+    def xhatm(self):
+        return self.__xhatm
+
+    def __init__(self, f, h, x0, P0, Q, R, Nparticles=1000, resample=0.5,
+                 parallelization="serial", maxthreads=None, seed=None):
+        """
+        Initialize the filter by sampling Nparticles from N(x0, P0).
+        """
+        if not isinstance(f, casadi.Function):
+            f = f.getCasadiFunc()
+        self.__ffunc = util.mapfunc(f, Nparticles, parallelization, maxthreads)
+        self.__hfunc = util.mapfunc(h, Nparticles, parallelization, maxthreads)
+        self.__additive = (f.n_in() == 2)
+
+        # Get sizes.
+        Nx = f.size1_in(0)
+        Nu = f.size1_in(1)
+        Nw = Nx if self.__additive else f.size1_in(2)
+        self.__Nparticles = Nparticles
+        self.__resample = resample
+        self.__rng = np.random.default_rng(seed)
+
+        # Factor covariances so that we can sample w and evaluate weights. Q
+        # may be singular, but R must be positive definite.
+        self.__Qsqrt = util.psdsqrt(util.array(Q))
+        self.__Rchol = scipy.linalg.cholesky(util.array(R), lower=True)
+        if self.__Qsqrt.shape != (Nw, Nw):
+            raise ValueError("Q must have shape %r!" % ((Nw, Nw),))
+
+        # Preallocate storage.
+        self.__particles = np.zeros((Nparticles, Nx))
+        self.__weights = np.zeros((Nparticles,))
+        self.__logweights = np.zeros((Nparticles,))
+        self.__w = np.zeros((Nparticles, Nw))
+        self.__u = np.zeros((Nu,))
+        self.__xhat = np.zeros((Nx,))
+        self.__xhatm = np.zeros((Nx,))
+        self.reset(x0, P0)
+
+    def reset(self, x0, P0):
+        """Resamples all particles from N(x0, P0) with equal weights."""
+        x0 = np.asarray(x0, dtype=float).flatten()
+        P0sqrt = util.psdsqrt(util.array(P0))
+        self.__rng.standard_normal(out=self.__particles)
+        self.__particles[...] = self.__particles.dot(P0sqrt.T) + x0
+        self.__logweights[:] = -np.log(self.__Nparticles)
+        self.__weights[:] = 1/self.__Nparticles
+        self.__xhatm[:] = x0
+        self.__xhat[:] = x0
+
+    def correct(self, y):
+        """
+        Reweights particles using measurement y(k) and resamples if needed.
+        """
+        yhat = np.array(self.__hfunc(self.__particles.T))
+        resid = np.asarray(y, dtype=float).reshape((-1, 1)) - yhat
+        z = scipy.linalg.solve_triangular(self.__Rchol, resid, lower=True,
+                                          check_finite=False)
+        self.__logweights -= 0.5*np.sum(z**2, axis=0)
+        self.__logweights -= np.max(self.__logweights)
+        np.exp(self.__logweights, out=self.__weights)
+        total = np.sum(self.__weights)
+        self.__weights /= total
+        self.__logweights -= np.log(total)
+        np.dot(self.__weights, self.__particles, out=self.__xhat)
+        if self.ess < self.__resample*self.__Nparticles:
+            self.resample()
+
+    def resample(self):
+        """Does systematic resampling and resets weights to be equal."""
+        N = self.__Nparticles
+        positions = (self.__rng.random() + np.arange(N))/N
+        cumweights = np.cumsum(self.__weights)
+        cumweights[-1] = 1 # Avoid roundoff problems.
+        i = np.searchsorted(cumweights, positions)
+        self.__particles[...] = self.__particles[i,:]
+        self.__logweights[:] = -np.log(N)
+        self.__weights[:] = 1/N
+
+    def predict(self, u=None):
+        """
+        Propagates all particles to time k + 1 using input u(k).
+
+        If u is None, the previous value of u is used.
+        """
+        if u is not None:
+            self.__u[:] = np.asarray(u, dtype=float).flatten()
+        self.__rng.standard_normal(out=self.__w)
+        w = self.__w.dot(self.__Qsqrt.T)
+        if self.__additive:
+            xnext = np.array(self.__ffunc(self.__particles.T, self.__u)).T
+            np.add(xnext, w, out=self.__particles)
+        else:
+            xnext = self.__ffunc(self.__particles.T, self.__u, w.T)
+            self.__particles[...] = np.array(xnext).T
+        np.dot(self.__weights, self.__particles, out=self.__xhatm)
+
+    def step(self, y, u=None):
+        """
+        Does one correction and one prediction step.
+
+        Returns copies of [xhat(k+1 | k), xhat(k | k)].
+        """
+        self.correct(y)
+        self.predict(u)
+        return [self.__xhatm.copy(), self.__xhat.copy()]
+
+
+class LinearMHE(object):
+    """
+    Moving horizon estimator for linear models with quadratic costs.
+
+    The model is x^+ = Ax + Bu + Gw and y = Cx + v, where w and v have
+    covariances Q and R (G defaults to the identity). The window holds the
+    last N + 1 measurements, and the MHE problem is
+
+        min |x(0) - x0bar|_P0^-1 + sum |w(t)|_Q^-1 + sum |v(t)|_R^-1
+
+    over the window, which is a banded least-squares QP (as in nmhe with
+    linear f and h and quadratic l and lx). Without constraints, its KKT
+    system is factored exactly by a forward Riccati (Kalman filter) pass and
+    solved by a backward (Rauch-Tung-Striebel) pass.
+
+    Each sample in the window stores its forward-pass quantities, so a new
+    measurement needs only one correction and one prediction step, and the
+    oldest sample is simply dropped. The arrival cost (x0bar, P0) is then
+    the filter prior for the oldest sample, i.e., the Riccati update of the
+    arrival cost. The smoother gains are also stored at each prediction, so
+    the backward pass in smooth() is only matrix-vector products. Once the
+    Riccati recursion converges (relative change below tol), the covariances
+    and gains are frozen, and each step is just a few matrix-vector products.
+    Set tol=None to always update them.
+
+    Estimates follow the notation of EKF, i.e., xhatm = xhat(k | k-1) and
+    xhat = xhat(k | k), where the latter is the MHE estimate of the final
+    state in the window. Inequality constraints are not supported; use nmhe
+    for constrained problems.
+    """
+    @property
+    def xhatm(self):
+        return self.__xhatm
+
+    @property
+    def Pm(self):
+        return self.__Pm
+
+    @property
+    def xhat(self):
+        return self.__xhat
+
+    @property
+    def P(self):
+        return self.__P
+
+    @property
+    def x0bar(self):
+        return self.__xm[self.__start].copy()
+
+    @property
+    def P0(self):
+        return self.__Pms[self.__start].copy()
+
+    @property
+    def N(self):
+        return self.__N
+
+    @property
+    def steady(self):
+        return self.__steady
+
+    def __init__(self, A, B, C, Q, R, N, x0, P0, G=None, tol=1e-12):
+        """
+        Initialize the estimator with system matrices and the prior.
+
+        x0 and P0 should be xhat(0 | -1) and P(0 | -1) as in EKF. N is the
+        number of intervals in the window.
+        """
+        self.__A = util.array(A)
+        self.__C = util.array(C)
+        Nx = self.__A.shape[0]
+        Ny = self.__C.shape[0]
+        self.__B = util.array(B).reshape((Nx, -1))
+        self.__G = np.eye(Nx) if G is None else util.array(G)
+        Nu = self.__B.shape[1]
+        Nw = self.__G.shape[1]
+        self.__Q = util.array(Q)
+        self.__R = util.array(R)
+        for (m, s, name) in [(self.__A, (Nx, Nx), "A"),
+                             (self.__C, (Ny, Nx), "C"),
+                             (self.__G, (Nx, Nw), "G"),
+                             (self.__Q, (Nw, Nw), "Q"),
+                             (self.__R, (Ny, Ny), "R")]:
+            if m.shape != s:
+                raise ValueError("%s must have shape %r!" % (name, s))
+        self.__GQGT = self.__G.dot(self.__Q).dot(self.__G.T)
+        self.__QGT = self.__Q.dot(self.__G.T)
+        self.__N = N
+        self.__tol = tol
+
+        # Ring buffers for the window. Index i holds filter prior, posterior,
+        # input, and smoother gains for sample i.
+        Nwin = N + 1
+        self.__xm = np.zeros((Nwin, Nx))
+        self.__Pms = np.zeros((Nwin, Nx, Nx))
+        self.__xf = np.zeros((Nwin, Nx))
+        self.__y = np.zeros((Nwin, Ny))
+        self.__u = np.zeros((Nwin, Nu))
+        self.__J = np.zeros((Nwin, Nx, Nx))
+        self.__Kw = np.zeros((Nwin, Nw, Nx))
+
+        # Current estimates and intermediate products.
+        self.__xhatm = np.zeros((Nx,))
+        self.__Pm = np.zeros((Nx, Nx))
+        self.__xhat = np.zeros((Nx,))
+        self.__P = np.zeros((Nx, Nx))
+        self.__L = np.zeros((Nx, Ny))
+        self.__innov = np.zeros((Ny,))
+        self.__lastu = np.zeros((Nu,))
+        self.reset(x0, P0)
+
+    def reset(self, x0, P0):
+        """Clears the window and sets the prior to (x0, P0)."""
+        self.__xhatm[:] = np.asarray(x0, dtype=float).flatten()
+        self.__Pm[...] = P0
+        self.__xhat[:] = self.__xhatm
+        self.__P[...] = self.__Pm
+        self.__start = 0
+        self.__count = 0
+        self.__steady = False
+
+    def __index(self, t):
+        """Ring-buffer index of the t-th sample in the window."""
+        return (self.__start + t) % (self.__N + 1)
+
+    def correct(self, y):
+        """
+        Adds measurement y(k) to the window and updates xhat(k | k).
+
+        If the window is full, the oldest sample is dropped.
+        """
+        if self.__count == self.__N + 1:
+            self.__start = self.__index(1)
+        else:
+            self.__count += 1
+        i = self.__index(self.__count - 1)
+        self.__y[i] = np.asarray(y, dtype=float).flatten()
+        self.__xm[i] = self.__xhatm
+        self.__Pms[i] = self.__Pm
+        if not self.__steady:
+            CP = self.__C.dot(self.__Pm)
+            S = CP.dot(self.__C.T) + self.__R
+            Sfactor = scipy.linalg.cho_factor(S, check_finite=False)
+            LT = scipy.linalg.cho_solve(Sfactor, CP, check_finite=False)
+            self.__L[...] = LT.T
+            np.subtract(self.__Pm, LT.T.dot(CP), out=self.__P)
+        np.dot(self.__C, self.__xhatm, out=self.__innov)
+        np.subtract(self.__y[i], self.__innov, out=self.__innov)
+        np.dot(self.__L, self.__innov, out=self.__xhat)
+        self.__xhat += self.__xhatm
+        self.__xf[i] = self.__xhat
+
+    def predict(self, u=None):
+        """
+        Advances to xhat(k+1 | k) and P(k+1 | k) using input u(k).
+
+        If u is None, the previous value of u is used. The smoother gains for
+        the newest sample are also computed here.
+        """
+        if u is not None:
+            self.__lastu[:] = np.asarray(u, dtype=float).flatten()
+        i = self.__index(self.__count - 1)
+        self.__u[i] = self.__lastu
+        np.dot(self.__A, self.__xhat, out=self.__xhatm)
+        self.__xhatm += self.__B.dot(self.__lastu)
+        if self.__steady:
+            self.__J[i] = self.__J[self.__index(self.__count - 2)]
+            self.__Kw[i] = self.__Kw[self.__index(self.__count - 2)]
+            return
+        AP = self.__A.dot(self.__P)
+        Pm = AP.dot(self.__A.T) + self.__GQGT
+        Pm += Pm.T
+        Pm *= 0.5
+        Pmfactor = scipy.linalg.cho_factor(Pm, check_finite=False)
+        self.__J[i] = scipy.linalg.cho_solve(Pmfactor, AP,
+                                             check_finite=False).T
+        self.__Kw[i] = scipy.linalg.cho_solve(Pmfactor, self.__QGT.T,
+                                              check_finite=False).T
+        if self.__tol is not None and self.__count > 1:
+            change = np.max(np.abs(Pm - self.__Pm))
+            self.__steady = change <= self.__tol*np.max(np.abs(Pm))
+        self.__Pm[...] = Pm
+
+    def step(self, y, u=None):
+        """
+        Does one correction and one prediction step.
+
+        The return value matches EKF.step, i.e., copies of
+
+            [P(k+1 | k), xhat(k+1 | k), P(k | k), xhat(k | k)]
+        """
+        self.correct(y)
+        self.predict(u)
+        return [self.__Pm.copy(), self.__xhatm.copy(), self.__P.copy(),
+                self.__xhat.copy()]
+
+    def smooth(self):
+        """
+        Solves the MHE problem for the whole window.
+
+        Returns a dictionary with entries "x", "w", and "v" with time along
+        the first dimension, as in callSolver for nmhe. The final x is xhat.
+        """
+        n = self.__count
+        index = [self.__index(t) for t in range(n)]
+        x = np.zeros((n, self.__xhat.size))
+        w = np.zeros((n - 1, self.__Kw.shape[1]))
+        x[-1] = self.__xf[index[-1]]
+        for t in range(n - 2, -1, -1):
+            (i, j) = (index[t], index[t + 1])
+            dx = x[t + 1] - self.__xm[j]
+            x[t] = self.__xf[i] + self.__J[i].dot(dx)
+            w[t] = self.__Kw[i].dot(dx)
+        v = self.__y[index] - x.dot(self.__C.T)
+        return dict(x=x, w=w, v=v)
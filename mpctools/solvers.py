@@ -1,5 +1,7 @@
 import numpy as np
+import scipy.sparse
 from . import util
+from . import colloc
 import casadi
 import time
 import warnings
@@ -28,7 +30,9 @@ def callSolver(solver, verbosity=None):
     Returns a dictionary with optimal variables as NumPy arrays. Additional
     keys "t", "obj" and "status" are also present. Finally, if the model used
     collocation, an entry "tc" is also present which is an Nt by Nc array of
-    time points.
+    time points. If move blocking was used, blocked variables are expanded
+    to have one entry per stage. Similarly, for single shooting or
+    condensing, x is returned at every stage, not just the shooting nodes.
     """
     if verbosity is not None:
         solver.verbosity = verbosity
@@ -38,13 +42,24 @@ def callSolver(solver, verbosity=None):
     returnDict["obj"] = solver.obj
     returnDict["status"] = solver.stats["status"]
     
-    Delta = solver.misc.get("Delta", 1)
     N = solver.misc["N"]
-    returnDict["t"] = Delta*np.arange(N["t"] + 1)
+    [Delta, returnDict["t"]] = solver.timegrid()
     if "c" in N and N["c"] > 0:
         r = solver.misc["colloc"]["r"][1:-1] # Throw out endpoints.        
         r = r[np.newaxis,:]
-        returnDict["tc"] = returnDict["t"][:-1,np.newaxis] + Delta*r    
+        returnDict["tc"] = (returnDict["t"][:-1,np.newaxis]
+                            + Delta[:,np.newaxis]*r)
+    blocks = solver.misc.get("blocks", None)
+    if blocks is not None:
+        index = blocks["index"]
+        first = np.concatenate(([True], index[1:] != index[:-1]))
+        for v in blocks["vars"]:
+            val = returnDict[v][index,...]
+            if v.startswith("D"):
+                val[~first,...] = 0
+            returnDict[v] = val
+    if "shooting" in solver.misc:
+        returnDict["x"] = solver.shootingstates()
     
     return returnDict
 
@@ -152,14 +167,59 @@ class ControlSolver(object):
     def timelimit(self, t):
         self.__changesettings(timelimit=t)
     
+    @property
+    def sol(self):
+        return self.__sol
+    
     @property
     def isQP(self):
         return self.__settings["isQP"]
     
+    @property
+    def structure(self):
+        return self.__structure
+    
     @isQP.setter
     def isQP(self, tf):
         self.__changesettings(isQP=tf)
     
+    @property
+    def presolve(self):
+        return self.__settings["presolve"]
+    
+    @presolve.setter
+    def presolve(self, tf):
+        self.__changesettings(presolve=tf)
+    
+    @property
+    def scaling(self):
+        return self.__settings["scaling"]
+    
+    @scaling.setter
+    def scaling(self, nominal):
+        if nominal is None or nominal is False:
+            nominal = None
+        elif nominal is True:
+            nominal = np.nan*np.ones(self.__var.size)
+        else:
+            nominal = np.array(getattr(nominal, "cat", nominal),
+                               dtype=float).flatten()
+            if nominal.shape != (self.__var.size,):
+                raise ValueError("scaling must have one entry per variable!")
+        self.__changesettings(scaling=nominal)
+    
+    @property
+    def hessian(self):
+        return self.__settings["hessian"]
+    
+    @hessian.setter
+    def hessian(self, h):
+        if h not in ("exact", "gauss-newton"):
+            raise ValueError("hessian must be 'exact' or 'gauss-newton'!")
+        elif h == "gauss-newton" and self.__residual is None:
+            raise ValueError("Gauss-Newton Hessian requires a residual!")
+        self.__changesettings(hessian=h)
+    
     @property
     def solver(self):
         return self.__settings["solver"]
@@ -171,7 +231,7 @@ class ControlSolver(object):
             errmsg = ("%s is not a valid solver. Available solvers:\n%s" %
                       (solverstr, util.listAvailableSolvers(asstring=True)))
             raise ValueError(errmsg)
-        elif solverstr in availablesolvers["QP"] and not self.isQP:
+        elif solverstr in availablesolvers["QP"] and self.isQP is False:
             errmsg = ("%s is a QP solver and self.isQP is False. Please set "
                       "isQP to True or choose a QP solver. Available solvers:"
                       "\n%s" % (solverstr, util.listAvailableSolvers()))
@@ -194,10 +254,11 @@ class ControlSolver(object):
         return self.__par
     
     def __init__(self, var, varlb, varub, varguess, obj, con, conlb, conub,
-                 par=None, parval=None, verbosity=5, timelimit=60, isQP=False,
+                 par=None, parval=None, verbosity=5, timelimit=60, isQP=None,
                  casaditype="SX", name="ControlSolver", casadioptions=None,
                  solveroptions=None, misc=None, solver="ipopt",
-                 discretevar=None):
+                 discretevar=None, presolve=False, scaling=None,
+                 residual=None, hessian=None):
         """
         Initialize the solver object.
         
@@ -209,6 +270,35 @@ class ControlSolver(object):
         appropriate size. misc is a read-only dictionary for storing to hold
         miscellaneous parameters that cannot be changed.
         
+        If presolve is True, variables with lb == ub are substituted as
+        parameters before the problem is passed to the solver, constraints
+        that then do not depend on any variable are dropped, and duplicate
+        constraint rows are merged. The problem is rebuilt if the set of fixed
+        variables changes. Solutions and multipliers in self.sol are mapped
+        back to the full problem.
+        
+        If scaling is True, variables are scaled by nominal values inferred
+        from their bounds or guess, and constraint rows are scaled by the
+        inverse of their largest derivative at the guess. scaling can also be
+        a struct (or vector) of nominal values like var, with NaN entries to
+        be inferred. Scale factors are computed whenever the solver is
+        initialized, and self.var is always in the original units.
+        
+        If isQP is None (the default), the problem is checked for linear
+        constraints and a quadratic objective whenever the solver is
+        initialized (see util.nlpstructure), and the results are stored in
+        self.structure. For IPOPT, constant derivatives are then declared via
+        the options jac_c_constant, jac_d_constant, and hessian_constant.
+        isQP=True sets all of these without checking, and isQP=False skips
+        the check. If solver is "auto", the check is done immediately, and
+        qpoases is used for QPs (if available) and ipopt otherwise.
+        
+        residual is an optional vector of residuals whose sum of squares is
+        added to obj. hessian can then be "gauss-newton" (the default if
+        residual is given) to approximate the Hessian of the Lagrangian by
+        2*J'*J for the residuals plus the exact Hessian of obj, dropping
+        second derivatives of the constraints, or "exact".
+        
         Typically, it's easiest to build these objects using nmpc, nmhe, or
         sstarg from the tools module, all of which return ControlSolver
         objects.
@@ -230,6 +320,8 @@ class ControlSolver(object):
         self.__con = con
         self.__conlb = conlb
         self.__conub = conub
+        self.__residual = residual
+        self.__structure = None
         
         self.__par = par
         self.__parval = parval
@@ -238,7 +330,19 @@ class ControlSolver(object):
         self.__stats = {}
         self.__settings = {} # Need to initialize this.
         self.__changesettings(isQP=isQP, name=name, verbosity=verbosity,
-                              timelimit=timelimit, solver=solver)
+                              timelimit=timelimit, solver=solver,
+                              presolve=presolve)
+        self.scaling = scaling
+        if hessian is None:
+            hessian = "exact" if residual is None else "gauss-newton"
+        self.hessian = hessian
+        if solver == "auto":
+            self.__structure = self.__checkstructure()
+            qpsolvers = util.listAvailableSolvers()["QP"]
+            if self.__structure["QP"] and "qpoases" in qpsolvers:
+                self.__changesettings(isQP=True, solver="qpoases")
+            else:
+                self.__changesettings(solver="ipopt")
         if misc is None:
             misc = {}
         self.misc = util.ReadOnlyDict(**misc)
@@ -272,12 +376,29 @@ class ControlSolver(object):
             solveroptions = solveroptions.copy()
         
         nlp = {
-            "x" : self.__var,
+            "x" : self.__var.cat,
             "f" : self.__obj,
             "g" : self.__con,
         }
+        if self.isQP is None and self.__structure is None:
+            self.__structure = self.__checkstructure()
         if self.__par is not None:
-            nlp["p"] = self.__par
+            nlp["p"] = self.__par.cat
+        if self.__residual is not None:
+            nlp["r"] = self.__residual
+        if self.presolve:
+            nlp = self.__presolve(nlp)
+        if self.scaling is not None:
+            nlp = self.__scale(nlp)
+        
+        # Add least-squares terms to the objective.
+        residual = nlp.pop("r", None)
+        if self.hessian == "gauss-newton":
+            hesslag = self.__gaussnewton(nlp, residual)
+        else:
+            hesslag = None
+        if residual is not None:
+            nlp["f"] = nlp["f"] + casadi.sumsqr(residual)
         
         # Print and time limit options.
         if self.solver in set(["ipopt", "bonmin"]):
@@ -293,6 +414,9 @@ class ControlSolver(object):
             else:
                 plevel = "none"
             solveroptions["printLevel"] = plevel
+        elif self.solver in _QUIET_QP_OPTIONS:
+            if self.verbosity < 3:
+                solveroptions.update(_QUIET_QP_OPTIONS[self.solver])
         else:
             #TODO: add other solver-specific verbosity code.
             warnings.warn("Solver '%s' does not have a verbosity setting"
@@ -306,7 +430,6 @@ class ControlSolver(object):
                 solveroptions[timesetting] = self.timelimit        
              
         # Choose different function whether QP or not.
-        #TODO: Specify constant Lagrangian if isQP
         availablesolvers = util.listAvailableSolvers()
         if self.solver in availablesolvers["QP"]:
             solverfunc = casadi.qpsol
@@ -320,19 +443,29 @@ class ControlSolver(object):
                 else:
                     warnings.warn("NLP solver '%s' selected for QP."
                                   % self.solver)
+            elif self.isQP is None and self.solver == "ipopt":
+                constant = [("jac_c_constant", "linearequality"),
+                            ("jac_d_constant", "linearinequality"),
+                            ("hessian_constant", "QP")]
+                for (k, key) in constant:
+                    if self.structure[key]:
+                        solveroptions.setdefault(k, "yes")
             solverfunc = casadi.nlpsol
             if "eval_errors_fatal" not in casadioptions:
                 casadioptions["eval_errors_fatal"] = True
             casadioptions["print_time"] = self.verbosity > 2
             casadioptions[self.solver] = solveroptions
+            if hesslag is not None:
+                casadioptions["hess_lag"] = hesslag
         else:
             raise ValueError("Invalid choice of solver: %s" % self.solver)
         
         # Set discrete variables.
         if self.solver in set(["bonmin", "gurobi", "cplex"]):
-            discrete =  np.squeeze(np.array(self.discretevar.cat,
-                                            dtype=bool)).tolist()
-            casadioptions["discrete"] = discrete
+            discrete = np.array(self.discretevar.cat, dtype=bool).flatten()
+            if self.presolve:
+                discrete = discrete[self.__presolved["free"]]
+            casadioptions["discrete"] = discrete.tolist()
         elif np.any(self.discretevar.cat):
             warnings.warn("Discrete variables not supported in %s!"
                           % self.solver)
@@ -342,6 +475,283 @@ class ControlSolver(object):
         self.__solver = solver
         self.__changed = False
     
+    def __fixedvars(self):
+        """Returns a boolean vector marking variables with lb == ub."""
+        lb = np.array(self.lb.cat, dtype=float).flatten()
+        ub = np.array(self.ub.cat, dtype=float).flatten()
+        return (lb == ub)
+    
+    def __checkstructure(self):
+        """
+        Checks the full problem for linear constraints and quadratic cost.
+        
+        Prints a summary if verbosity is large enough.
+        """
+        obj = self.__obj
+        if self.__residual is not None:
+            obj = obj + casadi.sumsqr(self.__residual)
+        equality = (np.array(self.conlb, dtype=float).flatten()
+                    == np.array(self.conub, dtype=float).flatten())
+        structure = util.nlpstructure(obj, self.__con, self.__var.cat,
+                                      equality)
+        if self.verbosity > 2:
+            found = [("quadratic objective", "quadratic"),
+                     ("linear equality constraints", "linearequality"),
+                     ("linear inequality constraints", "linearinequality")]
+            print("Problem structure: %s." % ", ".join(
+                  ("" if structure[k] else "non") + name
+                  for (name, k) in found))
+        return structure
+    
+    @staticmethod
+    def __substitute(nlp, x, par, newx, newpar):
+        """
+        Returns a copy of nlp with x and par replaced by newx and newpar.
+        
+        Only the expressions "f", "g", and "r" are substituted. par and newpar
+        should be lists with zero or one entries.
+        """
+        keys = [k for k in ["f", "g", "r"] if k in nlp]
+        func = casadi.Function("nlp", [x] + par, [nlp[k] for k in keys])
+        nlp = nlp.copy()
+        nlp.update(zip(keys, func(newx, *newpar)))
+        return nlp
+    
+    def __gaussnewton(self, nlp, residual):
+        """
+        Returns a Function for the Gauss-Newton Hessian of the Lagrangian.
+        
+        The exact Hessian of nlp["f"] is kept, while residual contributes
+        2*J'*J and constraints are ignored. The output is upper triangular as
+        required for the hess_lag option of nlpsol.
+        """
+        x = nlp["x"]
+        symtype = type(x)
+        p = nlp.get("p", symtype.sym("p", 0))
+        lamf = symtype.sym("lam_f")
+        lamg = symtype.sym("lam_g", nlp["g"].numel())
+        J = casadi.jacobian(residual, x)
+        H = 2*casadi.mtimes(J.T, J) + casadi.hessian(nlp["f"], x)[0]
+        return casadi.Function("nlp_hess_l", [x, p, lamf, lamg],
+                               [casadi.triu(lamf*H)])
+    
+    def __presolve(self, nlp):
+        """
+        Returns an nlp dictionary with fixed variables and trivial constraints
+        removed.
+        
+        Fixed variables are moved to the start of the parameter vector. Rows
+        that do not depend on any free variable are dropped, and identical
+        rows are merged (SX problems only). Index information to map between
+        the full and reduced problems is stored in self.__presolved.
+        """
+        fixed = self.__fixedvars()
+        free = np.flatnonzero(~fixed)
+        nfixed = np.sum(fixed)
+        x = nlp["x"]
+        symtype = type(x)
+        par = [nlp["p"]] if "p" in nlp else []
+        npar = sum(p.numel() for p in par)
+        
+        # Substitute fixed variables as parameters.
+        xfree = symtype.sym("x", len(free))
+        psym = symtype.sym("p", nfixed + npar)
+        order = np.argsort(np.concatenate((free, np.flatnonzero(fixed))))
+        xfull = casadi.vertcat(xfree, psym[:nfixed])[order.tolist()]
+        pfull = [psym[nfixed:]] if npar > 0 else []
+        nlp = self.__substitute(nlp, x, par, xfull, pfull)
+        (obj, con) = (nlp["f"], nlp["g"])
+        
+        # Drop constant rows and merge duplicates. Candidate duplicates must
+        # agree at two random points before being checked symbolically.
+        Ncon = con.numel()
+        active = np.zeros(Ncon, dtype=bool)
+        active[casadi.jacobian(con, xfree).sparsity().row()] = True
+        rows = np.flatnonzero(active)
+        unique = []
+        rowmap = -np.ones(Ncon, dtype=int)
+        if symtype is casadi.SX and len(rows) > 0:
+            test = casadi.Function("test", [xfree, psym], [con[rows.tolist()]])
+            points = np.random.RandomState(0).uniform(0.5, 1.5,
+                (2, len(free) + psym.numel()))
+            vals = np.concatenate([np.array(test(pt[:len(free)],
+                                                 pt[len(free):]))
+                                   for pt in points], axis=1)
+            candidates = {}
+            for (i, v) in zip(rows, vals):
+                key = tuple(v)
+                for j in candidates.get(key, []):
+                    if casadi.is_equal(con[i], con[j], 20):
+                        rowmap[i] = rowmap[j]
+                        break
+                else:
+                    candidates.setdefault(key, []).append(i)
+                    rowmap[i] = len(unique)
+                    unique.append(i)
+        else:
+            rowmap[rows] = np.arange(len(rows))
+            unique = list(rows)
+        dropped = np.flatnonzero(~active)
+        
+        # Functions to recover multipliers and dropped rows.
+        nlp.update(x=xfree, g=con[unique], p=psym)
+        lam = symtype.sym("lam", len(unique))
+        lagrangian = obj + casadi.dot(lam, nlp["g"])
+        if "r" in nlp:
+            lagrangian += casadi.sumsqr(nlp["r"])
+        lamfixed = -casadi.gradient(lagrangian, psym)[:nfixed]
+        self.__presolved = dict(
+            fixed=fixed, free=free, rowmap=rowmap, dropped=dropped,
+            unique=np.array(unique, dtype=int),
+            lamfixed=casadi.Function("lamfixed", [xfree, psym, lam],
+                                     [lamfixed]),
+            droppedcon=casadi.Function("dropped", [xfree, psym],
+                                       [con[dropped.tolist()]]),
+        )
+        self.stats["presolve"] = dict(fixed=nfixed, dropped=len(dropped),
+                                      duplicate=len(rows) - len(unique))
+        return nlp
+    
+    def __presolveargs(self, args):
+        """
+        Reduces the full solver arguments to the presolved problem.
+        
+        Returns [args, lbg, ubg] with lbg and ubg the full constraint bounds.
+        """
+        pre = self.__presolved
+        fixed = pre["fixed"]
+        rows = np.flatnonzero(pre["rowmap"] >= 0)
+        Nrows = len(pre["unique"])
+        lbg = -np.inf*np.ones(Nrows)
+        ubg = np.inf*np.ones(Nrows)
+        np.maximum.at(lbg, pre["rowmap"][rows], args["lbg"][rows])
+        np.minimum.at(ubg, pre["rowmap"][rows], args["ubg"][rows])
+        p = [args["lbx"][fixed], args.get("p", np.zeros(0))]
+        reduced = dict(x0=args["x0"][~fixed], lbx=args["lbx"][~fixed],
+                       ubx=args["ubx"][~fixed], lbg=lbg, ubg=ubg,
+                       p=np.concatenate(p))
+        return [reduced, args["lbg"], args["ubg"]]
+    
+    def __unpresolve(self, sol, args, lbg, ubg):
+        """Maps a solution of the presolved problem back to the full layout."""
+        pre = self.__presolved
+        fixed = pre["fixed"]
+        nfixed = np.sum(fixed)
+        solx = np.array(sol["x"]).flatten()
+        lamg = np.array(sol["lam_g"]).flatten()
+        x = np.empty(len(fixed))
+        x[fixed] = args["p"][:nfixed]
+        x[~fixed] = solx
+        lamx = np.zeros(len(fixed))
+        lamx[~fixed] = np.array(sol["lam_x"]).flatten()
+        lamx[fixed] = np.array(pre["lamfixed"](solx, args["p"],
+                                               lamg)).flatten()
+        
+        # Duplicates get their multiplier on the first row only.
+        g = np.zeros(len(pre["rowmap"]))
+        rows = pre["rowmap"] >= 0
+        g[rows] = np.array(sol["g"]).flatten()[pre["rowmap"][rows]]
+        gdropped = np.array(pre["droppedcon"](solx, args["p"])).flatten()
+        g[pre["dropped"]] = gdropped
+        lam_g = np.zeros(len(pre["rowmap"]))
+        lam_g[pre["unique"]] = lamg
+        
+        # Dropped rows are not seen by the solver, so check them here.
+        violation = np.maximum(lbg[pre["dropped"]] - gdropped,
+                               gdropped - ubg[pre["dropped"]])
+        if np.any(violation > 1e-8):
+            warnings.warn("Fixed variables violate %d constraints removed by "
+                          "presolve." % np.sum(violation > 1e-8))
+        return dict(x=casadi.DM(x), f=sol["f"], g=casadi.DM(g),
+                    lam_x=casadi.DM(lamx), lam_g=casadi.DM(lam_g),
+                    lam_p=sol["lam_p"][nfixed:])
+    
+    def __varscale(self):
+        """
+        Returns scale factors for all variables.
+        
+        User-supplied nominal values are used first, then the largest finite
+        bound, and finally the guess. Any remaining zeros are replaced by 1.
+        """
+        lb = np.array(self.lb.cat, dtype=float).flatten()
+        ub = np.array(self.ub.cat, dtype=float).flatten()
+        guess = np.array(self.guess.cat, dtype=float).flatten()
+        scale = np.abs(self.scaling)
+        bounded = np.isnan(scale) & np.isfinite(lb) & np.isfinite(ub)
+        scale[bounded] = np.maximum(np.abs(lb), np.abs(ub))[bounded]
+        unknown = np.isnan(scale) | (scale == 0)
+        scale[unknown] = np.abs(guess[unknown])
+        scale[~np.isfinite(scale) | (scale == 0)] = 1
+        return scale
+    
+    def __scale(self, nlp):
+        """
+        Returns nlp in terms of scaled variables with scaled constraints.
+        
+        Works on either the full or presolved problem. Scale factors are
+        stored in self.__scalefactors.
+        """
+        x = nlp["x"]
+        par = [nlp["p"]] if "p" in nlp else []
+        xscale = self.__varscale()
+        if self.presolve:
+            xscale = xscale[self.__presolved["free"]]
+        xs = type(x).sym("x", x.numel())
+        nlp = self.__substitute(nlp, x, par, xscale*xs, par)
+        con = nlp["g"]
+        
+        # Scale each row by its largest derivative at the guess.
+        args = self.__solverargs()
+        if self.presolve:
+            args = self.__presolveargs(args)[0]
+        jac = casadi.Function("conjac", [xs] + par,
+                              [casadi.jacobian(con, xs)])
+        J = jac(args["x0"]/xscale, *([args["p"]] if par else []))
+        rownorm = np.zeros(con.numel())
+        np.maximum.at(rownorm, J.sparsity().row(), np.abs(J.nonzeros()))
+        rownorm[~np.isfinite(rownorm) | (rownorm == 0)] = 1
+        conscale = np.clip(1/rownorm, 1e-6, 1e6)
+        self.__scalefactors = dict(x=xscale, g=conscale)
+        
+        nlp.update(x=xs, g=conscale*con)
+        return nlp
+    
+    def __scaleargs(self, solverargs):
+        """Scales solver arguments for the scaled problem."""
+        xscale = self.__scalefactors["x"]
+        conscale = self.__scalefactors["g"]
+        args = solverargs.copy()
+        for k in ["x0", "lbx", "ubx"]:
+            args[k] = args[k]/xscale
+        for k in ["lbg", "ubg"]:
+            args[k] = args[k]*conscale
+        return args
+    
+    def __unscale(self, sol):
+        """Maps a solution of the scaled problem back to original units."""
+        xscale = self.__scalefactors["x"]
+        conscale = self.__scalefactors["g"]
+        sol = dict(sol)
+        sol["x"] = sol["x"]*xscale
+        sol["lam_x"] = sol["lam_x"]/xscale
+        sol["g"] = sol["g"]/conscale
+        sol["lam_g"] = sol["lam_g"]*conscale
+        return sol
+    
+    def __solverargs(self):
+        """Returns guess and bounds as vector arguments for the solver."""
+        solverargs = {
+            "x0" : self.guess.cat,
+            "lbx" : self.lb.cat,
+            "ubx" : self.ub.cat,
+            "lbg" : self.conlb,
+            "ubg" : self.conub,
+        }
+        if self.par is not None:
+            solverargs["p"] = self.par.cat
+        return {k : np.array(v, dtype=float).flatten()
+                for (k, v) in solverargs.items()}
+    
     def getSolverOptions(self, display=True):
         """
         Lists options for the current solver.
@@ -359,22 +769,27 @@ class ControlSolver(object):
         """
         Solve the current solver object.
         """
+        # Check the active horizon, since masks are all zero otherwise.
+        if self.misc.get("horizon", False):
+            horizon = float(self.par["horizon",0])
+            Nt = self.misc["N"]["t"]
+            if horizon != round(horizon) or horizon < 1 or horizon > Nt:
+                raise ValueError("par['horizon'] must be an integer between 1 "
+                                 "and N['t'] = %d!" % Nt)
+        
         # Solve the problem and get optimal variables.
         starttime = time.time()
-        if self.__changed:
+        if self.__changed or (self.presolve and not np.array_equal(
+                self.__fixedvars(), self.__presolved["fixed"])):
             self.initialize()
         solver = self.__solver
         
         # Now set guess and bounds.
-        solverargs = {
-            "x0" : self.guess,
-            "lbx" : self.lb,
-            "ubx" : self.ub,
-            "lbg" : self.conlb,
-            "ubg" : self.conub,
-        }
-        if self.par is not None:
-            solverargs["p"] = self.par
+        solverargs = self.__solverargs()
+        if self.presolve:
+            [solverargs, lbg, ubg] = self.__presolveargs(solverargs)
+        if self.scaling is not None:
+            solverargs = self.__scaleargs(solverargs)
         
         # Need something special to prevent c code from printing; in
         # particular, we want to suppress Ipopt's splash message if
@@ -387,6 +802,10 @@ class ControlSolver(object):
         with printcontext():
             sol = solver(**solverargs)
             stats = solver.stats()
+        if self.scaling is not None:
+            sol = self.__unscale(sol)
+        if self.presolve:
+            sol = self.__unpresolve(sol, solverargs, lbg, ubg)
         self.__sol = sol
         self.__varval = self.__var(sol["x"])
         self.__vardict = None # Lazy update in getter.
@@ -403,7 +822,9 @@ class ControlSolver(object):
         if self.verbosity > 1:
             print("Took %g s." % (endtime - starttime,))
         self.stats["status"] = status
+        self.stats["success"] = bool(stats.get("success", False))
         self.stats["time"] = endtime - starttime
+        self.stats["iter_count"] = stats.get("iter_count", None)
          
     def saveguess(self, newguess=None, toffset=None, default=False,
                   infercolloc=True, pad=True):
@@ -434,6 +855,23 @@ class ControlSolver(object):
         the solver. Thus, the final time point is missing. If pad=True, it will
         be filled using the second-to-last time point; otherwise, it will not
         be changed.
+        
+        For move-blocked variables, toffset counts stages rather than blocks,
+        so each block gets the value from the stage toffset after its start.
+        
+        With single shooting or condensing, x only has entries at the shooting
+        nodes. A guess for x may then have one entry per stage, in which case
+        each node takes the entry toffset after its stage. When the guess is
+        pulled from self.var, the eliminated states are simulated first.
+        
+        If the problem has a non-uniform time grid (i.e., Delta is a vector),
+        then a positive toffset instead shifts the guess forward in time by
+        the first toffset timesteps. The guess must then be on the same grid,
+        and the shifted values are interpolated in time.
+        
+        For a variable horizon (see nmpc), entries after the active horizon
+        (given by self.par["horizon"] before shifting) are padded from the end
+        of the active horizon rather than the end of the full horizon.
         """
         getguess = None
         if newguess is None:
@@ -471,10 +909,23 @@ class ControlSolver(object):
         if len(extra) > 0:
             warnings.warn("Ignoring extra fields in guess: %r." % (extra,))
         
-        # Now actually save guess.
+        # Now actually save guess. On non-uniform time grids, shifted guesses
+        # need to be interpolated in time.
+        shifted = (toffset > 0 and self.__nonuniform())
+        blocked = set(self.misc.get("blocks", {}).get("vars", []))
         for k in self.guess.keys(): # keys() is important!
             Tguess = len(getguess(k))
             Tself = len(self.guess[k])
+            if k == "x" and "shooting" in self.misc:
+                if self.__saveshootingguess(getguess, newguess is self.var,
+                                            toffset, pad):
+                    continue
+            if k in blocked and toffset != 0 and Tguess == Tself:
+                self.__saveblockedguess(k, getguess, toffset, pad)
+                continue
+            if shifted and Tguess == Tself:
+                if self.__saveshiftedguess(k, getguess, toffset, pad):
+                    continue
             if pad:
                 tmin = 0
                 tmax = Tself
@@ -487,12 +938,185 @@ class ControlSolver(object):
                 tself = t
                 tguess = max(0, min(t + toffset, Tguess - 1))
                 self.guess[k,tself] = getguess(k, tguess)
+        
+        # Pad after the active horizon.
+        if pad and self.misc.get("horizon", False):
+            skip = set(blocked)
+            if "shooting" in self.misc:
+                skip.add("x")
+            self.__padhorizon(toffset, skip)
                 
         # Finally, infer a collocation guess.
         if (infercolloc and "colloc" in self.misc
                 and "xc" not in newguess.keys()): # keys() is important!
             self.infercollocguess()
     
+    def __padhorizon(self, toffset, skip=()):
+        """
+        Fills guesses after the active horizon with its final entries.
+        
+        The active horizon is shifted by toffset stages. Variables in skip are
+        not changed.
+        """
+        Nt = self.misc["N"]["t"]
+        horizon = int(round(float(self.par["horizon",0])))
+        for k in set(self.guess.keys()).difference(skip):
+            T = len(self.guess[k])
+            if T == Nt + 1:
+                last = horizon - toffset
+            elif T == Nt:
+                last = horizon - toffset - 1
+            else:
+                continue
+            last = max(0, min(last, T - 1))
+            for t in range(last + 1, T):
+                self.guess[k,t] = self.guess[k,last]
+    
+    def __saveblockedguess(self, k, getguess, toffset, pad):
+        """Saves a guess for move-blocked k shifted by toffset stages."""
+        index = self.misc["blocks"]["index"]
+        Nt = len(index)
+        starts = np.cumsum([0] + self.misc["blocks"]["lengths"][:-1])
+        for (b, start) in enumerate(starts):
+            stage = start + toffset
+            if pad:
+                stage = max(0, min(stage, Nt - 1))
+            elif stage < 0 or stage >= Nt:
+                continue
+            self.guess[k,b] = getguess(k, index[stage])
+    
+    def __saveshootingguess(self, getguess, fromvar, toffset, pad):
+        """
+        Saves a guess for x at the shooting nodes shifted by toffset stages.
+        
+        Returns False if the guess does not have one entry per stage, in which
+        case nothing is stored.
+        """
+        nodes = self.misc["shooting"]["nodes"]
+        Nt = self.misc["N"]["t"]
+        if fromvar:
+            xguess = self.shootingstates()
+        elif len(getguess("x")) == Nt + 1:
+            xguess = np.array([getguess("x", t) for t in range(Nt + 1)])
+        else:
+            return False
+        for (i, node) in enumerate(nodes):
+            stage = node + toffset
+            if pad:
+                stage = max(0, min(stage, Nt))
+            elif stage < 0 or stage > Nt:
+                continue
+            self.guess["x",i] = xguess[stage,...]
+        return True
+    
+    def shootingstates(self):
+        """
+        Returns x at every stage for single shooting or condensing.
+        
+        The eliminated states are computed by simulating from the shooting
+        nodes in self.var. Result is an (Nt + 1) by Nx array.
+        """
+        if "shooting" not in self.misc:
+            raise ValueError("Problem does not use single shooting!")
+        args = [self.var.cat]
+        if self.par is not None:
+            args.append(self.par.cat)
+        x = self.misc["shooting"]["x"](*args)
+        return np.array(x).T
+    
+    def timegrid(self):
+        """
+        Returns [Delta, t] with the timestep of each stage and the time points.
+        
+        If Delta is a parameter, its current values are used. Otherwise, they
+        come from the Delta used to build the problem (default 1).
+        """
+        return util._timegrid(self.__deltas(), self.misc["N"]["t"])
+    
+    def __deltas(self):
+        """Returns the current timestep(s) as a flat array."""
+        if self.par is not None and "Delta" in self.par.keys():
+            Delta = self.par["Delta"]
+        else:
+            Delta = self.misc.get("Delta", 1)
+        return np.array(Delta, dtype=float).flatten()
+    
+    def __nonuniform(self):
+        """Returns True if the problem has a non-uniform time grid."""
+        Delta = self.__deltas()
+        return Delta.size > 1 and np.ptp(Delta) > 0
+    
+    def __saveshiftedguess(self, k, getguess, toffset, pad):
+        """
+        Saves a guess for k shifted forward by toffset time points.
+        
+        The guess is assumed to be on the same non-uniform time grid as self,
+        and values are interpolated at the shifted times. Collocation states
+        use their collocation polynomials, other time points are linearly
+        interpolated, and variables defined on intervals are taken from the
+        interval containing the new interval's midpoint.
+        
+        Returns False if k is not a time-varying variable, in which case
+        nothing is stored.
+        """
+        Nt = self.misc["N"]["t"]
+        T = len(self.guess[k])
+        collocvars = set(self.guess.keys()) if "colloc" in self.misc else set()
+        if k[-1:] == "c" and k[:-1] in collocvars:
+            kind = "colloc"
+        elif T == Nt + 1:
+            kind = "point"
+        elif T == Nt:
+            kind = "interval"
+        else:
+            return False
+        
+        # Figure out times for the new guess.
+        [Delta, t] = self.timegrid()
+        shift = t[min(toffset, Nt)]
+        if kind == "point":
+            tnew = t + shift
+        elif kind == "interval":
+            tnew = t[:-1] + shift + 0.5*Delta
+        else:
+            rc = self.misc["colloc"]["r"][1:-1]
+            tnew = t[:-1,np.newaxis] + shift + Delta[:,np.newaxis]*rc
+        keep = (tnew <= t[-1]) if not pad else np.ones(tnew.shape, dtype=bool)
+        keep = keep.reshape((T, -1)).all(axis=1)
+        tnew = np.minimum(tnew, t[-1])
+        
+        # Interpolate.
+        def getvals(v):
+            """Returns an array of values for v with time first."""
+            return np.array([np.array(getguess(v, j))
+                             for j in range(len(self.guess[v]))])
+        vals = getvals(k)
+        shape = vals.shape[1:]
+        if kind == "colloc" or (kind == "point" and k + "c" in collocvars):
+            if kind == "point":
+                x = vals
+                xc = getvals(k + "c")
+            else:
+                x = getvals(k[:-1])
+                xc = vals
+            x = x.reshape((Nt + 1, -1))
+            newvals = util.interpColloc(tnew.flatten(), x, xc, t)
+            if kind == "colloc":
+                newvals = newvals.reshape(tnew.shape + (-1,))
+                newvals = newvals.transpose((0, 2, 1))
+        else:
+            i = np.clip(np.searchsorted(t, tnew, side="right") - 1, 0, Nt - 1)
+            if kind == "point":
+                w = ((tnew - t[i])/Delta[i]).reshape((-1,) + (1,)*len(shape))
+                newvals = (1 - w)*vals[i] + w*vals[i + 1]
+            else:
+                newvals = vals[i]
+        newvals = newvals.reshape((T,) + shape)
+        for j in range(T):
+            if keep[j]:
+                self.guess[k,j] = newvals[j]
+        return True
+    
     def newmeasurement(self, y, u=None, x0bar=None):
         """
         Adds new measurement for MHE.
@@ -509,11 +1133,13 @@ class ControlSolver(object):
                 raise TypeError("u is missing from par! Not from mhe().")
             cycles["u"] = u
         
-        # Actually cycle things.
-        # TODO: split out saveguess and use same logic.
+        # Actually cycle things. Entries are stored contiguously with time
+        # first, so we can shift them all at once using their flat indices.
         for (k, newval) in cycles.items():
-            for t in range(len(self.par[k]) - 1):
-                self.par[k,t] = self.par[k,t + 1]
+            index = self.par.f[k]
+            n = len(index)//len(self.par[k])
+            cat = self.par.cat
+            cat[index[:-n]] = cat[index[n:]]
             self.par[k,-1] = newval
             
         # Also do x0bar.
@@ -522,6 +1148,46 @@ class ControlSolver(object):
                 raise TypeError("Object does not accept x0bar!")
             self.par["x0bar",0] = x0bar
     
+    def relinearize(self, x=None, u=None, fpar=None):
+        """
+        Updates the time-varying linear model of an ltvmpc controller.
+        
+        The nonlinear model is linearized at each time point of (x, u), which
+        default to the current guess. x and u should have time along the
+        first dimension with at least N["t"] entries. fpar can be given to
+        update the values of any additional model arguments.
+        """
+        ltv = self.misc.get("ltv", None)
+        if ltv is None:
+            raise TypeError("No time-varying model! Not from ltvmpc().")
+        Nt = self.misc["N"]["t"]
+        if x is None:
+            x = util.listcatfirstdim(self.guess["x"])
+        if u is None:
+            u = util.listcatfirstdim(self.guess["u"])
+        x = np.array(x, dtype=float)[:Nt,...].reshape((Nt, -1))
+        u = np.array(u, dtype=float)[:Nt,...].reshape((Nt, -1))
+        if fpar is not None:
+            ltv["fpar"][:] = [np.array(v, dtype=float).flatten()
+                              for v in fpar]
+        
+        # Linearize at all points in one call.
+        args = [x, u] + [np.tile(v, (Nt, 1)) for v in ltv["fpar"]]
+        ss = util.getLinearizedModel(ltv["f"], args, Delta=ltv["Delta"],
+                                     stacked=True)
+        A = ss["A"]
+        B = ss["B_1"]
+        c = ss["f"][...,0] - np.matmul(A, x[...,np.newaxis])[...,0]
+        c -= np.matmul(B, u[...,np.newaxis])[...,0]
+        if ltv["Delta"] is not None:
+            c += x # Continuous-time linearization is about x.
+        
+        # Pack everything (column-major) into the parameter struct.
+        p = np.concatenate([A.transpose((0, 2, 1)).reshape((Nt, -1)),
+                            B.transpose((0, 2, 1)).reshape((Nt, -1)), c],
+                           axis=1)
+        self.par["p"] = list(p)
+    
     def infercollocguess(self):
         """Infers a guess for "xc" based on the guess for "x"."""
         try:
@@ -530,6 +1196,61 @@ class ControlSolver(object):
             raise ValueError("No collocation variables are present!")
         util._infercolloc(r, self.guess)
     
+    def collocerror(self):
+        """
+        Estimates the collocation error on each time interval.
+        
+        On each interval, the collocation polynomial for x is compared to the
+        model at the midpoints between collocation nodes, where the polynomial
+        is not forced to satisfy the model. Returns an N["t"] vector with the
+        largest residual on each interval, which approximates the local error
+        in x, scaled by 1 + max|x| for each state over the horizon.
+        """
+        try:
+            col = self.misc["colloc"]
+            f = col["f"]
+        except KeyError:
+            raise ValueError("No collocation model is present!")
+        Nt = self.misc["N"]["t"]
+        [Delta, _] = util._timegrid(self.misc["Delta"], Nt)
+        r = col["r"]
+        s = 0.5*(r[1:] + r[:-1])
+        Ns = len(s)
+        [L, D] = colloc.basis(r, s)
+        
+        # Get values for all of the arguments at the midpoints.
+        vals = util.casadiStruct2numpyDict(self.var)
+        if self.par is not None:
+            vals.update(util.casadiStruct2numpyDict(self.par))
+        blocks = self.misc.get("blocks", None)
+        if blocks is not None:
+            for v in set(blocks["vars"]).intersection(vals):
+                vals[v] = vals[v][blocks["index"],...]
+        nodes = {}
+        for v in set(["x", "z"]).intersection(vals):
+            if v + "c" in vals:
+                nodes[v] = np.concatenate((vals[v][:-1,:,np.newaxis],
+                                           vals[v + "c"],
+                                           vals[v][1:,:,np.newaxis]), axis=2)
+        args = []
+        for a in col["fargs"]:
+            if a in nodes:
+                arg = np.matmul(nodes[a], L.T).transpose((0, 2, 1))
+                args.append(arg.reshape((Nt*Ns, -1)).T)
+            elif len(vals[a]) < Nt:
+                args.append(vals[a][0])
+            else:
+                arg = np.repeat(vals[a][:Nt].reshape((Nt, -1)), Ns, axis=0)
+                args.append(arg.T)
+        fmap = util.mapfunc(f, Nt*Ns)
+        fval = np.array(fmap(*args)).reshape((-1, Nt, Ns)).transpose((1, 0, 2))
+        
+        # Compare derivatives of the polynomial to the model.
+        resid = np.matmul(nodes["x"], D.T) - Delta[:,np.newaxis,np.newaxis]*fval
+        scale = 1 + np.max(np.abs(vals["x"]), axis=0)
+        err = np.abs(resid)/scale[np.newaxis,:,np.newaxis]
+        return np.max(err, axis=(1, 2))
+    
     def fixvar(self,var,t,val,indices=None):
         """
         Fixes variable var at time t to val.
@@ -586,7 +1307,7 @@ class ControlSolver(object):
             x = np.array(x)
             if x.size == 1:
                 x = x.flatten()*np.ones(newcon.numel())
-            elif x.ndims != 1:
+            elif x.ndim != 1:
                 raise ValueError("lb and ub must be vectors!")
             return x
         lb = promote(lb)
@@ -598,6 +1319,7 @@ class ControlSolver(object):
         self.__con = cat(self.__con, newcon)
         self.__conlb = cat(self.__conlb, lb)
         self.__conub = cat(self.__conub, ub)
+        self.__structure = None
         
         self.__changed = True
 
@@ -610,5 +1332,236 @@ class ControlSolver(object):
         if not hasattr(newobj, "shape") or newobj.shape() != (1, 1):
             raise ValueError("newobj must be a scalar expression!")
         self.__obj = self.__obj + newobj
+        self.__structure = None
         self.__changed = True
         
+
+
+# Options to silence the various QP solvers for low verbosity.
+_QUIET_QP_OPTIONS = util.ReadOnlyDict({
+    "qpoases" : {"printLevel" : "none"},
+    "qrqp" : {"print_iter" : False, "print_header" : False,
+              "print_info" : False},
+    "osqp" : {"osqp" : {"verbose" : False}},
+    "highs" : {"highs" : {"output_flag" : False}},
+})
+
+class LinearControlSolver(object):
+    """
+    Solver for QPs with constant sparse matrices, e.g., from tools.lmpc.
+    
+    The problem is
+    
+        min 0.5*(z - p)'*H*(z - p)
+        s.t. conlb <= A*z <= conub, lb <= z <= ub
+    
+    with z = var.cat and p = par.cat (or zero if par is None). Thus, par
+    must have the same layout as var. H and A can be any scipy.sparse
+    matrices (or numpy arrays). Since they are constant, the QP solver is
+    created only once, and changing bounds, parameters, or the guess is
+    just new numeric data for the next solve.
+    
+    The interface mirrors ControlSolver, i.e., var, vardict, obj, stats,
+    guess, lb, ub, par, fixvar, saveguess, and solve all work the same way,
+    and callSolver can be used. Note that var, lb, ub, guess, par, conlb,
+    and conub are util.StageStruct objects rather than casadi structs.
+    """
+    
+    @property
+    def var(self):
+        return self.__var
+    
+    @property
+    def vardict(self):
+        return util.casadiStruct2numpyDict(self.__var)
+    
+    @property
+    def obj(self):
+        return self.__objval
+    
+    @property
+    def lb(self):
+        return self.__lb
+    
+    @property
+    def ub(self):
+        return self.__ub
+    
+    @property
+    def guess(self):
+        return self.__guess
+    
+    @property
+    def defaultguess(self):
+        return self.__defaultguess
+    
+    @property
+    def par(self):
+        return self.__par
+    
+    @property
+    def conlb(self):
+        return self.__conlb
+    
+    @property
+    def conub(self):
+        return self.__conub
+    
+    @property
+    def stats(self):
+        return self.__stats
+    
+    @property
+    def solver(self):
+        return self.__solvername
+    
+    @property
+    def misc(self):
+        return self.__misc
+    
+    @property
+    def verbosity(self):
+        return self.__verbosity
+    
+    @verbosity.setter
+    def verbosity(self, v):
+        v = min(min(max(v, -1), 12), _MAX_VERBOSITY)
+        if self.__solver is not None and (v < 3) != (self.__verbosity < 3):
+            self.__solver = None # Need to change print options.
+        self.__verbosity = v
+    
+    @property
+    def H(self):
+        return self.__H
+    
+    @property
+    def A(self):
+        return self.__A
+    
+    def __init__(self, var, H, A, con, lb=None, ub=None, guess=None,
+                 par=None, solver="qrqp", verbosity=5, solveroptions=None,
+                 misc=None, name="LinearControlSolver"):
+        """
+        Initialize the solver.
+        
+        var and con should be util.StageStructs giving the layout of the
+        variables and the rows of A. lb, ub, and guess default to -inf, inf,
+        and 0. con gives the initial values of conlb and conub. solver can be
+        any Casadi QP plugin, and solveroptions are passed to casadi.conic.
+        """
+        self.__var = var()
+        self.__H = scipy.sparse.csc_matrix(H, dtype=float)
+        self.__A = scipy.sparse.csc_matrix(A, dtype=float)
+        if self.__H.shape != (var.size, var.size):
+            raise ValueError("H must be %d by %d!" % (var.size, var.size))
+        if self.__A.shape != (con.size, var.size):
+            raise ValueError("A must be %d by %d!" % (con.size, var.size))
+        if par is not None and par.size != var.size:
+            raise ValueError("par must be the same size as var!")
+        self.__lb = var(-np.inf) if lb is None else lb.copy()
+        self.__ub = var(np.inf) if ub is None else ub.copy()
+        self.__guess = var(0) if guess is None else guess.copy()
+        self.__defaultguess = self.__guess.copy()
+        self.__par = None if par is None else par.copy()
+        self.__conlb = con.copy()
+        self.__conub = con.copy()
+        self.__solvername = solver
+        self.__solver = None
+        self.__verbosity = verbosity
+        self.verbosity = verbosity
+        self.name = name
+        self.solveroptions = {} if solveroptions is None else solveroptions
+        self.__misc = util.ReadOnlyDict(**({} if misc is None else misc))
+        self.__stats = {}
+        self.__objval = None
+    
+    def initialize(self):
+        """Creates the Casadi QP solver."""
+        self.__Hdm = util.sparseDM(self.__H)
+        self.__Adm = util.sparseDM(self.__A)
+        options = {"print_time" : self.verbosity > 2, "error_on_fail" : False}
+        if self.verbosity < 3:
+            options.update(_QUIET_QP_OPTIONS.get(self.__solvername, {}))
+        options.update(self.solveroptions)
+        self.__solver = casadi.conic(self.name, self.__solvername,
+                                     {"h" : self.__Hdm.sparsity(),
+                                      "a" : self.__Adm.sparsity()}, options)
+    
+    def solve(self):
+        """
+        Solve the current QP.
+        """
+        starttime = time.time()
+        if self.__solver is None:
+            self.initialize()
+        p = self.__par.cat if self.__par is not None else 0*self.__var.cat
+        Hp = self.__H.dot(p)
+        args = dict(h=self.__Hdm, a=self.__Adm, g=-Hp, lbx=self.__lb.cat,
+                    ubx=self.__ub.cat, lba=self.__conlb.cat,
+                    uba=self.__conub.cat, x0=self.__guess.cat)
+        if self.verbosity <= -1:
+            printcontext = util.stdout_redirected
+        else:
+            printcontext = util.dummy_context
+        with printcontext():
+            sol = self.__solver(**args)
+            stats = self.__solver.stats()
+        self.__var.cat[:] = np.array(sol["x"], dtype=float).flatten()
+        self.__objval = float(sol["cost"]) + 0.5*p.dot(Hp)
+        endtime = time.time()
+        
+        status = stats.get("return_status", "UNKNOWN")
+        if self.verbosity > 0:
+            print("Solver Status:", status)
+        if self.verbosity > 1:
+            print("Took %g s." % (endtime - starttime,))
+        self.__stats["status"] = status
+        self.__stats["success"] = bool(stats.get("success", False))
+        self.__stats["time"] = endtime - starttime
+        self.__stats["iter_count"] = stats.get("iter_count", None)
+    
+    def timegrid(self):
+        """Returns [Delta, t] as in ControlSolver.timegrid."""
+        return util._timegrid(self.__misc.get("Delta", 1),
+                              self.__misc["N"]["t"])
+    
+    def fixvar(self, var, t, val, indices=None):
+        """
+        Fixes variable var at time t to val.
+        
+        Indices can be specified as a list to fix only a subset of values.
+        """
+        for s in [self.__lb, self.__ub, self.__guess]:
+            if indices is None:
+                s[var,t] = val
+            else:
+                s[var,t,indices] = val
+    
+    def saveguess(self, newguess=None, toffset=None, default=False):
+        """
+        Stores a guess, optionally shifted by toffset time points.
+        
+        As in ControlSolver, newguess can be a dictionary of arrays with time
+        along the first dimension (toffset defaults to 0), or default=True
+        reverts to the default guess (toffset defaults to 0). Otherwise, the
+        guess is taken from self.var with toffset defaulting to 1. Missing
+        time points are filled from the first or last given entry.
+        """
+        if newguess is None:
+            if default:
+                newguess = self.__defaultguess
+                toffset = 0 if toffset is None else toffset
+            else:
+                newguess = self.__var
+                toffset = 1 if toffset is None else toffset
+            newguess = util.casadiStruct2numpyDict(newguess)
+        elif toffset is None:
+            toffset = 0
+        for k in self.__guess.keys():
+            if k not in newguess:
+                continue
+            val = np.array(newguess[k], dtype=float)
+            val = val.reshape((val.shape[0], -1))
+            T = len(self.__guess[k])
+            index = np.clip(np.arange(T) + toffset, 0, val.shape[0] - 1)
+            self.__guess[k] = val[index,:]
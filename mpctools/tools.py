@@ -1,6 +1,13 @@
 import numpy as np
+import scipy.sparse
 import casadi
 import casadi.tools as ctools
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import types
 import warnings
 
 # Other things from our package.
@@ -17,6 +24,10 @@ Functions for solving MPC problems using Casadi and Ipopt.
 # disable the warning via this constant (see __getCasadiFunc).
 WARN_NUMPY_MX = True
 
+# Directory for the persistent cache of getCasadiFunc, or None to disable it
+# (unless a directory is passed to getCasadiFunc directly).
+CASADIFUNC_CACHE = None
+
 # =================================
 # MPC and MHE
 # =================================
@@ -28,8 +39,9 @@ WARN_NUMPY_MX = True
 def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
          Pf=None, sp={}, p=None, uprev=None, verbosity=5, timelimit=60,
          Delta=None, funcargs={}, extrapar={}, e=None, ef=None, periodic=False,
-         discretel=True, isQP=False, casaditype="SX", infercolloc=None,
-         solver=None, udiscrete=None, inferargs=False):
+         discretel=True, isQP=None, casaditype="SX", infercolloc=None,
+         solver=None, udiscrete=None, inferargs=False, blocks=None,
+         shooting="multiple", scaling=None, horizon=None, eliminatez=False):
     """
     Solves nonlinear MPC problem.
     
@@ -43,7 +55,9 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
     that may have weird sizes (e.g., a terminal penalty matrix that you may
     want to change), specify the numerical value in an entry of extrapar. Note
     that the names in extrapar must not conflict with default variable names
-    like 'u', 'u_sp', 'Du', etc.
+    like 'u', 'u_sp', 'Du', etc. Any symbolic constants in the model functions
+    (see the constants argument of getCasadiFunc) are added to extrapar with
+    their nominal values unless they are already present.
     
     lb and ub should be dictionaries of bounds for the various variables. Each
     entry should have time as the first index (i.e. lb["x"] should be a
@@ -85,11 +99,77 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
     
     solver is a string specifying which solver to use. By default, the solver
     is chosen based on the problem type: qpoases if isQP, bonmin if any
-    component of u is discrete, and ipopt otherwise.    
+    component of u is discrete, and ipopt otherwise. If isQP is None (the
+    default), the problem is checked for a quadratic objective and linear
+    constraints after it is built, and any constant derivatives found are
+    declared to ipopt. Set isQP=False to skip this check, or set
+    solver="auto" to also use qpoases for QPs.
     
     udiscrete should be an Nu vector of True and False to say whether u has
     any discrete components. Note that this setting is not supported for all
     solvers.    
+
+    Delta gives the length of each time interval. It can be a scalar or a
+    vector with N["t"] entries for a non-uniform time grid, e.g., with fine
+    steps near the present and coarse steps far in the future. If N["c"] is
+    given, f is taken to be continuous-time and is discretized with
+    collocation on each interval (see adaptivecolloc for automatic
+    refinement). Otherwise, f is discrete-time, and to use a non-uniform
+    grid, f (or any other function) can take the timestep for each stage as
+    a parameter "Delta" in funcargs. getCasadiFunc with rk4=True and
+    Delta=None gives such a model. The parameter "Delta" is only present for
+    discrete-time models with a vector Delta or with functions that take a
+    "Delta" argument, and changing it changes the grid used by saveguess and
+    callSolver.
+    
+    For move blocking, set blocks to a list of block lengths. u is then held
+    constant over each block, with only one decision variable per block,
+    which gives a smaller NLP than adding equality constraints. If the blocks
+    cover fewer than N["t"] stages, the last block is extended. Bounds and
+    guesses for u (and Du) can be given either per stage or per block. Note
+    that solver.var["u"] then has one entry per block, while callSolver
+    expands u back to one entry per stage.
+    
+    By default, the problem uses multiple shooting, i.e., every x(t) is a
+    decision variable, and the model is included as equality constraints.
+    For discrete-time models, shooting="single" instead eliminates all states
+    after x(0) by forward simulation, while an integer shooting=k keeps every
+    kth state as a shooting node (partial condensing). Eliminated states are
+    computed with mapaccum, and any bounds on them become nonlinear
+    constraints. This gives a much smaller NLP for problems with few states
+    and long horizons. Note that solver.var["x"] then only contains the
+    shooting nodes, while callSolver returns x at every stage.
+    
+    For least-squares stage costs, l can instead be given as a tuple (r, W)
+    with r a Casadi Function giving a residual vector and W a positive
+    semidefinite weight matrix, so that the stage cost is r'*W*r. The solver
+    then uses a Gauss-Newton Hessian approximation for these terms, which
+    avoids second derivatives of the model and often converges better for
+    tracking problems. Set solver.hessian = "exact" to use the exact Hessian.
+    
+    For badly scaled problems, set scaling=True to scale variables by nominal
+    values inferred from their (finite) bounds or guess, and to scale
+    constraints by their derivatives at the guess. scaling can also be a
+    dictionary of nominal values with the same structure as lb, with any
+    missing variables inferred. Solutions are always in the original units.
+    
+    For shrinking (or growing) horizons, set horizon to the initial number of
+    active stages (at most N["t"]). The problem is then built once at the
+    maximum horizon with an extra parameter "horizon", which can be changed
+    via solver.par["horizon"] without rebuilding. Stage costs and path
+    constraints after the active horizon are masked, and Pf, ef, and bounds
+    on xf are applied at the end of the active horizon. Bounds on x, z, and u
+    that can fall after the active horizon become masked constraints, so the
+    remaining states still follow the model but are otherwise free, and
+    saveguess fills them from the end of the active horizon. The value of
+    par["horizon"] is checked when the solver is called.
+    
+    For DAE models, set eliminatez=True to remove the algebraic states z from
+    the NLP. z is then computed by a Newton rootfinder for g = 0 in each call
+    to f (and e or l if they take z), starting from guess["z"] (or zero), and
+    derivatives are given by the implicit function theorem. This gives a
+    much smaller NLP, especially with collocation, but z must not have
+    bounds, and the problem is built with casaditype="MX".
     
     The return value is a ControlSolver object. To actually solve the
     optimization, use ControlSolver.solve().
@@ -98,6 +178,7 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
     N = N.copy()
     guess = guess.copy()
     funcargs = funcargs.copy()
+    [l, lsq] = __residualfunc(l)
     
     # Also, make sure certain inputs are dictionaries of numpy arrays. This
     # also forces a copy, so we don't have to worry about modifying the user's
@@ -107,8 +188,39 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
     guess = util.ArrayDict(guess)
     sp = util.ArrayDict(sp)
     extrapar = util.ArrayDict(extrapar)
+    __addconstants(extrapar, f, g, l, e, Pf, ef)
     if infercolloc is None:
         infercolloc = ("x" in guess and "xc" not in guess)
+    
+    # Eliminate algebraic states by solving g = 0 in each function call.
+    if eliminatez:
+        if g is None or N.get("z", 0) <= 0:
+            raise ValueError("Must provide g and N['z'] to eliminate z!")
+        if "z" in lb or "z" in ub:
+            raise ValueError("z cannot have bounds if it is eliminated!")
+        zguess = np.array(guess.pop("z", np.zeros(N["z"])), dtype=float)
+        zguess = zguess.reshape((-1, N["z"]))[0,:]
+        funcs = dict(f=f, g=g, e=e, l=l)
+        defaultargs = dict(f=["x","z","u","p"], g=["x","z","p"],
+                           e=["x","z","u","p"], l=[])
+        zargs = {}
+        for (k, func) in funcs.items():
+            if func is None:
+                continue
+            elif k in funcargs:
+                zargs[k] = list(funcargs[k])
+            elif inferargs:
+                zargs[k] = __getargnames(func)
+            else:
+                zargs[k] = ([a for a in defaultargs[k] if N.get(a, 0) > 0]
+                            + __constantargs(func))
+        g = funcs.pop("g")
+        [funcs, newargs] = __eliminatez(funcs, zargs, g, zargs["g"], zguess)
+        (f, e, l) = (funcs["f"], funcs["e"], funcs["l"])
+        funcargs.update(newargs)
+        N.pop("z")
+        g = None
+        casaditype = "MX"
    
     # Check specified sizes.
     try:
@@ -133,6 +245,45 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
                                         extra=extraparshapes)
     if "c" not in N:
         N["c"] = 0
+    # Timesteps are a parameter only if a discrete-time model can use them,
+    # i.e., Delta is a vector or some function takes a "Delta" argument.
+    # With collocation, Delta is used numerically when building the problem.
+    deltapar = (Delta is not None and N["c"] == 0
+                and (np.size(Delta) > 1
+                     or any("Delta" in args for args in funcargs.values())
+                     or any("Delta" in __getargnames(func)
+                            for func in [f, l, e, Pf, ef, g])))
+    if deltapar:
+        if "Delta" in allShapes:
+            raise KeyError("Extra parameter 'Delta' shadows the per-stage "
+                           "timestep parameter. Please choose a different "
+                           "name.")
+        [Deltas, _] = util._timegrid(Delta, N["t"])
+        allShapes["Delta"] = {"repeat" : N["t"], "shape" : (1, 1)}
+    if blocks is not None:
+        blocks = __getblocks(blocks, N["t"])
+        blockVars = ["u"] + ["D" + k for k in deltaVars]
+        for v in blockVars:
+            allShapes[v]["repeat"] = len(blocks)
+        __blockdata([lb, ub, guess], blockVars, blocks, N["t"], allShapes)
+    else:
+        blockVars = None
+    
+    # For a variable horizon, bounds on xf become constraints at the end.
+    if horizon is not None:
+        if periodic:
+            raise ValueError("Variable horizons cannot be periodic!")
+        if "horizon" in allShapes:
+            raise KeyError("Extra parameter 'horizon' shadows a reserved "
+                           "name. Please choose a different name.")
+        horizon = int(horizon)
+        if horizon < 1 or horizon > N["t"]:
+            raise ValueError("horizon must be between 1 and N['t']!")
+        allShapes["horizon"] = {"repeat" : 1, "shape" : (1, 1)}
+        xfbounds = [np.array(d.pop("xf", v*np.ones(N["x"])),
+                             dtype=float).flatten()
+                    for (d, v) in [(lb, -np.inf), (ub, np.inf)]]
+        guess.pop("xf", None)
     
     # Sort out bounds on x0 and xf.
     for (d,v) in [(lb,-np.inf), (ub,np.inf), (guess,0)]:
@@ -158,10 +309,31 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
                     raise ValueError("Incorrect size for xf.")
                 d["x"][-1,...] = xf
     
+    # Choose shooting nodes.
+    if shooting == "multiple":
+        shooting = None
+    else:
+        if N["c"] > 0 or "z" in allShapes or periodic:
+            raise ValueError("Single shooting and condensing are only "
+                             "available for discrete-time models without z!")
+        k = N["t"] if shooting == "single" else int(shooting)
+        if k <= 0:
+            raise ValueError("shooting must be 'multiple', 'single', or a "
+                             "positive integer!")
+        nodes = np.arange(0, N["t"], k)
+        xbounds = []
+        for d in [lb, ub, guess]:
+            x = np.array(d["x"], dtype=float).reshape((-1, N["x"]))
+            if x.shape[0] == 1:
+                x = np.tile(x, (N["t"] + 1, 1))
+            xbounds.append(x)
+            d["x"] = x[nodes,:]
+        allShapes["x"]["repeat"] = len(nodes)
+    
     # Build Casadi symbolic structures. These need to be separate because one
     # is passed as a set of variables and one is a set of parameters. Note that
     # if this ends up empty, we just set it to None.
-    parNames = set(["p"] + [k + "_sp" for k in sp]
+    parNames = set(["p", "Delta", "horizon"] + [k + "_sp" for k in sp]
         + [k + "_prev" for k in deltaVars] + list(extrapar))
     parStruct = __casadiSymStruct(allShapes, parNames, casaditype)
     if len(parStruct.keys()) == 0:
@@ -173,6 +345,10 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
 
     # Add parameters and setpoints to the guess structure.
     guess["p"] = p
+    if deltapar:
+        guess["Delta"] = Deltas[:,np.newaxis]
+    if horizon is not None:
+        guess["horizon"] = horizon
     for v in sp:
         guess[v + "_sp"] = sp[v]
     if uprev is not None:
@@ -196,16 +372,51 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
     if udiscrete is not None:
         discretevar["u"] = udiscrete
     
+    # Eliminate states for single shooting or condensing. Terminal functions
+    # then need the eliminated final state.
+    terminalstructs = [varStruct, parStruct]
+    if shooting is not None:
+        if "f" not in funcargs:
+            if inferargs:
+                funcargs["f"] = __getargnames(f)
+            else:
+                funcargs["f"] = [k for k in ["x","z","u","w","p"]
+                                 if k in allShapes] + __constantargs(f)
+        stagestruct = {}
+        for struct in [varStruct, parStruct]:
+            if struct is not None:
+                stagestruct.update({k : struct[k] for k in struct.keys()})
+        if blocks is not None:
+            __expandblocks(stagestruct, blocks, blockVars)
+        hsym = None if horizon is None else parStruct["horizon",0]
+        [xstages, shootcon, shootlb, shootub] = __shootingstates(f,
+            funcargs["f"], stagestruct, nodes, N["t"], *xbounds[:2],
+            horizon=hsym)
+        shooting = dict(nodes=nodes, x=xstages)
+        terminalstructs.insert(0, {"x" : xstages})
+    
+    # Terminal functions see the end of the active horizon.
+    if horizon is not None:
+        final = [parStruct["horizon",0] == t for t in range(N["t"] + 1)]
+        terminal = {}
+        for k in ["x", "x_sp"]:
+            for struct in terminalstructs:
+                if struct is not None and k in struct.keys():
+                    terminal[k] = [sum(final[t]*struct[k][t]
+                                       for t in range(N["t"] + 1))]
+                    break
+        terminalstructs.insert(0, terminal)
+    
     # Make initial objective term.    
     if Pf is not None:
         if "Pf" not in funcargs:
             if inferargs:
                 funcargs["Pf"] = __getargnames(Pf)
             elif "x" in sp:
-                funcargs["Pf"] = ["x", "x_sp"]
+                funcargs["Pf"] = ["x", "x_sp"] + __constantargs(Pf)
             else:
-                funcargs["Pf"] = ["x"]
-        args = __getArgs(funcargs["Pf"], N["t"], varStruct, parStruct)
+                funcargs["Pf"] = ["x"] + __constantargs(Pf)
+        args = __getArgs(funcargs["Pf"], N["t"], *terminalstructs)
         obj = Pf(*args)
     else:
         obj = None
@@ -217,7 +428,7 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
                 funcargs["ef"] = __getargnames(ef)    
             else:
                 raise KeyError("Must provide an 'ef' entry in funcargs!")
-        args = __getArgs(funcargs["ef"], N["t"], varStruct, parStruct)
+        args = __getArgs(funcargs["ef"], N["t"], *terminalstructs)
         con = [ef(*args)]
         Nef = np.prod(con[0].shape) # Figure out number of entries.
         conlb = -np.inf*np.ones((Nef,))
@@ -226,6 +437,21 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
         con = None
         conlb = None
         conub = None
+    if shooting is not None or horizon is not None:
+        if con is None:
+            con = []
+            conlb = np.array([])
+            conub = np.array([])
+    if shooting is not None:
+        con += shootcon
+        conlb = np.concatenate([conlb, shootlb])
+        conub = np.concatenate([conub, shootub])
+    if horizon is not None:
+        finite = np.isfinite(xfbounds[0]) | np.isfinite(xfbounds[1])
+        if np.any(finite):
+            con.append(terminal["x"][0][np.flatnonzero(finite).tolist()])
+            conlb = np.concatenate([conlb, xfbounds[0][finite]])
+            conub = np.concatenate([conub, xfbounds[1][finite]])
     
     # Decide arguments of l.
     if "l" not in funcargs and not inferargs:
@@ -234,7 +460,7 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
             largs.append("x_sp")
         if "u" in sp:
             largs.append("u_sp")
-        funcargs["l"] = largs
+        funcargs["l"] = largs + __constantargs(l)
     
     # Pick solver.
     if solver is None:
@@ -255,12 +481,231 @@ def nmpc(f=None, l=None, N={}, x0=None, lb={}, ub={}, guess={}, g=None,
                   deltaVars=deltaVars, isQP=isQP,
                   casaditype=casaditype, discretel=discretel,
                   infercolloc=infercolloc, solver=solver,
-                  discretevar=discretevar, inferargs=inferargs)
+                  discretevar=discretevar, inferargs=inferargs, blocks=blocks,
+                  blockVars=blockVars, shooting=shooting, scaling=scaling,
+                  lsq=lsq, horizon=(horizon is not None))
     return __optimalControlProblem(*args, **kwargs)
 
+
+def __shootingstates(f, fargs, struct, nodes, Nt, lbx, ubx, horizon=None):
+    """
+    Eliminates states between shooting nodes by forward simulation.
+    
+    struct["x"] should have one entry per node, and other entries should have
+    one entry per stage (or a single entry). Each segment between nodes is
+    simulated with a single call to f.mapaccum.
+    
+    Returns [xstages, con, conlb, conub] with xstages a list of Nt + 1 state
+    expressions, and con a list of constraints for continuity at the nodes
+    and for any finite bounds lbx and ubx on the eliminated states. If
+    horizon is a symbolic number of active stages, bounds after the active
+    horizon are masked (see __maskedbound).
+    """
+    ix = list(fargs).index("x")
+    simulators = {}
+    xstages = []
+    con = []
+    for (i, start) in enumerate(nodes):
+        stop = nodes[i + 1] if i + 1 < len(nodes) else Nt
+        L = stop - start
+        if L not in simulators:
+            simulators[L] = f.mapaccum("%s_%d" % (f.name(), L), L, [ix], [0])
+        args = []
+        for a in fargs:
+            if a == "x":
+                args.append(struct["x"][i])
+            elif len(struct[a]) == 1:
+                args.append(struct[a][0])
+            else:
+                args.append(casadi.horzcat(*struct[a][start:stop]))
+        xseg = casadi.horzsplit(simulators[L](*args))
+        xstages += [struct["x"][i]] + xseg[:-1]
+        if i + 1 < len(nodes):
+            con.append(struct["x"][i + 1] - xseg[-1])
+        else:
+            xstages.append(xseg[-1])
+    conlb = [np.zeros(lbx.shape[1]*len(con))]
+    conub = [np.zeros(lbx.shape[1]*len(con))]
+    
+    # Bounds on eliminated states become constraints.
+    for t in sorted(set(range(Nt + 1)).difference(nodes)):
+        finite = np.flatnonzero(np.isfinite(lbx[t]) | np.isfinite(ubx[t]))
+        if len(finite) > 0:
+            xt = xstages[t][list(finite)]
+            if horizon is not None and t > 1:
+                xt = __maskedbound(horizon >= t, xt, lbx[t,finite],
+                                   ubx[t,finite])
+            con.append(xt)
+            conlb.append(lbx[t,finite])
+            conub.append(ubx[t,finite])
+    return [xstages, con, np.concatenate(conlb), np.concatenate(conub)]
+
+
+def __maskedbound(active, v, lb, ub):
+    """
+    Returns an expression that must be in [lb, ub] only if active is 1.
+    
+    active should be a symbolic 0/1 mask. When it is zero, v is replaced by
+    the point in [lb, ub] closest to zero, so the bounds are satisfied for
+    any value of v.
+    """
+    c = casadi.DM(np.clip(0, lb, ub))
+    return active*v + (1 - active)*c
+
+
+def __expandblocks(struct, blocks, blockVars):
+    """
+    Expands move-blocked variables in struct to one entry per stage.
+    
+    Names starting with "D" are taken to be differences, which are zero
+    except at the first stage of each block. Returns the block index of each
+    stage.
+    """
+    index = np.repeat(np.arange(len(blocks)), blocks)
+    first = np.concatenate(([True], index[1:] != index[:-1]))
+    for v in blockVars:
+        if v.startswith("D"):
+            zero = 0*struct[v][0]
+            struct[v] = [struct[v][i] if isfirst else zero
+                         for (i, isfirst) in zip(index, first)]
+        else:
+            struct[v] = [struct[v][i] for i in index]
+    return index
+
+
+def __residualfunc(l):
+    """
+    Converts a least-squares cost (r, W) to a weighted residual Function.
+    
+    The returned Function gives L*r with W = L'*L, so the cost is the sum of
+    squares of its output. Returns [func, True] for a tuple (r, W), and
+    [l, False] otherwise.
+    """
+    if not isinstance(l, tuple):
+        return [l, False]
+    (r, W) = l
+    W = np.atleast_2d(np.array(W, dtype=float))
+    [w, V] = np.linalg.eigh(0.5*(W + W.T))
+    if np.min(w, initial=0) < -1e-10*np.max(np.abs(w), initial=1):
+        raise ValueError("W must be positive semidefinite!")
+    L = np.sqrt(np.maximum(w, 0))[:,np.newaxis]*V.T
+    args = r.sx_in() if r.is_a("SXFunction") else r.mx_in()
+    func = casadi.Function(r.name(), args, [casadi.mtimes(L, r(*args))],
+                           r.name_in(), ["r"])
+    if hasattr(r, "constants"):
+        func.constants = r.constants
+    return [func, True]
+
+
+def __addconstants(extrapar, *funcs):
+    """
+    Adds nominal values of symbolic constants in funcs to extrapar.
+    
+    Values already in extrapar are not changed (see getCasadiFunc).
+    """
+    for func in funcs:
+        for (k, v) in getattr(func, "constants", {}).items():
+            if k not in extrapar:
+                extrapar[k] = v
+
+
+def __constantargs(func):
+    """
+    Returns the names of the symbolic constants of func (see getCasadiFunc).
+    
+    These come after any other arguments, so they are added to the default
+    funcargs for each function.
+    """
+    return list(getattr(func, "constants", {}))
+
+
+def __eliminatez(funcs, funcargs, g, gargs, zguess):
+    """
+    Replaces algebraic states z in funcs by the solution of g(...) = 0.
+    
+    funcs is a dictionary of Casadi Functions (or None) whose argument names
+    are in the corresponding entries of funcargs, and gargs gives the
+    argument names of g. z is computed in each call by a Newton rootfinder
+    starting from zguess.
+    
+    Returns [newfuncs, newargs]. Functions that take z are replaced by MX
+    Functions without z (but with any other arguments of g), and newargs
+    gives their new argument names.
+    """
+    if "z" not in gargs:
+        raise ValueError("g must take z as an argument!")
+    sizes = {}
+    for (k, func) in list(funcs.items()) + [("g", g)]:
+        if func is not None:
+            args = gargs if k == "g" else funcargs[k]
+            for (i, a) in enumerate(args):
+                sizes[a] = func.size_in(i)
+    symbols = {a : casadi.MX.sym(a, *s) for (a, s) in sizes.items()}
+    gother = [a for a in gargs if a != "z"]
+    G = casadi.Function("g", [symbols[a] for a in ["z"] + gother],
+                        [g(*[symbols[a] for a in gargs])])
+    zsolver = casadi.rootfinder("zsolver", "newton", G)
+    values = symbols.copy()
+    values["z"] = zsolver(zguess, *[symbols[a] for a in gother])
+    
+    # Wrap each function that takes z.
+    newfuncs = {}
+    newargs = {}
+    for (k, func) in funcs.items():
+        if func is None or "z" not in funcargs[k]:
+            newfuncs[k] = func
+            continue
+        args = ([a for a in funcargs[k] if a != "z"]
+                + [a for a in gother if a not in funcargs[k]])
+        out = func.call([values[a] for a in funcargs[k]])
+        newfuncs[k] = casadi.Function(func.name(), [symbols[a] for a in args],
+                                      out, args, func.name_out())
+        if hasattr(func, "constants"):
+            newfuncs[k].constants = func.constants
+        newargs[k] = args
+    return [newfuncs, newargs]
+
+
+def __getblocks(blocks, Nt):
+    """
+    Returns a list of block lengths that covers exactly Nt stages.
+    """
+    blocks = [int(b) for b in blocks]
+    if any(b <= 0 for b in blocks):
+        raise ValueError("Block lengths must be positive!")
+    total = sum(blocks)
+    if total > Nt:
+        raise ValueError("Blocks cover %d stages, but N['t'] is %d!"
+                         % (total, Nt))
+    elif total < Nt:
+        blocks[-1] += Nt - total
+    return blocks
+
+
+def __blockdata(dicts, blockVars, blocks, Nt, shapes):
+    """
+    Converts per-stage bounds and guesses to per-block values in place.
+    
+    dicts should be [lb, ub, guess]. Within each block, the tightest bounds
+    are used, while guesses are taken from the first stage.
+    """
+    starts = np.cumsum([0] + blocks[:-1])
+    reducers = [np.maximum.reduceat, np.minimum.reduceat, None]
+    for (d, reduce) in zip(dicts, reducers):
+        for v in set(blockVars).intersection(d):
+            val = d[v]
+            shape = shapes[v]["shape"]
+            if val.shape in [shape, shape[:1]] or val.shape[0] != Nt:
+                continue # Not per-stage.
+            if reduce is None:
+                d[v] = val[starts,...]
+            else:
+                d[v] = reduce(val, starts, axis=0)
+
 def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
          p=None, verbosity=5, largs=None, funcargs={}, timelimit=60, Delta=None,
-         wAdditive=False, casaditype="SX", inferargs=False, extrapar={}):
+         wAdditive=False, casaditype="SX", inferargs=False, extrapar={},
+         scaling=None):
     """
     Solves nonlinear MHE problem.
     
@@ -283,11 +728,18 @@ def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
         
     Otherwise, the model must take a "w" argument.
     
+    As in nmpc, Delta can be a vector with N["t"] entries when using
+    collocation, and scaling can be True or a dictionary of nominal values.
+    Both l and lx can also be given as least-squares tuples (r, W) to use a
+    Gauss-Newton Hessian approximation.
+    
     The return value is a ControlSolver object.
     """
     # Copy dictionaries so we don't change the user inputs.
     N = N.copy()
     funcargs = funcargs.copy()
+    [l, lsq] = __residualfunc(l)
+    [lx, lxlsq] = __residualfunc(lx)
     
     # Also make sure some things are arrays of numpy dicts.
     lb = util.ArrayDict(lb)
@@ -308,7 +760,8 @@ def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
         raise KeyError("Invalid or missing entries in N dictionary!")
     
     # Handle prior for x0bar.
-    extrapar = extrapar.copy()    
+    extrapar = extrapar.copy()
+    __addconstants(extrapar, f, g, h, l, lx)
     if lx is not None or x0bar is not None:
         if lx is None or x0bar is None:
             raise ValueError("Both or none of lx and x0bar must be given!")
@@ -351,7 +804,8 @@ def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
     
     # Make initial objective term.
     if "l" not in funcargs:
-        funcargs["l"] = __getargnames(l) if inferargs else ["w", "v"]
+        funcargs["l"] = (__getargnames(l) if inferargs
+                         else ["w", "v"] + __constantargs(l))
     finallargs = []   
     for k in funcargs["l"]:
         if k == "w":
@@ -362,7 +816,9 @@ def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
             finallargs.append(varStruct[k,-1])
         else:
             raise KeyError("l argument %s is invalid!" % k)
-    obj = l(*finallargs)  
+    obj = []
+    residual = []
+    (residual if lsq else obj).append(l(*finallargs))
     if includeprior:
         lxargs = funcargs.get("lx", None)
         if lxargs is None and inferargs:
@@ -370,8 +826,10 @@ def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
         if lxargs is not None:
             args = __getArgs(lxargs, 0, varStruct, parStruct)
         else:
-            args = [varStruct["x",0] - parStruct["x0bar",0]]
-        obj += lx(*args)
+            args = ([varStruct["x",0] - parStruct["x0bar",0]]
+                    + __getArgs(__constantargs(lx), 0, parStruct))
+        (residual if lxlsq else obj).append(lx(*args))
+    obj = sum(obj[1:], obj[0]) if len(obj) > 0 else None
     
     # Decide if w is inside the model or additive.
     fErrorVars = []    
@@ -381,14 +839,15 @@ def nmhe(f, h, u, y, l, N, lx=None, x0bar=None, lb={}, ub={}, guess={}, g=None,
     kwargs = dict(f=f, g=g, h=h, l=l, funcargs=funcargs, Delta=Delta,
                   verbosity=verbosity, casaditype=casaditype,
                   timelimit=timelimit, fErrorVars=fErrorVars,
-                  inferargs=inferargs)
+                  inferargs=inferargs, scaling=scaling, lsq=lsq,
+                  residual=residual)
     return __optimalControlProblem(*args, **kwargs)
 
 
 def sstarg(f, h, N, phi=None, lb={}, ub={}, guess={}, g=None, p=None,
            funcargs={}, extrapar={}, e=None, discretef=True, verbosity=5,
            timelimit=60, casaditype="SX", inferargs=False, udiscrete=None,
-           ignoress=None):
+           ignoress=None, scaling=None):
     """
     Solves nonlinear steady-state target problem.
     
@@ -411,7 +870,8 @@ def sstarg(f, h, N, phi=None, lb={}, ub={}, guess={}, g=None, p=None,
     lb = util.ArrayDict(lb)
     ub = util.ArrayDict(ub)
     guess = util.ArrayDict(guess)
-    extrapar = util.ArrayDict(extrapar)       
+    extrapar = util.ArrayDict(extrapar)
+    __addconstants(extrapar, f, g, h, e, phi)
     
     # Check specified sizes.
     try:
@@ -476,6 +936,8 @@ def sstarg(f, h, N, phi=None, lb={}, ub={}, guess={}, g=None, p=None,
                 dx -= args[xind]
             return util.mtimes(mask, dx)
         f = getCasadiFunc(wrappedf, wraps=_f)
+        if hasattr(_f, "constants"):
+            f.constants = _f.constants
         discretef = False
     
     # Make objective term.
@@ -501,22 +963,350 @@ def sstarg(f, h, N, phi=None, lb={}, ub={}, guess={}, g=None, p=None,
     kwargs = dict(f=f, g=g, h=h, funcargs=funcargs, verbosity=verbosity,
                   discretef=discretef, finalpoint=False, casaditype=casaditype,
                   timelimit=timelimit, inferargs=inferargs, e=e,
-                  discretevar=discretevar)
+                  discretevar=discretevar, scaling=scaling)
     return __optimalControlProblem(*args, **kwargs)
 
 
+def lmpc(A, B, Q, R, N, P=None, x0=None, lb={}, ub={}, sp={}, guess={},
+         E=None, F=None, solver="qrqp", verbosity=5, solveroptions=None):
+    """
+    Builds a linear MPC problem directly from matrices.
+    
+    The problem is
+    
+        min sum_t |x(t) - x_sp(t)|_Q + |u(t) - u_sp(t)|_R
+                  + |x(N) - x_sp(N)|_P
+        s.t. x(t + 1) = A*x(t) + B*u(t)
+             lb["e"] <= E*x(t) + F*u(t) <= ub["e"]
+    
+    with bounds on x and u from lb and ub, and |x|_Q = x'*Q*x. All matrices
+    can be numpy arrays or scipy.sparse matrices. N is the horizon length (or
+    a dictionary with an entry "t" as in nmpc). If P is None, there is no
+    terminal penalty, and E and F default to zero if only one is given.
+    Bounds and setpoints (with keys "x" and "u") can be given as vectors or
+    as arrays with time along the first dimension, and "xf" in lb or ub
+    gives bounds on x(N).
+    
+    The QP matrices are assembled in scipy.sparse form without any symbolic
+    expressions, so building is fast even for long horizons. The return
+    value is a solvers.LinearControlSolver, whose interface mirrors
+    ControlSolver. Since the QP matrices never change, the initial condition
+    (via fixvar), setpoints (via par["x_sp"] and par["u_sp"]), bounds (via
+    lb and ub), and bounds on the constraints (conlb and conub, with entries
+    "f" for the model and "e" for E and F) can all be updated without
+    rebuilding anything. In particular, setting conlb["f",t] and
+    conub["f",t] to d gives a disturbance x(t + 1) = A*x(t) + B*u(t) + d.
+    
+    solver can be any Casadi QP plugin. The default is qrqp, which exploits
+    sparsity and is always available. Note that qpoases uses dense matrices
+    and is slow for long horizons.
+    """
+    Nt = N["t"] if isinstance(N, dict) else int(N)
+    if Nt <= 0:
+        raise ValueError("N must be positive!")
+    [A, B, Q, R] = [scipy.sparse.csr_matrix(np.atleast_2d(M) if not
+                    scipy.sparse.issparse(M) else M, dtype=float)
+                    for M in [A, B, Q, R]]
+    (Nx, Nu) = B.shape
+    if A.shape != (Nx, Nx):
+        raise ValueError("A must be %d by %d!" % (Nx, Nx))
+    P = scipy.sparse.csr_matrix((Nx, Nx)) if P is None else P
+    if E is None and F is None:
+        Ne = 0
+    else:
+        Ne = (E if E is not None else F).shape[0]
+        E = scipy.sparse.csr_matrix((Ne, Nx)) if E is None else E
+        F = scipy.sparse.csr_matrix((Ne, Nu)) if F is None else F
+    
+    # Objective is 0.5*(z - p)'*H*(z - p) with z = [x; u].
+    Ix = scipy.sparse.diags(np.append(np.ones(Nt), 0))
+    final = scipy.sparse.csr_matrix(([1.0], ([Nt], [Nt])),
+                                    shape=(Nt + 1, Nt + 1))
+    H = 2*scipy.sparse.block_diag([scipy.sparse.kron(Ix, Q)
+                                   + scipy.sparse.kron(final, P),
+                                   scipy.sparse.kron(scipy.sparse.eye(Nt), R)])
+    H = 0.5*(H + H.T)
+    
+    # Model and mixed constraints.
+    shift = scipy.sparse.eye(Nt, Nt + 1, k=1)
+    stage = scipy.sparse.eye(Nt, Nt + 1)
+    Iu = scipy.sparse.eye(Nt)
+    rows = [[scipy.sparse.kron(shift, scipy.sparse.eye(Nx))
+             - scipy.sparse.kron(stage, A), -scipy.sparse.kron(Iu, B)]]
+    if Ne > 0:
+        rows.append([scipy.sparse.kron(stage, E), scipy.sparse.kron(Iu, F)])
+    Acon = scipy.sparse.bmat(rows, format="csc")
+    
+    # Structures and data.
+    var = util.StageStruct([("x", Nt + 1, Nx), ("u", Nt, Nu)])
+    par = util.StageStruct([("x_sp", Nt + 1, Nx), ("u_sp", Nt, Nu)])
+    con = util.StageStruct([("f", Nt, Nx)] + ([("e", Nt, Ne)] if Ne > 0
+                                               else []))
+    structs = {}
+    for (name, d, default) in [("lb", lb, -np.inf), ("ub", ub, np.inf),
+                               ("guess", guess, 0)]:
+        s = var(default)
+        for k in set(d).intersection(["x", "u"]):
+            s[k] = __stagedata(d[k], len(s[k]), k)
+        if "xf" in d:
+            s["x",Nt] = d["xf"]
+        structs[name] = s
+    for k in sp:
+        par[k + "_sp"] = __stagedata(sp[k], len(par[k + "_sp"]), k)
+    if x0 is not None:
+        for s in structs.values():
+            s["x",0] = x0
+    misc = {"N" : {"x" : Nx, "u" : Nu, "t" : Nt}}
+    controller = solvers.LinearControlSolver(var, H, Acon, con,
+                                             par=par, solver=solver,
+                                             verbosity=verbosity,
+                                             solveroptions=solveroptions,
+                                             misc=misc, **structs)
+    if Ne > 0:
+        controller.conlb["e"] = __stagedata(lb.get("e", -np.inf*np.ones(Ne)),
+                                            Nt, "e")
+        controller.conub["e"] = __stagedata(ub.get("e", np.inf*np.ones(Ne)),
+                                            Nt, "e")
+    return controller
+
+
+def __stagedata(val, T, name):
+    """
+    Returns val as a constant vector or an array with T rows.
+    """
+    val = np.array(val, dtype=float)
+    if val.ndim >= 2 and val.shape[0] != T:
+        if val.shape[0] < T:
+            raise IndexError("Too few time points for '%s'!" % (name,))
+        warnings.warn("Extra time points for '%s'. Ignoring." % (name,))
+        val = val[:T,...]
+    return val
+
+
+def ltvmpc(f, l, N, x0=None, Delta=None, fpar=(), guess={}, isQP=True,
+           **kwargs):
+    """
+    Builds a successive-linearization (LTV) MPC problem.
+    
+    f should be a nonlinear model f(x,u,...) given as a Casadi Function. If
+    Delta is None, f is taken to be discrete-time. Otherwise, f is taken to be
+    continuous-time, and each linearization is discretized exactly using
+    timestep Delta. Any arguments of f after x and u are held fixed at the
+    values given in the list fpar (e.g., for measured disturbances).
+    
+    Instead of f itself, the optimization uses the affine time-varying model
+    
+        x(t + 1) = A(t)x(t) + B(t)u(t) + c(t)
+    
+    whose matrices are stored in the time-varying parameter "p". Thus, the QP
+    is only built once, and only numerical values change between solves.
+    Before each solve, call relinearize() on the returned ControlSolver to
+    linearize f along the current guess (e.g., the previous solution shifted
+    with saveguess()). All N["t"] linearizations are evaluated in a single
+    mapped call. If x0 is given and guess does not have an "x" entry, the
+    initial linearization is along the constant trajectory x0.
+    
+    The remaining arguments are passed to nmpc. Note that l, Pf, etc. should
+    be quadratic if isQP=True. Time-varying parameters are not supported,
+    so N must not have a "p" entry.
+    
+    The return value is a ControlSolver object.
+    """
+    N = N.copy()
+    if "p" in N:
+        raise ValueError("Time-varying parameters are not supported!")
+    (Nx, Nu, Nt) = (N["x"], N["u"], N["t"])
+    if len(fpar) != f.n_in() - 2:
+        raise ValueError("fpar must have one entry for each argument of f "
+                         "after x and u!")
+    
+    # Affine model with matrices packed (column-major) into p.
+    NA = Nx*Nx
+    NB = Nx*Nu
+    N["p"] = NA + NB + Nx
+    x = casadi.SX.sym("x", Nx)
+    u = casadi.SX.sym("u", Nu)
+    p = casadi.SX.sym("p", N["p"])
+    A = casadi.reshape(p[:NA], Nx, Nx)
+    B = casadi.reshape(p[NA:NA + NB], Nx, Nu)
+    xplus = casadi.mtimes(A, x) + casadi.mtimes(B, u) + p[NA + NB:]
+    fltv = casadi.Function("f_ltv", [x, u, p], [xplus], ["x", "u", "p"],
+                           ["f_ltv"])
+    
+    # Build controller with a placeholder model and then linearize.
+    guess = util.ArrayDict(guess)
+    if x0 is not None and "x" not in guess:
+        guess["x"] = np.tile(np.array(x0).flatten(), (Nt + 1, 1))
+    funcargs = kwargs.pop("funcargs", {}).copy()
+    funcargs["f"] = ["x", "u", "p"]
+    controller = nmpc(f=fltv, l=l, N=N, x0=x0, guess=guess, isQP=isQP,
+                      p=np.zeros((Nt, N["p"])), funcargs=funcargs, **kwargs)
+    ltv = dict(f=f, Delta=Delta, fpar=[np.array(v, dtype=float).flatten()
+                                       for v in fpar])
+    controller.misc = util.ReadOnlyDict(controller.misc, ltv=ltv)
+    controller.relinearize()
+    return controller
+
+
+def adaptivecolloc(build, Delta, tol=1e-6, maxiter=10, maxsplit=4,
+                   merge=True, maxintervals=None, guess=None, verbosity=0):
+    """
+    Solves a collocation problem with adaptive mesh refinement.
+    
+    build must be a function build(Delta, guess) that returns a ControlSolver
+    using collocation (e.g., from nmpc or nmhe) with per-interval timesteps
+    given by the vector Delta and initial guess given by the dictionary guess.
+    Note that build is responsible for setting N["t"] = len(Delta) and for
+    adjusting any time-varying data (e.g., parameters or measurements) to
+    the new time grid.
+    
+    Delta gives the initial mesh. After each solve, the collocation error is
+    estimated using ControlSolver.collocerror. While the error exceeds tol on
+    any interval, those intervals are split into as many as maxsplit pieces.
+    Once tol is satisfied everywhere, if merge=True, adjacent pairs of
+    intervals whose errors are small enough that the merged interval should
+    still satisfy tol are combined, and this is repeated until merging
+    causes tol to be violated, at which point the last acceptable solution is
+    returned. Each time, the problem is rebuilt on the new mesh and
+    re-solved with a guess interpolated from the previous solution. Note that
+    splitting or merging an interval also refines or coarsens the
+    piecewise-constant inputs on that interval. The number of collocation
+    points N["c"] is the same on every interval.
+    
+    Iteration also stops when the mesh stops changing, after maxiter solves,
+    or when the mesh would have more than maxintervals intervals.
+    
+    Returns the final ControlSolver, which has been solved.
+    """
+    Delta = np.array(Delta, dtype=float).flatten()
+    best = None
+    for i in range(maxiter):
+        solver = build(Delta, guess)
+        solver.solve()
+        err = solver.collocerror()
+        if verbosity > 0:
+            print("Mesh iteration %d: %d intervals, max error %g (%s)."
+                  % (i, len(Delta), np.max(err), solver.stats["status"]))
+        order = solver.misc["N"]["c"] + 1
+        if np.max(err) <= tol:
+            best = solver
+            if not merge:
+                break
+            newDelta = __coarsenmesh(Delta, err, tol, order)
+        elif best is not None:
+            break # Merged too much.
+        else:
+            newDelta = __refinemesh(Delta, err, tol, order, maxsplit)
+        if (len(newDelta) == len(Delta) or
+                maxintervals is not None and len(newDelta) > maxintervals):
+            break
+        guess = __meshguess(solver, Delta, newDelta)
+        Delta = newDelta
+    return solver if best is None else best
+
+def __refinemesh(Delta, err, tol, order, maxsplit=4):
+    """
+    Returns new timesteps after splitting intervals whose error exceeds tol.
+    
+    The local error on each interval is assumed to scale with Delta**order.
+    """
+    newDelta = []
+    for (D, e) in zip(Delta, err):
+        if e > tol:
+            pieces = int(np.ceil((e/tol)**(1/order)))
+            pieces = min(maxsplit, max(2, pieces))
+            newDelta += [D/pieces]*pieces
+        else:
+            newDelta.append(D)
+    return np.array(newDelta)
+
+def __coarsenmesh(Delta, err, tol, order):
+    """
+    Returns new timesteps after merging pairs of intervals with small error.
+    
+    The local error on each interval is assumed to scale with Delta**order,
+    and a safety factor of 2 is included.
+    """
+    newDelta = []
+    k = 0
+    while k < len(Delta):
+        if k + 1 < len(Delta) and max(err[k], err[k + 1])*2**(order + 1) < tol:
+            newDelta.append(Delta[k] + Delta[k + 1])
+            k += 2
+        else:
+            newDelta.append(Delta[k])
+            k += 1
+    return np.array(newDelta)
+
+def __meshguess(solver, Delta, newDelta):
+    """
+    Interpolates the solution from a solver onto a new time grid.
+    
+    Collocation states are evaluated using their collocation polynomials, and
+    other time-varying variables are taken from the old interval containing
+    the new interval or time point.
+    """
+    vals = util.casadiStruct2numpyDict(solver.var)
+    [_, told] = util._timegrid(Delta, len(Delta))
+    [_, tnew] = util._timegrid(newDelta, len(newDelta))
+    rc = solver.misc["colloc"]["r"][1:-1]
+    tcnew = tnew[:-1,np.newaxis] + newDelta[:,np.newaxis]*rc[np.newaxis,:]
+    tmid = 0.5*(tnew[1:] + tnew[:-1])
+    kmid = np.clip(np.searchsorted(told, tmid, side="right") - 1, 0,
+                   len(Delta) - 1)
+    kpoint = np.clip(np.searchsorted(told, tnew, side="right") - 1, 0,
+                     len(Delta))
+    guess = {}
+    for (v, val) in vals.items():
+        if v + "c" in vals:
+            guess[v] = util.interpColloc(tnew, val, vals[v + "c"], told)
+        elif v[-1:] == "c" and v[:-1] in vals:
+            xc = util.interpColloc(tcnew, vals[v[:-1]], val, told)
+            xc = xc.reshape(tcnew.shape + (-1,)).transpose((0, 2, 1))
+            guess[v] = xc
+        elif len(val) == len(Delta):
+            guess[v] = val[kmid]
+        elif len(val) == len(Delta) + 1:
+            guess[v] = val[kpoint]
+        else:
+            guess[v] = val
+    return guess
+
 def __optimalControlProblem(N, var, par=None, lb={}, ub={}, guess={},
         obj=None, f=None, g=None, h=None, l=None, e=None, funcargs={},
         Delta=None, con=None, conlb=None, conub=None, periodic=False,
         discretef=True, deltaVars=None, finalpoint=True, verbosity=5,
         timelimit=60, casaditype="SX", discretel=True, fErrorVars=None,
-        isQP=False, infercolloc=None, solver="ipopt", discretevar=None,
-        inferargs=False):
+        isQP=None, infercolloc=None, solver="ipopt", discretevar=None,
+        inferargs=False, blocks=None, blockVars=None, shooting=None,
+        scaling=None, lsq=False, residual=None, horizon=False):
     """
     General wrapper for an optimal control problem (e.g., mpc or mhe).
     
     var and par must both be casadi sym_structs.
     
+    If blocks is given, the variables in blockVars have one entry per block,
+    and they are expanded to one entry per stage before building the
+    constraints. Names starting with "D" are taken to be differences, which
+    are zero except at the first stage of each block.
+    
+    If shooting is given, it must be a dictionary with entries "nodes" giving
+    the stages of the entries in var["x"] and "x" giving expressions for x at
+    every stage. The model f is then not used, and the caller is responsible
+    for continuity constraints.
+    
+    scaling can be True, or a dictionary of nominal values like lb, which is
+    passed to ControlSolver as a struct with NaN for missing entries.
+    
+    If lsq is True, l gives weighted residuals whose sum of squares is the
+    stage cost (see __residualfunc). These and any other residual terms in
+    the list residual are passed to ControlSolver for a Gauss-Newton Hessian.
+    
+    If horizon is True, par must have an entry "horizon" giving the number of
+    active stages. Stage costs and path constraints are multiplied by masks
+    that are zero after the active horizon, and bounds that can fall after
+    the active horizon become masked constraints (see __horizonbounds).
+    
     Note that only variable fields are taken from lb and ub, but parameter
     values must be specified in the guess dictionary.
     """
@@ -536,12 +1326,16 @@ def __optimalControlProblem(N, var, par=None, lb={}, ub={}, guess={},
         dataAndStructure.append((guess,parval,"par"))  # See above.
     else:
         parval = None
+    if isinstance(scaling, dict):
+        nominal = util.ArrayDict(scaling)
+        scaling = var(np.nan)
+        dataAndStructure.append((nominal,scaling,"scaling"))
     misc = {"N" : N.copy()}
     
     # Check timestep.
-    if N.get("c", 0) > 0:
-        if Delta is None:
-            raise ValueError("Must provide Delta to use collocation!")
+    if N.get("c", 0) > 0 and Delta is None:
+        raise ValueError("Must provide Delta to use collocation!")
+    if Delta is not None:
         misc["Delta"] = Delta
         
     # Sort out bounds and parameters.
@@ -589,6 +1383,24 @@ def __optimalControlProblem(N, var, par=None, lb={}, ub={}, guess={},
         for k in par.keys():
             struct[k] = par[k]
     
+    # Expand blocked variables.
+    if blocks is not None:
+        blockstruct = {v : struct[v] for v in blockVars}
+        index = __expandblocks(struct, blocks, blockVars)
+        misc["blocks"] = dict(lengths=list(blocks), index=index,
+                              vars=list(blockVars))
+    else:
+        blockstruct = None
+    
+    # Use eliminated states for single shooting.
+    if shooting is not None:
+        struct["x"] = shooting["x"]
+        f = None
+        symbols = [var.cat] + ([] if par is None else [par.cat])
+        xfunc = casadi.Function("x", symbols,
+                                [casadi.horzcat(*shooting["x"])])
+        misc["shooting"] = dict(nodes=shooting["nodes"], x=xfunc)
+    
     # Double-check some sizes and then get constraints.
     for (func,name) in [(f,"f"), (g,"g"), (h,"h"), (e,"e")]:
         if func is None:
@@ -601,8 +1413,25 @@ def __optimalControlProblem(N, var, par=None, lb={}, ub={}, guess={},
         g=g, Ng=N["g"], h=h, Nh=N["h"], l=l, funcargs=funcargs, Ncolloc=N["c"],
         Delta=Delta, discretef=discretef, deltaVars=deltaVars,
         finalpoint=finalpoint, e=e, Ne=N["e"], discretel=discretel,
-        fErrorVars=fErrorVars, inferargs=inferargs)
+        fErrorVars=fErrorVars, inferargs=inferargs, blockvar=blockstruct,
+        lsq=lsq)
         
+    # Mask stages after the active horizon.
+    if horizon:
+        active = [par["horizon",0] > t for t in range(N["t"])]
+        for k in ["cost", "residual"]:
+            if k in constraints:
+                constraints[k] = [[a*c for c in stage] for (a, stage)
+                                  in zip(active, constraints[k])]
+        if "path" in constraints:
+            constraints["path"]["con"] = [[a*c for c in stage] for (a, stage)
+                in zip(active, constraints["path"]["con"])]
+        boundcon = __horizonbounds(var, varlb, varub, par["horizon",0],
+                                   shooting, blocks)
+        misc["horizon"] = True
+    else:
+        boundcon = None
+    
     # Save collocation weights and generate a guess for xc if not given.
     if "colloc" in constraints:
         misc["colloc"] = constraints["colloc"]
@@ -625,6 +1454,10 @@ def __optimalControlProblem(N, var, par=None, lb={}, ub={}, guess={},
             con += util.flattenlist(constraints[f]["con"])
             conlb = np.concatenate([conlb,constraints[f]["lb"].flatten()])
             conub = np.concatenate([conub,constraints[f]["ub"].flatten()])
+    if boundcon is not None:
+        con += boundcon[0]
+        conlb = np.concatenate([conlb] + boundcon[1])
+        conub = np.concatenate([conub] + boundcon[2])
     con = casadi.vertcat(*con)
     
     if obj is None:
@@ -635,20 +1468,61 @@ def __optimalControlProblem(N, var, par=None, lb={}, ub={}, guess={},
     
     if "cost" in list(constraints.keys()):
         obj = sum(util.flattenlist(constraints["cost"]),obj)
+    residual = list(residual or [])
+    if "residual" in constraints:
+        residual += util.flattenlist(constraints["residual"])
+    residual = casadi.vertcat(*residual) if len(residual) > 0 else None
     
     # Build ControlSolver object and return that.
     args = [var, varlb, varub, varguess, obj, con, conlb, conub, par, parval]
     kwargs = dict(verbosity=verbosity, timelimit=timelimit, isQP=isQP,
                   casaditype=casaditype, misc=misc, discretevar=vardiscretevar,
-                  solver=solver)
+                  solver=solver, scaling=scaling, residual=residual)
     solver = solvers.ControlSolver(*args, **kwargs)
     return solver
 
+def __horizonbounds(var, varlb, varub, horizon, shooting=None, blocks=None):
+    """
+    Moves bounds on x, z, and u that can fall after the active horizon.
+    
+    Entries of x and z at t > 1 and of u at t > 0 are affected, with t taken
+    from the shooting nodes or block starts if given. Their finite bounds are
+    removed from varlb and varub and returned as [con, conlb, conub], with
+    con masked by (horizon >= t) for x and z and (horizon > t) for u (see
+    __maskedbound), so that everything after the active horizon is free.
+    """
+    starts = {}
+    if shooting is not None:
+        starts["x"] = shooting["nodes"]
+    if blocks is not None:
+        starts["u"] = np.cumsum([0] + list(blocks[:-1]))
+    con = []
+    conlb = []
+    conub = []
+    for v in sorted(set(["x", "z", "u"]).intersection(var.keys())):
+        first = 1 if v == "u" else 2
+        for (i, t) in enumerate(starts.get(v, range(len(var[v])))):
+            lb = np.array(varlb[v,i], dtype=float).flatten()
+            ub = np.array(varub[v,i], dtype=float).flatten()
+            finite = np.flatnonzero(np.isfinite(lb) | np.isfinite(ub))
+            if t < first or len(finite) == 0:
+                continue
+            active = (horizon > t) if v == "u" else (horizon >= t)
+            con.append(__maskedbound(active, var[v,i][finite.tolist()],
+                                     lb[finite], ub[finite]))
+            conlb.append(lb[finite])
+            conub.append(ub[finite])
+            lb[finite] = -np.inf
+            ub[finite] = np.inf
+            varlb[v,i] = lb
+            varub[v,i] = ub
+    return [con, conlb, conub]
+
 def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
                          l=None, funcargs=None, Ncolloc=0, Delta=1,
                          discretef=True, deltaVars=None, finalpoint=True,
                          e=None, Ne=0, discretel=True, fErrorVars=None,
-                         inferargs=False):
+                         inferargs=False, blockvar=None, lsq=False):
     """
     Creates general state evolution constraints for the following system:
     
@@ -696,13 +1570,20 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
     keys, e.g. if deltaVars = ["u"], then var must have "u", "Du", and "u_prev"
     entries or else this will error.    
     
+    blockvar is an optional dictionary of variables with one entry per block
+    (for move blocking). If given, its entries are used instead of those in
+    var for the delta constraints, so that there is only one constraint per
+    block.
+    
     Returns a dictionary with entries "state", "algebra", and "measurement".
     Note that the relevant fields will be missing if f, g, or h are set to
     None. Each entry in the return dictionary will be a list of lists, with
     each sublist corresponding to a single time segment worth of constraints.
     The list of stage costs is in "cost". This is also a list of lists, but
     each sub-list only has one element unless you are using a continuous
-    objective function.
+    objective function. If lsq is True, l gives residuals instead, and they
+    are returned in "residual" (scaled by the square root of any quadrature
+    weights).
     """
     
     # Figure out what variables are supplied.
@@ -716,8 +1597,8 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
     givenvarscolloc = givenvars.intersection(["x","z"])    
     
     # Decide function arguments.
+    funcs = dict(f=f, g=g, h=h, l=l, e=e)
     if inferargs:
-        funcs = dict(f=f, g=g, h=h, l=l, e=e)
         args = {k : __getargnames(v) for (k, v) in funcs.items()}
         args.update(funcargs)
     else:
@@ -746,7 +1627,8 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
     def isGiven(v): # Membership function.
         return v in givenvars
     for k in set(defaultargs).difference(args):
-        args[k] = [a for a in defaultargs[k] if isGiven(a)]
+        args[k] = ([a for a in defaultargs[k] if isGiven(a)]
+                   + __constantargs(funcs[k]))
     
     # Also define inverse map to get positions of arguments.
     argsInv = {}
@@ -772,6 +1654,10 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
     if Ncolloc > 0:
         [r,A,B,q] = colloc.weights(Ncolloc, True, True) # Collocation weights.
         returnDict["colloc"] = {"r" : r, "A" : A, "B" : B, "q" : q}
+        if f is not None:
+            returnDict["colloc"]["f"] = f
+            returnDict["colloc"]["fargs"] = list(args["f"])
+        [Deltas, _] = util._timegrid(Delta, Nt)
         collocvar = {}
         for v in givenvarscolloc:
             # Make sure we were given the corresponding "c" variables.            
@@ -819,7 +1705,7 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
                 for j in range(1,Ncolloc+2):
                     thisargs = getCollocArgs("f",t,j)
                     # Start with function evaluation.
-                    thiscon = Delta*f(*thisargs)
+                    thiscon = Deltas[t]*f(*thisargs)
                     
                     # Add collocation weights.
                     if "x" in givenvarscolloc:
@@ -872,15 +1758,18 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
     if len(deltaVars) > 0:
         deltaconstraints = []
         numentries = 0
+        dvar = dict(var)
+        if blockvar is not None:
+            dvar.update(blockvar)
         for v in deltaVars:
-            if not set([v,"D"+v, v+"_prev"]).issubset(var.keys()):
+            if not set([v,"D"+v, v+"_prev"]).issubset(dvar.keys()):
                 raise KeyError("Variable '%s' must also have entries 'D%s' "
                     "and '%s_prev'!" % (v,v,v))
-            thisdelta = [var["D" + v][0] - var[v][0] + var[v + "_prev"][0]]
-            for t in range(1,len(var[v])):
-                thisdelta.append(var["D" + v][t] - var[v][t] + var[v][t-1])
+            thisdelta = [dvar["D" + v][0] - dvar[v][0] + dvar[v + "_prev"][0]]
+            for t in range(1,len(dvar[v])):
+                thisdelta.append(dvar["D" + v][t] - dvar[v][t] + dvar[v][t-1])
             deltaconstraints.append(thisdelta)
-            numentries += len(var[v])*np.product(var[v][0].shape)
+            numentries += len(dvar[v])*np.product(dvar[v][0].shape)
         lb = np.zeros((numentries,))
         ub = lb.copy()
         returnDict["delta"] = dict(con=deltaconstraints,lb=lb,ub=ub)
@@ -900,9 +1789,13 @@ def __generalConstraints(var, Nt, f=None, Nf=0, g=None, Ng=0, h=None, Nh=0,
                 thiscost = []
                 for j in range(Ncolloc+2):
                     thisargs = getCollocArgs("l",t,j)
-                    thiscost.append(Delta*q[j]*l(*thisargs))
+                    w = Deltas[t]*q[j]
+                    if lsq:
+                        thiscost.append(np.sqrt(w)*l(*thisargs))
+                    else:
+                        thiscost.append(w*l(*thisargs))
                 cost.append(thiscost)
-        returnDict["cost"] = cost
+        returnDict["residual" if lsq else "cost"] = cost
     
     # Nonlinear path constraints.
     if e is not None:
@@ -1122,7 +2015,7 @@ def __getArgs(names,t=0,*structs):
 
 def getCasadiFunc(f, varsizes=None, varnames=None, funcname=None, rk4=False,
                   Delta=1, M=1, scalar=None, casaditype=None, wraps=None,
-                  numpy=None):
+                  numpy=None, constants=None, cache=None):
     """
     Takes a function handle and turns it into a Casadi function.
     
@@ -1147,6 +2040,33 @@ def getCasadiFunc(f, varsizes=None, varnames=None, funcname=None, rk4=False,
     To choose what type of Casadi symbolic variables to use, pass
     casaditype="SX" or casaditype="MX". The default value is "SX" if
     numpy=True, and "MX" if numpy=True.
+    
+    If rk4=True, f is taken to be an ODE in its first argument, and the
+    returned function takes M steps of fourth-order Runge-Kutta over a
+    timestep Delta. If Delta=None, the timestep is instead added as a final
+    argument named "Delta", which allows a different timestep in each stage
+    of nmpc (see the Delta argument there).
+    
+    constants can be a list of names of global variables or closure variables
+    used by f (or a dictionary mapping these names to values). Each one is
+    replaced by a symbolic parameter of the same name and shape, which is
+    added as an extra argument after those in varnames (but before Delta).
+    The nominal values are stored in the constants attribute of the returned
+    Function, and nmpc, nmhe, and sstarg add them to extrapar automatically,
+    so the values can be changed later via the par attribute of the
+    controller without rebuilding anything. Note that only names used
+    directly in the body of f are replaced.
+    
+    cache can be the name of a directory for a persistent cache of Casadi
+    Functions, so that f only needs to be traced once (even across
+    processes). The default is CASADIFUNC_CACHE, and cache=False disables
+    caching. Entries are keyed on a hash of the bytecode of f, the values of
+    its default arguments, closure variables and any global variables it
+    uses (recursively for Python functions), and all other arguments. If f
+    uses anything that cannot be hashed this way (e.g., an arbitrary
+    object), a warning is issued and f is traced as usual. Each entry is a
+    file written by Function.serialize() plus a JSON file for constants, so
+    loading never unpickles anything from the cache directory.
     """ 
     # Decide if user specified wraps.
     if wraps is not None:
@@ -1167,25 +2087,226 @@ def getCasadiFunc(f, varsizes=None, varnames=None, funcname=None, rk4=False,
     if numpy is None and scalar is not None:
         numpy = scalar
         warnings.warn("Passing 'scalar' is deprecated. Replace with 'numpy'.")
-    symbols = __getCasadiFunc(f, varsizes, varnames, funcname,
-                              numpy=numpy, casaditype=casaditype,
-                              allowmatrix=True)
-    args = symbols["casadiargs"]
-    fexpr = symbols["fexpr"]
     
-    # Evaluate function and make a Casadi object.  
-    fcasadi = casadi.Function(funcname, args, [fexpr], symbols["names"],
-                              [funcname])
+    # Look for a cached version. Note that the rk4 wrapper is cheap to build,
+    # but it makes the Function much larger, so it is not cached.
+    if cache is None:
+        cache = CASADIFUNC_CACHE
+    cachefile = None
+    fcasadi = None
+    if cache:
+        key = __funckey(f, [varsizes, varnames, funcname, numpy, casaditype,
+                            constants])
+        if key is not None:
+            cachefile = os.path.join(cache, key)
+            fcasadi = __loadcasadifunc(cachefile)
+    
+    # Evaluate function and make a Casadi object.
+    if fcasadi is None:
+        symbols = __getCasadiFunc(f, varsizes, varnames, funcname,
+                                  numpy=numpy, casaditype=casaditype,
+                                  allowmatrix=True, constants=constants)
+        fcasadi = casadi.Function(funcname, symbols["casadiargs"],
+                                  [symbols["fexpr"]], symbols["names"],
+                                  [funcname])
+        if symbols["constants"]:
+            fcasadi.constants = symbols["constants"]
+        if cachefile is not None:
+            __savecasadifunc(cachefile, fcasadi)
     
     # Wrap with rk4 if requested.
     if rk4:
-        frk4 = util.rk4(fcasadi, args[0], args[1:], Delta, M)
-        fcasadi = casadi.Function(funcname, args, [frk4], symbols["names"],
-                                  [funcname])
+        constants = getattr(fcasadi, "constants", None)
+        args = (fcasadi.sx_in() if fcasadi.is_a("SXFunction")
+                else fcasadi.mx_in())
+        names = fcasadi.name_in()
+        par = list(args[1:])
+        if Delta is None:
+            Delta = type(args[0]).sym("Delta")
+            args = list(args) + [Delta]
+            names.append("Delta")
+        frk4 = util.rk4(fcasadi, args[0], par, Delta, M)
+        fcasadi = casadi.Function(funcname, args, [frk4], names, [funcname])
+        if constants:
+            fcasadi.constants = constants
+    return fcasadi
+
+
+def __funckey(f, extra):
+    """
+    Returns a hash string for the Python function f and the list extra.
     
+    Returns None (with a warning) if f or extra cannot be hashed.
+    """
+    h = hashlib.sha1()
+    try:
+        __hashobj(h, [casadi.__version__, extra], set())
+        if not isinstance(f, types.FunctionType):
+            raise TypeError("f is not a Python function")
+        __hashobj(h, f, set())
+    except TypeError as err:
+        warnings.warn("Unable to cache %r: %s." % (f, err))
+        return None
+    return h.hexdigest()
+
+
+def __hashobj(h, obj, seen):
+    """
+    Updates hash h with the value of obj.
+    
+    Python functions are hashed by their bytecode, default arguments, closure
+    variables, and any global variables they use. Raises a TypeError if obj
+    contains anything else that cannot be hashed by value.
+    """
+    h.update(type(obj).__name__.encode())
+    if isinstance(obj, types.FunctionType):
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        names = __hashcode(h, obj.__code__, seen)
+        __hashobj(h, obj.__defaults__, seen)
+        __hashobj(h, [c.cell_contents for c in obj.__closure__ or ()], seen)
+        for name in sorted(names.intersection(obj.__globals__)):
+            h.update(name.encode())
+            __hashobj(h, obj.__globals__[name], seen)
+    elif isinstance(obj, (types.ModuleType, types.BuiltinFunctionType,
+                          np.ufunc, type)):
+        name = getattr(obj, "__module__", None) or ""
+        h.update((name + "." + obj.__name__).encode())
+    elif isinstance(obj, (np.ndarray, np.generic)):
+        obj = np.asarray(obj)
+        if obj.dtype == object:
+            __hashobj(h, obj.tolist(), seen)
+        else:
+            h.update(repr((obj.dtype.str, obj.shape)).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, bytes):
+        h.update(obj)
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for x in obj:
+            __hashobj(h, x, seen)
+    elif isinstance(obj, (set, frozenset)):
+        __hashobj(h, sorted(obj, key=repr), seen)
+    elif isinstance(obj, dict):
+        __hashobj(h, sorted(obj.items(), key=lambda kv : repr(kv[0])), seen)
+    elif isinstance(obj, casadi.Function):
+        h.update(obj.serialize().encode())
+    else:
+        raise TypeError("cannot hash object of type %s"
+                        % (type(obj).__name__,))
+
+
+def __hashcode(h, code, seen):
+    """
+    Updates hash h with a code object and any nested code objects.
+    
+    Returns the set of all global (or attribute) names that are used.
+    """
+    h.update(code.co_code)
+    names = set(code.co_names)
+    h.update(repr(code.co_names).encode())
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names.update(__hashcode(h, c, seen))
+        else:
+            __hashobj(h, c, seen)
+    return names
+
+
+def __loadcasadifunc(filename):
+    """
+    Loads a Function saved by __savecasadifunc (or returns None).
+    
+    The Function itself is read with Casadi's deserializer, and constants
+    come from a JSON file next to it, so nothing is unpickled.
+    """
+    try:
+        with open(filename + ".json", "r") as f:
+            meta = json.load(f)
+        with open(filename + ".casadi", "r") as f:
+            fcasadi = casadi.Function.deserialize(f.read())
+        constants = meta["constants"]
+        if constants is not None:
+            constants = collections.OrderedDict(
+                (name, np.array(val, dtype=float).reshape(shape))
+                for (name, shape, val) in constants)
+    except Exception:
+        return None
+    if constants is not None:
+        fcasadi.constants = constants
     return fcasadi
 
 
+def __savecasadifunc(filename, fcasadi):
+    """
+    Saves a Function (and any constants) atomically.
+    
+    The serialized Function goes in filename + ".casadi" and the constants
+    in filename + ".json". The JSON file is written first, so any process
+    that finds the Function file can also read the constants.
+    """
+    constants = getattr(fcasadi, "constants", None)
+    if constants is not None:
+        constants = [[name, list(val.shape), val.flatten().tolist()]
+                     for (name, val) in constants.items()]
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    for (ext, contents) in [(".json", json.dumps(dict(constants=constants))),
+                            (".casadi", fcasadi.serialize())]:
+        (fd, tmpname) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(contents)
+            os.replace(tmpname, filename + ext)
+        except Exception:
+            os.remove(tmpname)
+            raise
+
+
+def getLinearFunc(mats, varnames=None, funcname="f", offset=None,
+                  casaditype="SX"):
+    """
+    Returns a Casadi Function for a linear model A*x + B*u + ... + offset.
+    
+    mats should be a list of matrices [A, B, ...], each either a numpy array
+    or a scipy.sparse matrix, with one argument for each. varnames gives the
+    names of the arguments (by default ["x0", "x1", ...]), and their sizes
+    are the numbers of columns of each matrix.
+    
+    All matrices are converted to sparse casadi.DM (see util.sparseDM), so
+    zero entries never enter the Casadi graph. This is much faster than
+    getCasadiFunc with f(x, u) = A.dot(x) + B.dot(u) for large sparse models,
+    e.g., from discretized PDEs, and building the Function, its memory use,
+    and its derivatives all scale with the number of nonzeros.
+    """
+    mats = [util.sparseDM(M) for M in mats]
+    if len(mats) == 0:
+        raise ValueError("Must provide at least one matrix!")
+    Nf = mats[0].size1()
+    if any(M.size1() != Nf for M in mats):
+        raise ValueError("All matrices must have the same number of rows!")
+    if varnames is None:
+        varnames = ["x%d" % (i,) for i in range(len(mats))]
+    else:
+        varnames = [str(n) for n in varnames]
+    if len(varnames) != len(mats):
+        raise ValueError("varnames must be the same length as mats!")
+    XX = dict(SX=casadi.SX, MX=casadi.MX).get(casaditype, None)
+    if XX is None:
+        raise ValueError("casaditype must be either 'SX' or 'MX'!")
+    
+    # Build expression with sparse products.
+    args = [XX.sym(name, M.size2()) for (name, M) in zip(varnames, mats)]
+    fexpr = sum((casadi.mtimes(M, x) for (M, x) in zip(mats, args)),
+                XX(Nf, 1))
+    if offset is not None:
+        fexpr += util.sparseDM(offset)
+    return casadi.Function(funcname, args, [fexpr], varnames, [funcname])
+
+
 def getCasadiIntegrator(f, Delta, argsizes, argnames=None, funcname="int_f",
                         abstol=1e-8, reltol=1e-8, wrap=True, verbosity=1,
                         scalar=None, casaditype=None, numpy=None):
@@ -1242,7 +2363,7 @@ def getCasadiIntegrator(f, Delta, argsizes, argnames=None, funcname="int_f",
 
 
 def __getCasadiFunc(f, varsizes, varnames=None, funcname="f", numpy=None,
-                    casaditype=None, allowmatrix=True):
+                    casaditype=None, allowmatrix=True, constants=None):
     """
     Core logic for getCasadiFunc and its relatives.
     
@@ -1281,6 +2402,10 @@ def __getCasadiFunc(f, varsizes, varnames=None, funcname="f", numpy=None,
     - names: a list of string names for each argument.
     
     - sizes: a list of one- or two-element lists giving the sizes.
+    
+    - constants: a dictionary of nominal values for any of the constants
+                 (see __liftconstants) that were made symbolic. Their
+                 symbols are added to the end of casadiargs.
     """
     # Check names.
     if varnames is None:
@@ -1337,10 +2462,83 @@ def __getCasadiFunc(f, varsizes, varnames=None, funcname="f", numpy=None,
         numpyargs = None
         fargs = casadiargs
     
+    # Replace any constants with symbols.
+    if constants:
+        [f, constants, constargs] = __liftconstants(f, constants, XX, numpy)
+        casadiargs = casadiargs + constargs
+        varnames = varnames + list(constants)
+        realvarsizes = realvarsizes + [list(x.shape) for x in constargs]
+    else:
+        constants = {}
+    
     # Evaluate the function and return everything.
     fexpr = util.safevertcat(f(*fargs))
     return dict(fexpr=fexpr, casadiargs=casadiargs, numpyargs=numpyargs, XX=XX,
-                names=varnames, sizes=realvarsizes)
+                names=varnames, sizes=realvarsizes, constants=constants)
+
+
+def __liftconstants(f, constants, XX, numpy=True):
+    """
+    Makes a copy of the Python function f with constants replaced by symbols.
+    
+    constants should be a list of names of global or closure variables of f,
+    or a dictionary mapping these names to their nominal values. Symbols are
+    of type XX with the same shape as each value, and they are passed to f as
+    numpy arrays of scalars if numpy is True.
+    
+    Returns a list [newf, values, symbols], with values an ordered dictionary
+    of nominal values and symbols a list of the corresponding symbols.
+    """
+    try:
+        code = f.__code__
+        fglobals = f.__globals__
+        closure = f.__closure__ or ()
+    except AttributeError:
+        raise TypeError("constants can only be used if f is a Python "
+                        "function!")
+    cells = dict(zip(code.co_freevars, closure))
+    if not isinstance(constants, dict):
+        values = collections.OrderedDict()
+        for name in constants:
+            if name in cells:
+                values[name] = cells[name].cell_contents
+            elif name in fglobals:
+                values[name] = fglobals[name]
+            else:
+                raise ValueError("Constant '%s' not found in f!" % (name,))
+    else:
+        values = collections.OrderedDict(sorted(constants.items()))
+    
+    # Make symbols and their replacements within f.
+    symbols = []
+    replacements = {}
+    for (name, val) in values.items():
+        val = np.array(val, dtype=float)
+        if val.ndim > 2:
+            raise ValueError("Constant '%s' has more than two dimensions!"
+                             % (name,))
+        values[name] = val
+        shape = val.shape + (1,)*(2 - val.ndim)
+        x = XX.sym(name, *shape)
+        symbols.append(x)
+        if numpy and val.ndim > 0:
+            x = __casadi_to_numpy(x, matrix=(val.ndim == 2))
+        replacements[name] = x
+    newglobals = fglobals.copy()
+    newclosure = []
+    for (var, cell) in zip(code.co_freevars, closure):
+        if var in replacements:
+            cell = __makecell(replacements.pop(var))
+        newclosure.append(cell)
+    newglobals.update(replacements)
+    newf = types.FunctionType(code, newglobals, f.__name__, f.__defaults__,
+                              tuple(newclosure) or None)
+    return [newf, values, symbols]
+
+
+def __makecell(val):
+    """Returns a closure cell containing val."""
+    return (lambda : val).__closure__[0]
 
 
 def __casadi_to_numpy(x, matrix=False, scalar=False):
@@ -1363,8 +2561,12 @@ def __casadi_to_numpy(x, matrix=False, scalar=False):
     if y.ndim == 0:
         y[()] = x # Casadi uses different behavior for x[()].
     else:
-        for i in np.ndindex(shape):
-            y[i] = x[i]
+        # Split all at once in column-major order rather than indexing.
+        elements = casadi.vertsplit(casadi.vec(x))
+        if y.ndim == 1:
+            y[:] = elements
+        else:
+            y.T.flat[:] = elements
     return y
 
 
@@ -1403,6 +2605,10 @@ class DummySimulator(object):
     def args(self):
         return self.__argnames
     
+    @property
+    def argsizes(self):
+        return self.__argsizes
+    
     def __init__(self, model, argsizes, argnames=None):
         """Initilize the simulator using a model function."""
         # Decide argument names.
@@ -1422,6 +2628,18 @@ class DummySimulator(object):
         self._checkargs(args)
         return self.__integrator(*args)
 
+    def getCasadiFunc(self, funcname="sim"):
+        """
+        Returns a Casadi Function that simulates one timestep.
+        
+        The Function is built from MX symbols using self.call, so it can be
+        mapped or embedded in other symbolic expressions.
+        """
+        args = [casadi.MX.sym(n, s) for (n, s)
+                in zip(self.args, self.argsizes)]
+        return casadi.Function(funcname, args, [self.call(*args)], self.args,
+                               [funcname])
+
     def _checkargs(self, args):
         """Checks that the right number of arguments have been given."""
         if len(args) != self.Nargs:
@@ -1,5 +1,7 @@
 
 import scipy.linalg
+import scipy.sparse
+import hashlib
 import casadi
 import casadi.tools as ctools
 import collections
@@ -65,7 +67,8 @@ def atleastnd(arr,n=2):
     return arr
 
 
-def getLinearizedModel(f,args,names=None,Delta=None,returnf=True,forcef=False):
+def getLinearizedModel(f,args,names=None,Delta=None,returnf=True,forcef=False,
+                       stacked=False):
     """
     Returns linear (affine) state-space model for f at the point in args.
     
@@ -79,25 +82,45 @@ def getLinearizedModel(f,args,names=None,Delta=None,returnf=True,forcef=False):
     If "f" is not in the list of names, then the return dict will also include
     an "f" entry with the actual value of f at the linearization point. To
     disable this, set returnf=False.
+    
+    The value of f and all of its Jacobians are evaluated in one call to a
+    single Casadi Function, which is cached (see JACOBIAN_CACHE) so that
+    repeated linearizations of the same f do not rebuild anything.
+    
+    To linearize at many points at once, set stacked=True and give each entry
+    of args a leading dimension K, i.e., args[i] should have shape (K, n_i).
+    All K points are then evaluated in one mapped call, and each entry of the
+    return dictionary has a leading dimension K.
     """
     # Decide names.
     if names is None:
         names = ["A"] + ["B_%d" % (i,) for i in range(1,len(args))]
     
-    # Evaluate function.
-    fs = np.array(f(*args))    
-    
-    # Now do jacobian.
-    jacobians = []
-    for i in range(len(args)):
-        jac = jacobianfunc(f, i) # df/d(args[i]).
-        jacobians.append(np.array(jac(*args)))
+    # Evaluate function and jacobians in one go.
+    indeps = tuple(range(len(args)))
+    if stacked:
+        args = [np.array(a, dtype=float) for a in args]
+        K = args[0].shape[0]
+        linfunc = _getfusedjacobianfunc(f, indeps, K)
+        vals = linfunc(*[a.reshape((K, -1)).T for a in args])
+        fs = np.array(vals[0]).T[:,:,np.newaxis]
+        jacobians = []
+        for (i, jac) in enumerate(vals[1:]):
+            jac = np.array(jac)
+            jac = jac.reshape((jac.shape[0], K, f.numel_in(i)))
+            jacobians.append(jac.transpose((1, 0, 2)))
+    else:
+        linfunc = _getfusedjacobianfunc(f, indeps)
+        vals = [np.array(v) for v in linfunc(*args)]
+        fs = vals[0]
+        jacobians = vals[1:]
     
     # Decide whether or not to discretize.
     if Delta is not None:
-        (A, Bfactor) = c2d(jacobians[0],np.eye(jacobians[0].shape[0]),Delta)
-        jacobians = [A] + [Bfactor.dot(j) for j in jacobians[1:]]
-        fs = Bfactor.dot(fs)
+        A = jacobians[0]
+        (A, Bfactor) = c2d(A, np.eye(A.shape[-1]), Delta)
+        jacobians = [A] + [np.matmul(Bfactor, j) for j in jacobians[1:]]
+        fs = np.matmul(Bfactor, fs)
     
     # Package everything up.
     ss = dict(zip(names, jacobians))
@@ -105,6 +128,114 @@ def getLinearizedModel(f,args,names=None,Delta=None,returnf=True,forcef=False):
         ss["f"] = fs
     return ss    
 
+
+def _getfusedjacobianfunc(f, indeps, K=None):
+    """
+    Returns a (cached) fused Jacobian Function for f.
+    
+    If K is not None, the Function is mapped over K points.
+    """
+    def build():
+        """Builds the Function and keeps f alive as long as it is cached."""
+        func = fusedjacobianfunc(f, indeps)
+        if K is not None:
+            func = mapfunc(func, K)
+        return (f, func)
+    return JACOBIAN_CACHE.get((id(f), indeps, K), build)[1]
+
+
+# Coefficients and maximum 1-norm for the [13/13] Pade approximant in expm.
+_EXPM_PADE13 = (64764752532480000., 32382376266240000., 7771770303897600.,
+                1187353796428800., 129060195264000., 10559470521600.,
+                670442572800., 33522128640., 1323241920., 40840800., 960960.,
+                16380., 182., 1.)
+_EXPM_THETA13 = 5.371920351148152
+
+def expm(M, cache=True):
+    """
+    Returns the matrix exponential of M.
+    
+    M can be a single square matrix or a stack of matrices with shape
+    (..., n, n), in which case every matrix is exponentiated at once using a
+    vectorized scaling-and-squaring [13/13] Pade approximation (Higham, 2005).
+    
+    If cache=True, results are stored in EXPM_CACHE keyed on a hash of the
+    bytes of each matrix, and only matrices not found in the cache are
+    computed.
+    """
+    M = np.array(M, dtype=float)
+    shape = M.shape
+    n = shape[-1]
+    if len(shape) < 2 or shape[-2] != n:
+        raise ValueError("M must be square!")
+    M = M.reshape((-1, n, n))
+    if not cache:
+        return _expmpade(M).reshape(shape)
+    
+    # Look everybody up in the cache and compute what's missing. Hits are
+    # copied out before inserting anything, since inserting can evict them.
+    keys = [(hashlib.sha1(m.tobytes()).hexdigest(), n) for m in M]
+    expM = np.empty(M.shape)
+    missing = []
+    for (i, k) in enumerate(keys):
+        val = EXPM_CACHE.lookup(k)
+        if val is None:
+            missing.append(i)
+        else:
+            expM[i] = val
+    if len(missing) > 0:
+        expM[missing] = _expmpade(M[missing])
+        for i in missing:
+            val = expM[i].copy()
+            val.flags.writeable = False
+            EXPM_CACHE.get(keys[i], lambda : val)
+    return expM.reshape(shape)
+
+
+def _expmpade(M):
+    """Scaling-and-squaring matrix exponential for a (K, n, n) stack."""
+    b = _EXPM_PADE13
+    I = np.eye(M.shape[-1])
+    
+    # Scale so that the Pade approximant is accurate.
+    norm = np.max(np.sum(np.abs(M), axis=-2), axis=-1)
+    s = np.zeros(norm.shape, dtype=int)
+    big = norm > _EXPM_THETA13
+    s[big] = np.ceil(np.log2(norm[big]/_EXPM_THETA13)).astype(int)
+    M = M/(2.0**s)[:,np.newaxis,np.newaxis]
+    
+    # Pade approximant.
+    M2 = np.matmul(M, M)
+    M4 = np.matmul(M2, M2)
+    M6 = np.matmul(M2, M4)
+    U = np.matmul(M6, b[13]*M6 + b[11]*M4 + b[9]*M2)
+    U += b[7]*M6 + b[5]*M4 + b[3]*M2 + b[1]*I
+    U = np.matmul(M, U)
+    V = np.matmul(M6, b[12]*M6 + b[10]*M4 + b[8]*M2)
+    V += b[6]*M6 + b[4]*M4 + b[2]*M2 + b[0]*I
+    R = np.linalg.solve(V - U, V + U)
+    
+    # Undo scaling by repeated squaring.
+    for i in range(np.max(s, initial=0)):
+        square = (s > i)
+        R[square] = np.matmul(R[square], R[square])
+    return R
+
+
+def _matvec(M, v):
+    """
+    Multiplies (stacks of) matrices M by v.
+    
+    If v has one fewer dimension than M, it is treated as a (stack of)
+    vectors. Otherwise, it is treated as a (stack of) matrices.
+    """
+    v = np.asarray(v)
+    if v.ndim == M.ndim - 1:
+        ret = np.matmul(M, v[...,np.newaxis])[...,0]
+    else:
+        ret = np.matmul(M, v)
+    return ret
+
     
 def c2d(A, B, Delta, Bp=None, f=None, asdict=False):
     """
@@ -116,16 +247,23 @@ def c2d(A, B, Delta, Bp=None, f=None, asdict=False):
     If asdict=True, return value will be a dictionary with entries A, B, Bp,
     and f. Otherwise, the return value will be a 4-element list [A, B, Bp, f]
     if Bp and f are provided, otherwise a 2-element list [A, B].
+    
+    To discretize many systems at once, A can be a stack of matrices with
+    shape (K, n, n), and B, Bp, and f can be either stacked or shared by all
+    K systems. Matrix exponentials are computed with expm, so repeated calls
+    with the same A and Delta are served from EXPM_CACHE.
     """
-    n = A.shape[0]
-    I = np.eye(n)
-    D = scipy.linalg.expm(Delta*np.vstack((np.hstack([A, I]),
-                                     np.zeros((n, 2*n)))))
-    Ad = D[:n,:n]
-    Id = D[:n,n:]
-    Bd = Id.dot(B)
-    Bpd = None if Bp is None else Id.dot(Bp)
-    fd = None if f is None else Id.dot(f)   
+    A = np.asarray(A)
+    n = A.shape[-1]
+    D = np.zeros(A.shape[:-2] + (2*n, 2*n))
+    D[...,:n,:n] = A
+    D[...,:n,n:] = np.eye(n)
+    D = expm(Delta*D)
+    Ad = D[...,:n,:n]
+    Id = D[...,:n,n:]
+    Bd = np.matmul(Id, B)
+    Bpd = None if Bp is None else np.matmul(Id, Bp)
+    fd = None if f is None else _matvec(Id, f)
     
     if asdict:
         retval = dict(A=Ad, B=Bd, Bp=Bpd, f=fd)
@@ -154,47 +292,56 @@ def c2dObjective(a,b,q,r,Delta):
         
     in discrete time.
     
+    To discretize many systems at once, any of the inputs can be a stack of
+    matrices with a leading dimension K. As in c2d, matrix exponentials are
+    computed with expm and cached.
+    
     Formulas from Pannocchia, Rawlings, Mayne, and Mancuso (2014).
     """
     # Make sure everything is a matrix.
     for m in [a,b,q,r]:
         try:
-            if len(m.shape) != 2:
-                raise ValueError("All inputs must be 2D arrays!")
+            if len(m.shape) not in (2, 3):
+                raise ValueError("All inputs must be 2D or 3D arrays!")
         except AttributeError:
             raise TypeError("All inputs must have a shape attribute!")
             
     # Get sizes.
-    Nx = a.shape[1]
-    Nu = b.shape[1]
+    Nx = a.shape[-1]
+    Nu = b.shape[-1]
     for (m,s) in [(a,(Nx,Nx)), (b,(Nx,Nu)), (q,(Nx,Nx)), (r,(Nu,Nu))]:
-        if m.shape != s:
+        if m.shape[-2:] != s:
             raise ValueError("Incorrect sizes for inputs!")
+    stack = np.broadcast(*[m[...,0,0] for m in [a,b,q,r]]).shape
     
     # Now stack everybody up.
+    def T(m):
+        """Transposes (stacks of) matrices."""
+        return np.swapaxes(m, -1, -2)
     i = [slice(j*Nx,(j+1)*Nx) for j in range(3)] + [slice(3*Nx,3*Nx+Nu)]
-    c = np.zeros((3*Nx + Nu,)*2)
-    c[i[0],i[0]] = -a.T
-    c[i[1],i[1]] = -a.T
-    c[i[2],i[2]] = a
-    c[i[0],i[1]] = np.eye(Nx)
-    c[i[1],i[2]] = q
-    c[i[2],i[3]] = b
+    c = np.zeros(stack + (3*Nx + Nu,)*2)
+    c[...,i[0],i[0]] = -T(a)
+    c[...,i[1],i[1]] = -T(a)
+    c[...,i[2],i[2]] = a
+    c[...,i[0],i[1]] = np.eye(Nx)
+    c[...,i[1],i[2]] = q
+    c[...,i[2],i[3]] = b
     
     # Now exponentiate and grab everybody.
-    C = scipy.linalg.expm(c*Delta);
-    F3 = C[i[2],i[2]]
-    G3 = C[i[2],i[3]]
-    G2 = C[i[1],i[2]]
-    H2 = C[i[1],i[3]]
-    K1 = C[i[0],i[3]]
+    C = expm(c*Delta)
+    F3 = C[...,i[2],i[2]]
+    G3 = C[...,i[2],i[3]]
+    G2 = C[...,i[1],i[2]]
+    H2 = C[...,i[1],i[3]]
+    K1 = C[...,i[0],i[3]]
     
     # Then, use formulas.
     A = F3
     B = G3
-    Q = F3.T.dot(G2)
-    M = F3.T.dot(H2)
-    R = r*Delta + b.T.dot(F3.T.dot(K1)) + (b.T.dot(F3.T.dot(K1))).T
+    Q = np.matmul(T(F3), G2)
+    M = np.matmul(T(F3), H2)
+    bFK = np.matmul(T(b), np.matmul(T(F3), K1))
+    R = r*Delta + bFK + T(bFK)
     
     return [A,B,Q,R,M]
 
@@ -233,6 +380,224 @@ def dlqe(A,C,Q,R):
     
     return [L, P]
 
+
+def psdsqrt(M):
+    """
+    Returns S with S S^T = M for symmetric positive semidefinite M.
+
+    Uses the lower Cholesky factor when M is positive definite. Otherwise,
+    falls back to the eigendecomposition with negative roundoff eigenvalues
+    clipped to zero, so singular covariances (e.g., noise that only enters
+    some states) are allowed.
+    """
+    try:
+        S = scipy.linalg.cholesky(M, lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        (w, V) = scipy.linalg.eigh(M, check_finite=False)
+        S = V*np.sqrt(np.maximum(w, 0))
+    return S
+
+
+def _stackseq(mats, N=None):
+    """
+    Broadcasts (N, n, m) stacks and (n, m) matrices to a common length N.
+    
+    Returns the list of stacks and N.
+    """
+    mats = [np.asarray(m, dtype=float) for m in mats]
+    if N is None:
+        N = max([m.shape[0] for m in mats if m.ndim == 3] + [0])
+        if N == 0:
+            raise ValueError("N must be given if no inputs are stacked!")
+    stacks = []
+    for m in mats:
+        if m.ndim == 2:
+            m = np.broadcast_to(m, (N,) + m.shape)
+        elif m.ndim != 3 or m.shape[0] != N:
+            raise ValueError("Stacked inputs must have shape (N, n, m)!")
+        stacks.append(m)
+    return [stacks, N]
+
+
+def dlqrtv(A, B, Q, R, Pf, M=None, N=None):
+    """
+    Finite-horizon, time-varying discrete-time LQR.
+    
+    Solves the backward Riccati recursion for the system
+    
+        x_{k+1} = A_k x_k + B_k u_k
+        
+    with stage costs x'Q_k x + 2x'M_k u + u'R_k u for k = 0, ..., N - 1 and
+    terminal cost x'Pf x. Each of A, B, Q, R, and M can be a stack with
+    shape (N, n, m) or a single matrix used for every stage. If none are
+    stacked, then N must be given.
+    
+    Returns [K, Pi] with K of shape (N, Nu, Nx) giving the optimal policies
+    u_k = K_k x_k and Pi of shape (N + 1, Nx, Nx) giving the cost-to-go
+    matrices, with Pi[N] = Pf.
+    """
+    if M is None:
+        M = np.zeros(np.shape(B)[-2:])
+    ([A, B, Q, R, M], N) = _stackseq([A, B, Q, R, M], N)
+    (Nx, Nu) = B.shape[1:]
+    
+    # Preallocate everything.
+    K = np.empty((N, Nu, Nx))
+    Pi = np.empty((N + 1, Nx, Nx))
+    Pi[N] = Pf
+    PA = np.empty((Nx, Nx))
+    PB = np.empty((Nx, Nu))
+    G = np.empty((Nu, Nx))
+    S = np.empty((Nu, Nu))
+    
+    # Backward recursion.
+    for k in range(N - 1, -1, -1):
+        np.dot(Pi[k + 1], A[k], out=PA)
+        np.dot(Pi[k + 1], B[k], out=PB)
+        np.dot(B[k].T, PB, out=S)
+        S += R[k]
+        np.dot(B[k].T, PA, out=G)
+        G += M[k].T
+        K[k] = scipy.linalg.solve(S, G, assume_a="pos")
+        np.negative(K[k], out=K[k])
+        np.dot(A[k].T, PA, out=Pi[k])
+        Pi[k] += Q[k]
+        Pi[k] += np.dot(G.T, K[k])
+        Pi[k] += Pi[k].T
+        Pi[k] *= 0.5
+    
+    return [K, Pi]
+
+
+def dlqetv(A, C, Q, R, P0, N=None):
+    """
+    Finite-horizon, time-varying discrete-time Kalman filter.
+    
+    Solves the forward Riccati recursion for the system
+    
+        x_{k+1} = A_k x_k + w_k,    w_k ~ N(0, Q_k)
+        y_k = C_k x_k + v_k,        v_k ~ N(0, R_k)
+        
+    starting from prior covariance P0. Each of A, C, Q, and R can be a stack
+    with shape (N, n, m) or a single matrix used for every stage. If none are
+    stacked, then N must be given.
+    
+    Returns [L, P] with L of shape (N, Nx, Ny) giving the filter gains and P
+    of shape (N + 1, Nx, Nx) giving the prior covariances, with P[0] = P0.
+    As N becomes large, these approach the values returned by dlqe.
+    """
+    ([A, C, Q, R], N) = _stackseq([A, C, Q, R], N)
+    (Ny, Nx) = C.shape[1:]
+    
+    # Preallocate everything.
+    L = np.empty((N, Nx, Ny))
+    P = np.empty((N + 1, Nx, Nx))
+    P[0] = P0
+    PCT = np.empty((Nx, Ny))
+    S = np.empty((Ny, Ny))
+    Pc = np.empty((Nx, Nx))
+    
+    # Forward recursion.
+    for k in range(N):
+        np.dot(P[k], C[k].T, out=PCT)
+        np.dot(C[k], PCT, out=S)
+        S += R[k]
+        L[k] = scipy.linalg.solve(S, PCT.T, assume_a="pos").T
+        np.dot(L[k], PCT.T, out=Pc)
+        np.subtract(P[k], Pc, out=Pc)
+        np.dot(A[k], np.dot(Pc, A[k].T), out=P[k + 1])
+        P[k + 1] += Q[k]
+        P[k + 1] += P[k + 1].T
+        P[k + 1] *= 0.5
+    
+    return [L, P]
+
+
+class LQRTerminalCost(object):
+    """
+    Memoizing provider of infinite-horizon LQR terminal costs.
+    
+    Calling with (A, B) returns [K, Pi] as from dlqr for fixed Q, R, and M.
+    Solutions are cached by model, and new models are solved by Newton
+    (Hewer) iteration warm-started from the most recent solution. This is
+    much cheaper than solving the DARE from scratch when the model changes
+    only slightly between calls, e.g., when rescheduling Pf in nonlinear MPC.
+    If the previous gain does not stabilize the new model or the iteration
+    fails to converge, falls back to dlqr.
+    """
+    def __init__(self, Q, R, M=None, maxiter=25, tol=1e-10, maxsize=128):
+        self.__Q = np.array(Q, dtype=float)
+        self.__R = np.array(R, dtype=float)
+        self.__M = None if M is None else np.array(M, dtype=float)
+        self.__maxiter = maxiter
+        self.__tol = tol
+        self.__cache = LRUCache(maxsize=maxsize)
+        self.__K = None
+        self.__Pi = None
+        
+    @property
+    def K(self):
+        """Most recent LQR gain."""
+        return self.__K
+    
+    @property
+    def Pi(self):
+        """Most recent cost-to-go matrix."""
+        return self.__Pi
+    
+    def reset(self):
+        """Clears cached solutions and the warm start."""
+        self.__cache.clear()
+        self.__K = None
+        self.__Pi = None
+    
+    def __call__(self, A, B):
+        """Returns [K, Pi] for the given model."""
+        A = np.array(A, dtype=float)
+        B = np.array(B, dtype=float)
+        key = (hashlib.sha1(A.tobytes() + B.tobytes()).hexdigest(), A.shape,
+               B.shape)
+        (K, Pi) = self.__cache.get(key, lambda : self.__solve(A, B))
+        self.__K = K
+        self.__Pi = Pi
+        return [K.copy(), Pi.copy()]
+    
+    def __solve(self, A, B):
+        """Solves the DARE, warm-starting if possible."""
+        sol = None
+        if self.__K is not None and self.__K.shape == B.T.shape:
+            sol = self.__hewer(A, B, self.__K)
+        if sol is None:
+            sol = dlqr(A, B, self.__Q, self.__R, self.__M)
+        for m in sol:
+            m.flags.writeable = False
+        return tuple(sol)
+    
+    def __hewer(self, A, B, K):
+        """
+        Newton iteration for the DARE starting from stabilizing gain K.
+        
+        Returns None if K is not stabilizing or iteration does not converge.
+        """
+        Q = self.__Q
+        R = self.__R
+        M = np.zeros(B.shape) if self.__M is None else self.__M
+        Pi = None
+        for i in range(self.__maxiter):
+            Acl = A + B.dot(K)
+            if np.max(np.abs(np.linalg.eigvals(Acl))) >= 1:
+                return None
+            MK = M.dot(K)
+            Qcl = Q + MK + MK.T + K.T.dot(R).dot(K)
+            Pinew = scipy.linalg.solve_discrete_lyapunov(Acl.T, Qcl)
+            K = -scipy.linalg.solve(B.T.dot(Pinew).dot(B) + R,
+                                    B.T.dot(Pinew).dot(A) + M.T)
+            change = np.max(np.abs(Pinew - Pi)) if Pi is not None else np.inf
+            if change <= self.__tol*max(1, np.max(np.abs(Pinew))):
+                return [K, Pinew]
+            Pi = Pinew
+        return None
+
     
 def mtimes(*args, **kwargs):
     """
@@ -240,7 +605,9 @@ def mtimes(*args, **kwargs):
     
     Matrix multiplies all of the given arguments and returns the result. If any
     inputs are Casadi's SX or MX data types, uses Casadi's mtimes. Otherwise,
-    uses a sequence of np.dot operations.
+    uses a sequence of np.dot operations. With Casadi's mtimes, any
+    scipy.sparse matrices are converted via sparseDM, so their zeros do not
+    enter the expression.
     
     Keyword arguments forcedot or forcemtimes can be set to True to pick one
     behavior or another.
@@ -268,10 +635,33 @@ def mtimes(*args, **kwargs):
                 break
 
     # Now actually do multiplication.
-    ans = ctools.mtimes(args) if useMul else reduce(np.dot, args)
+    if useMul:
+        args = [sparseDM(a) if scipy.sparse.issparse(a) else a for a in args]
+        ans = ctools.mtimes(args)
+    else:
+        ans = reduce(np.dot, args)
     return ans
 
 
+def sparseDM(M):
+    """
+    Converts a numpy array or scipy.sparse matrix to a sparse casadi.DM.
+    
+    Any zero entries are removed from the sparsity pattern, so they never
+    enter Casadi expressions. 1D arrays are taken to be column vectors.
+    """
+    if not scipy.sparse.issparse(M):
+        M = np.array(M, dtype=float)
+        if M.ndim < 2:
+            M = M.reshape((-1, 1))
+    M = scipy.sparse.csc_matrix(M, dtype=float)
+    M.eliminate_zeros()
+    M.sort_indices()
+    sparsity = casadi.Sparsity(M.shape[0], M.shape[1], M.indptr.tolist(),
+                               M.indices.tolist())
+    return casadi.DM(sparsity, M.data)
+
+
 def flattenlist(l,depth=1):
     """
     Flattens a nested list of lists of the given depth.
@@ -366,7 +756,7 @@ def smushColloc(t=None, x=None, tc=None, xc=None, Delta=1, asdict=False):
         from . import colloc
         Nc = xc.shape[2]
         [r, _, _, _] = colloc.weights(Nc, include0=False, include1=False)
-        r.shape = (r.size,1)
+        r = r.reshape((r.size,1))
         tc = (t[:-1] + r*Delta).T.copy()
     
     # Add some dimensions to make sizes compatible.
@@ -398,6 +788,54 @@ def smushColloc(t=None, x=None, tc=None, xc=None, Delta=1, asdict=False):
     return ret
 
 
+def interpColloc(tq, x, xc, t=None, Delta=1):
+    """
+    Evaluates the collocation polynomials of a solution at times tq.
+    
+    x and xc must have sizes (Nt+1,Nx) and (Nt,Nx,Nc) as in smushColloc, and t
+    (if given) must have size (Nt+1,). Otherwise, t is constructed using a
+    timestep of Delta. On each interval, the state is the polynomial through
+    x[k], the Nc interior points xc[k], and x[k+1], which is evaluated with
+    the barycentric Lagrange formula. Times outside of t are extrapolated
+    using the first or last polynomial.
+    
+    Returns an array with size (len(tq),Nx).
+    """
+    from . import colloc
+    tq = np.asarray(tq, dtype=float).flatten()
+    x = np.asarray(x, dtype=float)
+    xc = np.asarray(xc, dtype=float)
+    (Nt, Nx, Nc) = xc.shape
+    if t is None:
+        t = np.arange(0, Nt+1)*Delta
+    else:
+        t = np.asarray(t, dtype=float).flatten()
+    
+    # Node values on each interval and barycentric weights.
+    [r, _, _, _] = colloc.weights(Nc, include0=True, include1=True)
+    [ri, rj] = colloc.ijify(r)
+    y = ri - rj
+    np.fill_diagonal(y, 1)
+    w = 1/np.prod(y, axis=1)
+    V = np.concatenate((x[:-1,:,np.newaxis], xc, x[1:,:,np.newaxis]),
+                       axis=2)
+    
+    # Find interval and local time for each query point.
+    k = np.clip(np.searchsorted(t, tq, side="right") - 1, 0, Nt - 1)
+    s = (tq - t[k])/(t[k + 1] - t[k])
+    
+    # Evaluate, taking care of query points that coincide with nodes.
+    diff = s[:,np.newaxis] - r[np.newaxis,:]
+    exact = (diff == 0)
+    diff[exact] = 1
+    terms = w/diff
+    hit = np.any(exact, axis=1)
+    terms[hit] = exact[hit]
+    Xq = np.einsum("qj,qij->qi", terms, V[k])
+    Xq /= np.sum(terms, axis=1)[:,np.newaxis]
+    return Xq
+
+
 @contextmanager
 def nice_stdout():
     """
@@ -522,6 +960,152 @@ class ReadOnlyDict(dict):
     del __readonly__
 
 
+class StageStruct(object):
+    """
+    Lightweight numeric analog of a casadi struct with time-indexed entries.
+
+    entries should be a list of (name, repeat, size) tuples. All values are
+    stored in a single flat array self.cat, with each entry in order and
+    time-major within each entry. Access patterns are the same as for casadi
+    structs, i.e., s["x"] gives a list of (size, 1) arrays, s["x",t] gives
+    a single one, and s["x",t,i] gives individual elements. Setting
+    s["x"] to a single vector sets every time point.
+
+    Unlike casadi structs, these are cheap to create even with thousands of
+    time points.
+    """
+    def __init__(self, entries, value=0):
+        """Creates a struct with all entries equal to value."""
+        self.__entries = [(str(k), int(r), int(n)) for (k, r, n) in entries]
+        self.__index = collections.OrderedDict()
+        offset = 0
+        for (k, r, n) in self.__entries:
+            self.__index[k] = (offset, r, n)
+            offset += r*n
+        self.cat = np.full(offset, value, dtype=float)
+
+    def __call__(self, value=0):
+        """Returns a new struct with the same entries all equal to value."""
+        return StageStruct(self.__entries, value)
+
+    def copy(self):
+        """Returns a copy of self."""
+        s = self()
+        s.cat[:] = self.cat
+        return s
+
+    @property
+    def size(self):
+        return self.cat.size
+
+    def keys(self):
+        return list(self.__index)
+
+    def __view(self, k):
+        """Returns a (repeat, size) view of entry k."""
+        (o, r, n) = self.__index[k]
+        return self.cat[o:o + r*n].reshape((r, n))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return [v[:,np.newaxis] for v in self.__view(key)]
+        view = self.__view(key[0])
+        if len(key) == 2:
+            return view[key[1]][:,np.newaxis]
+        return view[key[1:]]
+
+    def __setitem__(self, key, val):
+        val = np.array(val, dtype=float)
+        if not isinstance(key, tuple):
+            view = self.__view(key)
+            if val.size in (1, view.shape[1]):
+                view[...] = val.reshape((1, -1))
+            else:
+                view[...] = val.reshape(view.shape)
+        else:
+            view = self.__view(key[0])
+            if len(key) == 2:
+                view[key[1]] = val.flatten()
+            else:
+                view[key[1:]] = val
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __repr__(self):
+        return "StageStruct(%r)" % (self.__entries,)
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache that holds at most maxsize entries.
+    
+    Values are created on demand by get(), and the least-recently used
+    entries are discarded once the cache is full. If maxbytes is not None,
+    entries are also discarded once the total nbytes of all values (e.g.,
+    for numpy arrays) exceeds maxbytes.
+    """
+    def __init__(self, maxsize=128, maxbytes=None):
+        """Initialize an empty cache."""
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.__cache = collections.OrderedDict()
+        self.__nbytes = 0
+    
+    @property
+    def nbytes(self):
+        """Total nbytes of all values."""
+        return self.__nbytes
+    
+    def get(self, key, build):
+        """
+        Returns the value for key, calling build() to create it if needed.
+        """
+        try:
+            val = self.__cache.pop(key)
+        except KeyError:
+            val = build()
+            self.__nbytes += getattr(val, "nbytes", 0)
+        self.__cache[key] = val # Moves key to the end.
+        while (len(self.__cache) > self.maxsize
+               or (self.maxbytes is not None
+                   and self.__nbytes > self.maxbytes)):
+            (_, old) = self.__cache.popitem(last=False)
+            self.__nbytes -= getattr(old, "nbytes", 0)
+        return val
+    
+    def lookup(self, key, default=None):
+        """
+        Returns the value for key (marking it as recently used) or default.
+        """
+        try:
+            val = self.__cache.pop(key)
+        except KeyError:
+            return default
+        self.__cache[key] = val
+        return val
+    
+    def clear(self):
+        """Removes all entries."""
+        self.__cache.clear()
+        self.__nbytes = 0
+    
+    def __contains__(self, key):
+        return key in self.__cache
+    
+    def __len__(self):
+        return len(self.__cache)
+
+# Cache for getLinearizedModel. Keys include id() of the Casadi Function, so
+# values also hold a reference to the Function to keep the id from being
+# reused while the entry is in the cache.
+JACOBIAN_CACHE = LRUCache(maxsize=32)
+
+# Cache for expm. Values are read-only arrays, so the cache is also limited
+# to 16 MB in case of large matrices.
+EXPM_CACHE = LRUCache(maxsize=4096, maxbytes=2**24)
+
+
 def strcolor(s, color=None, bold=False):
     """
     Adds ANSI escape sequences to colorize string s.
@@ -577,6 +1161,9 @@ def ekf(f,h,x,u,w,y,P,Q,R,f_jacx=None,f_jacw=None,h_jacx=None):
         
     Depending on your specific application, you will only be interested in
     some of these values.
+    
+    If you are calling this function repeatedly (e.g., in a closed-loop
+    simulation), estimators.EKF is much faster.
     """
     
     # Check jacobians.
@@ -610,6 +1197,24 @@ def ekf(f,h,x,u,w,y,P,Q,R,f_jacx=None,f_jacw=None,h_jacx=None):
     return [Pmp1, xhatmp1, P, xhat]
 
 
+def _timegrid(Delta, Nt):
+    """
+    Returns [Deltas, t] for Nt time intervals with timestep(s) Delta.
+    
+    Delta can be a scalar or a vector with Nt entries. Deltas is always an Nt
+    vector of timesteps, and t is the Nt + 1 vector of time points starting
+    from 0.
+    """
+    Delta = np.array(Delta, dtype=float).flatten()
+    if Delta.size == 1:
+        Delta = np.tile(Delta, Nt)
+    elif Delta.size != Nt:
+        raise ValueError("Delta must be a scalar or have N['t'] = %d entries!"
+                         % (Nt,))
+    t = np.concatenate(([0], np.cumsum(Delta)))
+    return [Delta, t]
+
+
 def _infercolloc(r, guess):
     """
     Infer a guess for collocation states "xc" based on the guess for "x".
@@ -878,6 +1483,74 @@ def jacobianfunc(func, indep, dep=0, name=None):
     return func.factory(name, func.name_in(), [jacname])
 
 
+def fusedjacobianfunc(func, indeps, dep=0, name=None, includef=True):
+    """
+    Returns a Casadi Function to evaluate func and several Jacobians at once.
+
+    indeps should be a list of independent variables, and dep gives the
+    dependent variable. As in jacobianfunc, each can be a (zero-based) integer
+    index or the name of a variable as a string.
+
+    The returned Function has the same inputs as func. Its outputs are the
+    value of func (if includef=True) followed by one Jacobian for each entry
+    of indeps. Because everything is evaluated in a single call, common
+    subexpressions are shared, and there is only one round-trip into Casadi.
+    """
+    if name is None:
+        name = "fusedjac_" + func.name()
+    if isinstance(dep, int):
+        dep = func.name_out(dep)
+    outnames = [dep] if includef else []
+    for i in indeps:
+        if isinstance(i, int):
+            i = func.name_in(i)
+        outnames.append(":".join(["jac", dep, i]))
+    return func.factory(name, func.name_in(), outnames)
+
+
+def mapfunc(func, n, parallelization="serial", maxthreads=None):
+    """
+    Returns func mapped over n horizontally concatenated sets of inputs.
+    
+    parallelization is passed to casadi.Function.map and can be "serial",
+    "openmp", or "thread". For "thread", maxthreads defaults to the number of
+    CPUs instead of Casadi's default of one thread per evaluation.
+    """
+    if parallelization == "thread" and maxthreads is None:
+        maxthreads = os.cpu_count() or 1
+    if maxthreads is None:
+        mapped = func.map(n, parallelization)
+    else:
+        mapped = func.map(n, parallelization, maxthreads)
+    return mapped
+
+
+def nlpstructure(f, g, x, equality=None):
+    """
+    Checks which parts of an optimization problem are linear or quadratic.
+    
+    f and g should be the objective and constraints of an NLP as Casadi
+    expressions in the symbolic variable x. equality is a boolean vector that
+    marks equality constraints in g (by default, all rows are inequalities).
+    
+    Returns a dictionary with boolean entries "linearequality" and
+    "linearinequality" for the two kinds of constraints, "quadratic" for the
+    objective, and "QP" if the whole problem is a QP.
+    """
+    if equality is None:
+        equality = np.zeros(g.numel(), dtype=bool)
+    structure = {}
+    for (name, rows) in [("linearequality", np.flatnonzero(equality)),
+                         ("linearinequality", np.flatnonzero(~equality))]:
+        structure[name] = bool(len(rows) == 0
+                               or casadi.is_linear(g[rows.tolist()], x))
+    structure["quadratic"] = bool(casadi.is_quadratic(f, x))
+    structure["QP"] = (structure["quadratic"]
+                       and structure["linearequality"]
+                       and structure["linearinequality"])
+    return structure
+
+
 def runfile(file, scope=None):
     """
     Executes a file in the given scope and return the dict of variables.